@@ -0,0 +1,152 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+BlockTracker
+
+Backs up the huge files that change in place, VM images and databases named
+in the block-files setting, a block at a time.  rsync's delta algorithm
+reads and checksums all of such a file on both ends every run, so the
+server does as much work for one changed block as for a new file.
+
+- the client keeps a map of the SHA-256 of every block-size-kb block of
+  each file, in the settings folder, and the server keeps the map of the
+  version it last stored
+- a file with the size and mtime in the map has not changed, the server
+  links the version in the latest backup into WORKING
+- otherwise the file is read and hashed locally, HASH_WORKERS blocks at a
+  time, and only the blocks whose hash differs from the map are sent
+- the server starts the new version as a copy of the latest backup's, made
+  with copy_file_range so a filesystem that can shares the blocks rather
+  than copying them, writes the changed blocks into it, checking the hash
+  of each, and puts it in WORKING once its map is the client's
+- if the latest backup does not hold the version the client's map
+  describes, every block is sent
+
+rsync is kept away from the files, see addBlockFiles() in RsyncMethod.  The
+work on the server, and what is sent, grow with the blocks that change
+rather than with the size of the file.
+"""
+
+import os
+import zlib
+import base64
+import sqlite3
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_MAPS_FILE = "block-maps.db"
+HASH_WORKERS = 4
+# changed blocks sent per request
+BLOCK_BATCH = 16 * 1024 * 1024
+DIGEST_LENGTH = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    block_size INTEGER NOT NULL,
+    digests TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def fingerprint(digests):
+    """the SHA-256 of a block map, as the server works it out"""
+    return hashlib.sha256("".join(digests).encode()).hexdigest()
+
+
+class BlockTracker():
+    """send the blocks of huge files that changed since the last backup"""
+
+    def __init__(self, settings_dir, comms, log, block_size):
+        """"""
+        self.comms = comms
+        self.log = log
+        self.block_size = block_size
+        self.db = sqlite3.connect(os.path.join(settings_dir, BLOCK_MAPS_FILE))
+        self.db.executescript(SCHEMA)
+        # the compressed bytes of the changed blocks sent
+        self.sent = 0
+
+    def close(self):
+        """close the block maps"""
+        self.db.close()
+
+    def _map(self, local):
+        """(size, mtime_ns, digests) of the version last sent, None if there
+        is none in blocks of this size
+        """
+        row = self.db.execute("SELECT size, mtime_ns, block_size, digests FROM files WHERE path = ?",
+                              (local,)).fetchone()
+        if row is None or row[2] != self.block_size:
+            return None
+        return row[0], row[1], [row[3][i:i + DIGEST_LENGTH] for i in range(0, len(row[3]), DIGEST_LENGTH)]
+
+    def _readBlock(self, fd, index):
+        """the data of a block"""
+        return os.pread(fd, self.block_size, index * self.block_size)
+
+    def _hashBlocks(self, fd, size):
+        """the digest of every block of the file open as fd"""
+        count = -(-size // self.block_size)
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            return list(pool.map(lambda index: hashlib.sha256(self._readBlock(fd, index)).hexdigest(),
+                                 range(count)))
+
+    def backup(self, local, path, base):
+        """back up the file local to path in WORKING, from its version in the
+        backup base. returns the bytes sent, raises CrashPlanError if it
+        could not be
+        """
+        name = hashlib.sha256(path.encode()).hexdigest()[:40]
+        st = os.stat(local)
+        known = self._map(local)
+        unchanged = known is not None and known[:2] == (st.st_size, st.st_mtime_ns)
+        old = known[2] if known else None
+
+        based = self.comms.blockBegin(name, path, base, fingerprint(old) if old else "", unchanged)
+        if based and unchanged:
+            self.log.info("BlockTracker %s - unchanged" % path)
+            return 0
+
+        fd = os.open(local, os.O_RDONLY)
+        try:
+            digests = old if unchanged else self._hashBlocks(fd, st.st_size)
+            changed = [index for index, digest in enumerate(digests)
+                       if not based or index >= len(old) or old[index] != digest]
+            sent = self._sendBlocks(fd, name, changed, digests)
+        finally:
+            os.close(fd)
+
+        self.comms.blockEnd(name, path, st, self.block_size, fingerprint(digests), based)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                            (local, st.st_size, st.st_mtime_ns, self.block_size, "".join(digests)))
+        self.log.info("BlockTracker %s - %d of %d blocks changed, %d bytes sent"
+                      % (path, len(changed), len(digests), sent))
+        return sent
+
+    def _sendBlocks(self, fd, name, changed, digests):
+        """send the changed blocks in batches, each block as it is now, so
+        digests ends up as what the server has. returns the compressed bytes
+        sent
+        """
+        batch, batch_bytes, sent = [], 0, 0
+        for index in changed:
+            data = self._readBlock(fd, index)
+            digests[index] = hashlib.sha256(data).hexdigest()
+            batch.append([index, digests[index], base64.b64encode(zlib.compress(data)).decode()])
+            batch_bytes += len(batch[-1][2])
+            if batch_bytes >= BLOCK_BATCH:
+                self.comms.blockPut(name, self.block_size, batch)
+                sent += batch_bytes
+                batch, batch_bytes = [], 0
+        if batch:
+            self.comms.blockPut(name, self.block_size, batch)
+            sent += batch_bytes
+        self.sent += sent
+        return sent
+
@@ -0,0 +1,279 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+ChunkMethod
+
+A backup method that stores files as content defined chunks in the server's
+chunk store (see Chunker and ChunkStore) instead of whole files with rsync.
+A 20 GB mailbox that gains a message costs the few chunks around the change,
+and identical chunks are only ever stored once, for every host.
+
+For each source
+- the source is walked, skipping the exclude-files and exclude-folders
+- a file whose size, mtime and inode match the chunk cache from the last run
+  is not read again, its chunk list is reused once the server confirms it
+  still has all the chunks
+- anything else is chunked; the server is asked which of the new chunks it
+  is missing and only those are compressed and sent, CHUNK_BATCH bytes at a
+  time
+- the manifest listing every entry and its chunks is sent in batches and
+  put in place in WORKING at the end
+
+The cache lives in the settings folder as an SQLite file.  Selected with the
+backup-method setting, "chunk" instead of "rsync".
+"""
+
+import os
+import json
+import stat
+import zlib
+import base64
+import fnmatch
+import logging
+import sqlite3
+
+from Settings import Settings
+from RemoteComms import RemoteComms
+from MetaData import MetaData
+from CrashPlan import CrashPlanErrorCodes
+from CrashPlanError import CrashPlanError
+from RsyncMethod import BaseMethod
+from Chunker import chunks
+
+CHUNK_CACHE_FILE = "chunk-cache.db"
+CHUNK_BATCH = 16 * 1024 * 1024
+MANIFEST_BATCH = 2000
+VERIFY_BATCH = 5000
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    chunks TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class ChunkMethod(BaseMethod):
+    """a method of doing backups into the server's chunk store"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, settings, meta, log, comms, dry_run=False, getsize=False):
+        """constructor"""
+        super().__init__()
+        assert isinstance(settings, Settings)
+        assert isinstance(meta, MetaData)
+        assert isinstance(log, logging.Logger)
+        assert isinstance(comms, RemoteComms)
+
+        self.settings = settings
+        self.meta = meta
+        self.log = log
+        self.comms = comms
+        self.dry_run = dry_run
+        self.getsize = getsize
+        self.excludes = [x for x in self.settings('exclude-files').split(',') +
+                         self.settings('exclude-folders').split(',') if x]
+        self.cache_file = os.path.join(self.settings('settings-dir'), CHUNK_CACHE_FILE)
+        self.src = None
+        self.dest = None
+        self.size_required = 0
+        self.files_required = 0
+        self.sent = 0
+        self._reset()
+
+    def _reset(self):
+        """forget the state of the last run"""
+        self.pending = []
+        self.pending_bytes = 0
+        self.manifest = []
+        self.manifest_started = False
+        self.verify = []
+        self.size_required = 0
+        self.files_required = 0
+        self.sent = 0
+
+    def buildCommand(self, src, dest):
+        """remember what to back up, there is no command to build"""
+        self.src = src.rstrip('/')
+        self.dest = dest
+
+    def buildSizeCommand(self, src, dest):
+        """as buildCommand, the size is worked out by a dry run"""
+        self.buildCommand(src, dest)
+
+    def _excluded(self, name):
+        """is name matched by the exclude-files or exclude-folders settings"""
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.excludes)
+
+    def transferredBytes(self):
+        """the bytes the last run sent to the server"""
+        return self.sent
+
+    def _walk(self):
+        """yield (path relative to the source's parent, lstat) of every entry
+        to back up, the source itself first
+        """
+        parent = os.path.dirname(self.src)
+        todo = [os.path.basename(self.src)]
+        while todo:
+            relpath = todo.pop()
+            try:
+                st = os.lstat(os.path.join(parent, relpath))
+            except OSError as exc:
+                self.log.error(f"(ChunkMethod): {exc}")
+                continue
+            yield relpath, st
+            if stat.S_ISDIR(st.st_mode):
+                try:
+                    names = sorted(os.listdir(os.path.join(parent, relpath)), reverse=True)
+                except OSError as exc:
+                    self.log.error(f"(ChunkMethod): {exc}")
+                    continue
+                todo.extend(os.path.join(relpath, name) for name in names if not self._excluded(name))
+
+    def run(self):
+        """back up the source, return one of the CrashPlanErrorCodes values"""
+        self._reset()
+        cache = sqlite3.connect(self.cache_file)
+        cache.executescript(CACHE_SCHEMA)
+        try:
+            self._backup(cache)
+        except CrashPlanError as exc:
+            self.log.error(exc)
+            if "No space left" in str(exc):
+                return CrashPlanErrorCodes.DISK_FULL
+            return CrashPlanErrorCodes.FAILURE
+        finally:
+            cache.commit()
+            cache.close()
+
+        self.log.info("ChunkMethod %s - %d bytes sent" % (self.src, self.sent))
+        return CrashPlanErrorCodes.SUCCESS
+
+    def _backup(self, cache):
+        """walk the source and send what the server does not have"""
+        parent = os.path.dirname(self.src)
+        for relpath, st in self._walk():
+            entry = {'path': relpath, 'mode': stat.S_IMODE(st.st_mode), 'mtime': int(st.st_mtime)}
+            if stat.S_ISDIR(st.st_mode):
+                entry['type'] = 'd'
+            elif stat.S_ISLNK(st.st_mode):
+                entry['type'] = 'l'
+                entry['target'] = os.readlink(os.path.join(parent, relpath))
+            elif stat.S_ISREG(st.st_mode):
+                entry['type'] = 'f'
+                entry['size'] = st.st_size
+                row = cache.execute("SELECT size, mtime, ino, chunks FROM files WHERE path = ?",
+                                    (os.path.join(parent, relpath),)).fetchone()
+                if row and row[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+                    entry['chunks'] = json.loads(row[3])
+                    self.verify.append(entry)
+                    if len(self.verify) >= VERIFY_BATCH:
+                        self._verify(cache)
+                    continue
+                if not self._chunkFile(cache, entry, st):
+                    continue
+            else:
+                # sockets, fifos and devices are not backed up
+                continue
+            self._addEntry(entry)
+
+        self._verify(cache)
+        self._flushChunks()
+        self._flushManifest(last=True)
+
+    def _chunkFile(self, cache, entry, st):
+        """chunk a file, queueing its chunks to be sent, False if it could not be read"""
+        path = os.path.join(os.path.dirname(self.src), entry['path'])
+        entry['chunks'] = []
+        try:
+            with open(path, 'rb') as fp:
+                for digest, data in chunks(fp):
+                    entry['chunks'].append([digest, len(data)])
+                    self.pending.append((digest, data))
+                    self.pending_bytes += len(data)
+                    if self.pending_bytes >= CHUNK_BATCH:
+                        self._flushChunks()
+        except OSError as exc:
+            self.log.error(f"(ChunkMethod): {exc}")
+            return False
+
+        cache.execute("INSERT OR REPLACE INTO files (path, size, mtime, ino, chunks) VALUES (?, ?, ?, ?, ?)",
+                      (path, st.st_size, st.st_mtime_ns, st.st_ino, json.dumps(entry['chunks'])))
+        return True
+
+    def _verify(self, cache):
+        """check the server still has the chunks of the files taken from the
+        cache, chunking again any that it has lost
+        """
+        if not self.verify:
+            return
+        entries, self.verify = self.verify, []
+        digests = {digest for entry in entries for digest, _size in entry['chunks']}
+        missing = set(self._missing(list(digests)))
+        for entry in entries:
+            if any(digest in missing for digest, _size in entry['chunks']):
+                path = os.path.join(os.path.dirname(self.src), entry['path'])
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if not self._chunkFile(cache, entry, st):
+                    continue
+            self._addEntry(entry)
+
+    def _missing(self, digests):
+        """the digests the server's chunk store does not have"""
+        reply, = self.comms.agent([{'op': 'chunks-missing', 'digests': digests}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot query the chunk store. ({reply['error']})")
+        return reply['missing']
+
+    def _flushChunks(self):
+        """send the queued chunks the server does not have yet"""
+        if not self.pending:
+            return
+        pending, self.pending, self.pending_bytes = self.pending, [], 0
+
+        missing = set(self._missing(sorted({digest for digest, _data in pending})))
+        batch = []
+        for digest, data in pending:
+            if digest in missing:
+                missing.discard(digest)
+                if self.dry_run:
+                    self.size_required += len(data) / 1024
+                    self.files_required += 1
+                else:
+                    batch.append([digest, base64.b64encode(zlib.compress(data)).decode()])
+                    self.sent += len(batch[-1][1])
+        if batch:
+            reply, = self.comms.agent([{'op': 'chunks-put', 'chunks': batch}])
+            if not reply['ok']:
+                raise CrashPlanError(f"ERROR: cannot store chunks. ({reply['error']})")
+
+    def _addEntry(self, entry):
+        """add an entry to the manifest, sending a batch when there are enough"""
+        self.manifest.append(entry)
+        if len(self.manifest) >= MANIFEST_BATCH:
+            # the chunks the entries refer to must be stored first
+            self._flushChunks()
+            self._flushManifest()
+
+    def _flushManifest(self, last=False):
+        """send the queued manifest entries"""
+        if self.dry_run:
+            self.manifest = []
+            return
+        entries, self.manifest = self.manifest, []
+        reply, = self.comms.agent([{'op': 'manifest-put', 'source': os.path.basename(self.src),
+                                    'entries': entries, 'first': not self.manifest_started,
+                                    'last': last}])
+        self.manifest_started = True
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot write the manifest. ({reply['error']})")
+
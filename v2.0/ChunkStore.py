@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+ChunkStore - server side
+
+  python3 ChunkStore.py restore <backup-destination> <host> <backup> <target>
+  python3 ChunkStore.py gc <backup-destination>
+
+The store behind the chunk backup method.  Files are cut into content
+defined chunks on the client (see Chunker) and each chunk is kept once, for
+every host, in <backup-destination>/.chunks/
+- packs/<n>.pack hold the zlib compressed chunks end to end, a new pack is
+  started once the current one reaches PACK_SIZE
+- index.db maps each chunk's sha256 to its pack, offset and length
+
+A backup made this way is a folder holding a manifest per source,
+.manifest-<source>.jsonl.gz, one JSON line per file, folder or symlink with
+its attributes and, for files, the list of chunks.  The folder is renamed
+from WORKING to its date like any other backup, and is pruned the same way;
+gc then drops the chunks no manifest refers to and repacks packs that are
+mostly dead.  The reclaimer runs gc once it has emptied the trash of chunk
+backups.  A backup only writes its manifest after it has checked which
+chunks the store already has, so every chunk remembers when it was last
+asked for or added and gc leaves those seen within GC_GRACE alone.
+
+Chunks arrive compressed and are only added after their contents have been
+checked against their name.  Pack data is flushed to disk before the index
+refers to it, a crash leaves at most some unreferenced bytes in a pack.
+
+Only the standard library is used, this runs under the server agent.
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import zlib
+import fcntl
+import base64
+import hashlib
+import sqlite3
+
+CHUNKS_DIR = ".chunks"
+CHUNKS_DB = "index.db"
+CHUNKS_LOCK = ".lock"
+PACK_SIZE = 64 * 1024 * 1024
+MANIFEST_PREFIX = ".manifest-"
+MANIFEST_SUFFIX = ".jsonl.gz"
+GC_DEAD_RATIO = 0.5
+GC_GRACE = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    digest TEXT PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    seen INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chunks_pack ON chunks (pack);
+"""
+
+
+def manifestName(source):
+    """the file name of the manifest of one backup source"""
+    return MANIFEST_PREFIX + source + MANIFEST_SUFFIX
+
+
+def readManifests(backup, partial=False):
+    """yield every entry of every manifest in a backup folder, and of those
+    still being written if partial
+    """
+    for name in sorted(os.listdir(backup)):
+        if name.startswith(MANIFEST_PREFIX) and \
+           (name.endswith(MANIFEST_SUFFIX) or partial and name.endswith(MANIFEST_SUFFIX + ".part")):
+            with gzip.open(os.path.join(backup, name), 'rt') as fp:
+                for line in fp:
+                    yield json.loads(line)
+
+
+def hasManifests(backup):
+    """True if a backup folder was made by the chunk method"""
+    return any(name.startswith(MANIFEST_PREFIX) for name in os.listdir(backup))
+
+
+def manifestBackups(destination):
+    """yield (host, backup name, path) for every backup folder of every
+    host, the ones in the trash and other dot folders are left out
+    """
+    for host in sorted(os.listdir(destination)):
+        hostdir = os.path.join(destination, host)
+        if host.startswith('.') or not os.path.isdir(hostdir):
+            continue
+        for name in sorted(os.listdir(hostdir)):
+            backup = os.path.join(hostdir, name)
+            if not name.startswith('.') and os.path.isdir(backup):
+                yield host, name, backup
+
+
+def chunkGroups(destination, host, names):
+    """{tuple of backup names: bytes} for the chunks that only the backups
+    names of host refer to, by the set of backups referring to them. a chunk
+    is freed by removing its backups once gc rewrites its pack, so for packs
+    gc leaves in place this errs on the high side.
+    """
+    db_path = os.path.join(destination, CHUNKS_DIR, CHUNKS_DB)
+    if not os.path.exists(db_path):
+        return {}
+    names = set(names)
+    holders = {}
+    kept = set()
+    for backup_host, name, backup in manifestBackups(destination):
+        if not hasManifests(backup):
+            continue
+        mine = backup_host == host and name in names
+        for entry in readManifests(backup, partial=True):
+            for digest, _size in entry.get('chunks', []):
+                if mine:
+                    holders.setdefault(digest, set()).add(name)
+                else:
+                    kept.add(digest)
+    if not holders:
+        return {}
+
+    groups = {}
+    db = sqlite3.connect(db_path)
+    try:
+        for digest, length in db.execute("SELECT digest, length FROM chunks"):
+            if digest in holders and digest not in kept:
+                key = tuple(sorted(holders[digest]))
+                groups[key] = groups.get(key, 0) + length
+    finally:
+        db.close()
+    return groups
+
+
+class ChunkStore():
+    """the chunk store of one backup destination"""
+
+    def __init__(self, destination):
+        """"""
+        self.destination = destination
+        self.root = os.path.join(destination, CHUNKS_DIR)
+        os.makedirs(os.path.join(self.root, "packs"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.root, CHUNKS_DB))
+        self.db.executescript(SCHEMA)
+        self.lockfile = None
+
+    def close(self):
+        """"""
+        self.db.close()
+
+    def lock(self):
+        """hold the store's lock, others wait"""
+        self.lockfile = open(os.path.join(self.root, CHUNKS_LOCK), 'w')   # pylint: disable=consider-using-with
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+
+    def unlock(self):
+        """"""
+        self.lockfile.close()
+        self.lockfile = None
+
+    def packPath(self, pack):
+        """"""
+        return os.path.join(self.root, "packs", "%d.pack" % pack)
+
+    def missing(self, digests):
+        """the digests that are not in the store. the ones it has are marked
+        seen, the backup asking is about to refer to them.
+        """
+        self.lock()
+        try:
+            digests = list(digests)
+            have = self._have(digests)
+            with self.db:
+                self.db.executemany("UPDATE chunks SET seen = ? WHERE digest = ?",
+                                    ((int(time.time()), digest) for digest in have))
+            return [digest for digest in digests if digest not in have]
+        finally:
+            self.unlock()
+
+    def _have(self, digests):
+        """the digests of a list that are in the store"""
+        have = set()
+        for i in range(0, len(digests), 500):
+            batch = digests[i:i+500]
+            have.update(row[0] for row in self.db.execute(
+                "SELECT digest FROM chunks WHERE digest IN (%s)" % ",".join("?" * len(batch)), batch))
+        return have
+
+    def _currentPack(self):
+        """the pack new chunks go to"""
+        row = self.db.execute("SELECT max(pack) FROM chunks").fetchone()
+        pack = row[0] or 1
+        while os.path.exists(self.packPath(pack + 1)):
+            pack += 1
+        if os.path.exists(self.packPath(pack)) and os.path.getsize(self.packPath(pack)) >= PACK_SIZE:
+            pack += 1
+        return pack
+
+    def put(self, chunks):
+        """add [digest, base64 of the zlib compressed chunk] pairs, skipping
+        any already stored. returns (chunks added, bytes written).
+        """
+        self.lock()
+        try:
+            digests = [digest for digest, _data in chunks]
+            todo = set(digests) - self._have(digests)
+            pack = self._currentPack()
+            rows = []
+            written = 0
+            now = int(time.time())
+            with open(self.packPath(pack), 'ab') as fp:
+                for digest, data in chunks:
+                    if digest not in todo:
+                        continue
+                    packed = base64.b64decode(data)
+                    raw = zlib.decompress(packed)
+                    if hashlib.sha256(raw).hexdigest() != digest:
+                        raise ValueError("chunk %s does not match its contents" % digest)
+                    rows.append((digest, pack, fp.tell(), len(packed), len(raw), now))
+                    fp.write(packed)
+                    written += len(packed)
+                    todo.discard(digest)
+                fp.flush()
+                os.fsync(fp.fileno())
+            with self.db:
+                self.db.executemany("INSERT OR IGNORE INTO chunks (digest, pack, offset, length, size, seen) "
+                                    "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            return len(rows), written
+        finally:
+            self.unlock()
+
+    def get(self, digest):
+        """the contents of one chunk"""
+        row = self.db.execute("SELECT pack, offset, length FROM chunks WHERE digest = ?",
+                              (digest,)).fetchone()
+        if not row:
+            raise KeyError("chunk %s is not in the store" % digest)
+        with open(self.packPath(row[0]), 'rb') as fp:
+            fp.seek(row[1])
+            return zlib.decompress(fp.read(row[2]))
+
+    def restore(self, backup, target):
+        """recreate the files of a backup folder under target"""
+        folders = []
+        for entry in readManifests(backup):
+            path = os.path.join(target, entry['path'])
+            if entry['type'] == 'd':
+                os.makedirs(path, exist_ok=True)
+                folders.append(entry)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if entry['type'] == 'l':
+                os.symlink(entry['target'], path)
+                continue
+            with open(path, 'wb') as fp:
+                for digest, _size in entry['chunks']:
+                    fp.write(self.get(digest))
+            os.chmod(path, entry['mode'])
+            os.utime(path, (entry['mtime'], entry['mtime']))
+        # deepest first, making a folder's contents changes its times
+        for entry in sorted(folders, key=lambda e: e['path'].count('/'), reverse=True):
+            path = os.path.join(target, entry['path'])
+            os.chmod(path, entry['mode'])
+            os.utime(path, (entry['mtime'], entry['mtime']))
+
+    def live(self):
+        """the digests referred to by any manifest of any backup"""
+        live = set()
+        for _host, _name, backup in manifestBackups(self.destination):
+            for entry in readManifests(backup, partial=True):
+                live.update(digest for digest, _size in entry.get('chunks', []))
+        return live
+
+    def exclusive(self, backups):
+        """{backup path: bytes} for the chunks each of the backups alone
+        refers to, among themselves and every other backup. chunks shared
+        by several of them are not counted, so this errs on the low side.
+        """
+        live = self.live()
+        holders = {}
+        for backup in backups:
+            for entry in readManifests(backup, partial=True):
+                for digest, _size in entry.get('chunks', []):
+                    if digest not in live:
+                        holders.setdefault(digest, set()).add(backup)
+        exclusive = {backup: 0 for backup in backups}
+        for digest, length in self.db.execute("SELECT digest, length FROM chunks"):
+            if len(holders.get(digest, ())) == 1:
+                exclusive[next(iter(holders[digest]))] += length
+        return exclusive
+
+    def gc(self, grace=GC_GRACE):
+        """drop the chunks no backup refers to and rewrite the packs that are
+        mostly dead. chunks seen within grace seconds are kept, a running
+        backup may not have written them to its manifest yet. returns
+        (chunks dropped, bytes freed).
+        """
+        self.lock()
+        try:
+            live = self.live()
+            cutoff = time.time() - grace
+            dropped = 0
+            freed = 0
+            packs = [row[0] for row in self.db.execute("SELECT DISTINCT pack FROM chunks")]
+            current = self._currentPack()
+            for pack in packs:
+                rows = self.db.execute("SELECT digest, offset, length, size, seen FROM chunks WHERE pack = ?",
+                                       (pack,)).fetchall()
+                dead = [row for row in rows if row[0] not in live and row[4] < cutoff]
+                if not dead:
+                    continue
+                dead_bytes = sum(row[2] for row in dead)
+                with self.db:
+                    self.db.executemany("DELETE FROM chunks WHERE digest = ?", [(row[0],) for row in dead])
+                dropped += len(dead)
+
+                if pack == current or dead_bytes < GC_DEAD_RATIO * os.path.getsize(self.packPath(pack)):
+                    continue
+                freed += self._repack(pack, [row for row in rows if row not in dead])
+            return dropped, freed
+        finally:
+            self.unlock()
+
+    def _repack(self, pack, rows):
+        """copy the live chunks of a pack to a new one and remove it"""
+        size = os.path.getsize(self.packPath(pack))
+        if not rows:
+            os.unlink(self.packPath(pack))
+            return size
+        new = self._currentPack() + 1
+        moved = []
+        with open(self.packPath(pack), 'rb') as src, open(self.packPath(new), 'wb') as dest:
+            for digest, offset, length, _size, _seen in rows:
+                src.seek(offset)
+                moved.append((new, dest.tell(), digest))
+                dest.write(src.read(length))
+            dest.flush()
+            os.fsync(dest.fileno())
+        with self.db:
+            self.db.executemany("UPDATE chunks SET pack = ?, offset = ? WHERE digest = ?", moved)
+        os.unlink(self.packPath(pack))
+        return size - os.path.getsize(self.packPath(new))
+
+
+def main(argv):
+    """restore a backup or collect garbage from the command line"""
+    if len(argv) == 5 and argv[0] == 'restore':
+        store = ChunkStore(argv[1])
+        store.restore(os.path.join(argv[1], argv[2], argv[3]), argv[4])
+        store.close()
+        return 0
+    if len(argv) == 2 and argv[0] == 'gc':
+        store = ChunkStore(argv[1])
+        dropped, freed = store.gc()
+        store.close()
+        print("%d chunks dropped, %d bytes freed" % (dropped, freed))
+        return 0
+
+    sys.stderr.write("usage: ChunkStore.py restore <backup-destination> <host> <backup> <target>\n"
+                     "       ChunkStore.py gc <backup-destination>\n")
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
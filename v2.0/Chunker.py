@@ -0,0 +1,87 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+Chunker
+
+Content defined chunking for the chunk store backup method.
+
+A file is cut where the bytes just before a position match a condition, so
+the cut points move with the data: inserting or removing a few bytes in a
+20 GB mailbox changes the chunks around the edit and no others, where fixed
+size blocks would all shift.
+
+A rolling hash such as FastCDC's gear hash needs a step per byte, which in
+pure python runs at a few MB/s.  Instead the cut condition is tested only at
+anchors, the positions just after an ANCHOR byte, which bytes.find locates at
+C speed:
+- at an anchor the CHUNK_WINDOW bytes before it are hashed with crc32 and a
+  cut is made if the hash matches a mask; anchors come about every 256 bytes
+  in typical data so the masks are 8 bits short of the average size
+- nothing is looked at in the first CHUNK_MIN bytes of a chunk
+- as in FastCDC a stricter mask is used before CHUNK_AVG and a looser one
+  after, which keeps chunk sizes close to the average
+- a chunk is cut at CHUNK_MAX whatever the data, long runs with no anchor
+  (zero filled disk images) are cut into CHUNK_MAX pieces
+
+Chunks are named by the sha256 of their contents.
+"""
+
+import zlib
+import hashlib
+
+CHUNK_MIN = 256 * 1024
+CHUNK_AVG = 1024 * 1024
+CHUNK_MAX = 4 * 1024 * 1024
+CHUNK_WINDOW = 48
+READ_SIZE = 8 * 1024 * 1024
+
+ANCHOR = b'\x8e'
+# 1 MiB on average is 2**20, an anchor every 2**8 bytes leaves 12 bits, one
+# more before the average and one fewer after
+MASK_STRICT = (1 << 13) - 1
+MASK_LOOSE = (1 << 11) - 1
+
+
+def cutPoint(data, start, end):
+    """the offset of the end of the chunk that begins at start, looking no
+    further than end
+    """
+    if end - start <= CHUNK_MIN:
+        return end
+
+    limit = min(end, start + CHUNK_MAX)
+    normal = min(end, start + CHUNK_AVG)
+    find = data.find
+    i = find(ANCHOR, start + CHUNK_MIN - 1, limit)
+    while i >= 0:
+        cut = i + 1
+        mask = MASK_STRICT if cut < normal else MASK_LOOSE
+        if not zlib.crc32(data[cut - CHUNK_WINDOW:cut]) & mask:
+            return cut
+        i = find(ANCHOR, cut, limit)
+    return limit
+
+
+def chunks(fp):
+    """yield (sha256 hex digest, bytes) for each chunk of an open binary file"""
+    buf = b''
+    pos = 0
+    eof = False
+    while True:
+        # a cut point is only final with a full CHUNK_MAX to look at
+        if not eof and len(buf) - pos < CHUNK_MAX:
+            block = fp.read(READ_SIZE)
+            eof = not block
+            buf = buf[pos:] + block
+            pos = 0
+            continue
+        if pos >= len(buf):
+            return
+
+        cut = cutPoint(buf, pos, len(buf))
+        chunk = buf[pos:cut]
+        pos = cut
+        yield hashlib.sha256(chunk).hexdigest(), chunk
+
@@ -0,0 +1,175 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+ContinuousBackup
+
+Continuous protection for Linux clients, run with --continuous.  Instead of
+one backup a day, which leaves up to a day's work exposed and pays for a
+scan of everything each time, the sources are watched with inotify (see
+SourceWatcher) and what changes is sent into WORKING in small batches.
+
+- on starting, and after each snapshot, WORKING is brought up to date with a
+  journal scan pass (JournalRsyncMethod), cloning the latest backup first
+  when there is no WORKING; events from then on are collected
+- once continuous-interval seconds have passed since the last batch and
+  nothing has changed for continuous-quiet seconds, the dirty paths go to
+  rsync with --files-from, the same way the journal's changes do.  Under
+  constant changes a batch is sent after twice the interval regardless
+- if events were lost, the queue overflowed or there are too many folders
+  to watch, the next batch is a scan pass instead
+- once a day, as the scheduled backup would, the last changes are sent and
+  WORKING is finalized as a dated snapshot through CrashPlan.finishUp(), so
+  pruning, the catalog and dedupe happen as they always do
+
+A batch that fails is put back and tried again with the next one.
+"""
+
+import os
+import time
+
+from CrashPlan import CrashPlan
+from CrashPlanError import CrashPlanError
+from FileJournal import ScanResult
+from JournalRsyncMethod import JournalRsyncMethod
+from Inotify import SourceWatcher
+from Utils import TimeDate
+
+POLL_TIMEOUT = 5
+
+
+class ContinuousMethod(JournalRsyncMethod):
+    """a JournalRsyncMethod that can be given the changes to send"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, settings, meta, log, comms, dry_run=False, getsize=False):
+        """constructor"""
+        super().__init__(settings, meta, log, comms, dry_run, getsize)
+        # the dirty paths to send, None for a scan pass
+        self.batch = None
+
+    def buildCommand(self, src, dest):
+        """send the dirty paths in the source, or scan it"""
+        if self.batch is None:
+            super().buildCommand(src, dest)
+            return
+
+        src = src.rstrip('/')
+        parent = os.path.dirname(src)
+        self.src = src
+        self.scan = ScanResult(True)
+        for path in sorted(self.batch):
+            if path != src and not path.startswith(src + '/'):
+                continue
+            if os.path.lexists(path):
+                self.scan.candidates.append(os.path.relpath(path, parent))
+            else:
+                self.scan.deletions.append(os.path.relpath(path, parent))
+
+        self.cmd = self._journalCmd(self.dry_run)
+        self.cmd += self._journalArgs(src, dest)
+
+
+class ContinuousBackup():
+    """watch the sources, send batches of changes and make a snapshot a day"""
+
+    def __init__(self, settings, meta, log, comms):
+        """"""
+        self.settings = settings
+        self.log = log
+        self.comms = comms
+        self.method = ContinuousMethod(settings, meta, log, comms)
+        self.crashplan = CrashPlan(settings, meta, log, comms, self.method, False)
+        # every batch goes over the sources again, none of them is ever done
+        self.crashplan.runs = None
+        self.watcher = None
+        self.interval = self.settings('continuous-interval')
+        self.quiet = self.settings('continuous-quiet')
+        self.snapshot_day = meta.get('backup-today')
+        # WORKING holds everything up to the last batch
+        self.current = False
+        self.last_batch = 0
+
+    def start(self):
+        """watch the sources, events are collected from now on"""
+        excludes = [x for x in self.settings('exclude-files').split(',') +
+                    self.settings('exclude-folders').split(',') if x]
+        try:
+            self.watcher = SourceWatcher(self.crashplan.backupSources(), excludes, self.log,
+                                         self.settings('continuous-max-watches'))
+        except OSError as exc:
+            raise CrashPlanError(f"ERROR: continuous mode needs inotify. ({exc})")
+        self.watcher.start()
+
+    def run(self, stop=None):
+        """run until stop() returns True or we are interrupted"""
+        self.start()
+        try:
+            while not (stop and stop()):
+                self.watcher.poll(POLL_TIMEOUT)
+                self.step(time.time())
+        except KeyboardInterrupt:
+            self.log.info("Continuous backup stopped")
+        finally:
+            self.watcher.close()
+
+    def due(self, now):
+        """is it time to send the dirty paths"""
+        watcher = self.watcher
+        if not watcher.dirty or now - self.last_batch < self.interval:
+            return False
+        return now - (watcher.last_event or 0) >= self.quiet or now - self.last_batch >= 2 * self.interval
+
+    def step(self, now):
+        """send a batch or a scan pass, and a snapshot, if they are due"""
+        snapshot = self.snapshot_day != TimeDate.today()
+
+        if not self.current or self.watcher.overflowed:
+            # a failed pass, or a watcher that cannot keep up, waits its turn
+            if now - self.last_batch >= self.interval:
+                self.scanPass()
+                self.last_batch = now
+        elif self.due(now) or (snapshot and self.watcher.dirty):
+            self.sendBatch()
+            self.last_batch = now
+
+        if snapshot and self.current and not self.watcher.dirty:
+            self.snapshot()
+
+    def _backup(self):
+        """run the method over every source"""
+        self.crashplan.doBackup()
+        return self.crashplan.backup_successful
+
+    def scanPass(self):
+        """bring WORKING up to date by scanning the sources"""
+        self.method.batch = None
+        # the scan finds these, and anything that changes while it runs is
+        # read from the queue afterwards
+        dirty = self.watcher.take()
+        self.current = self._backup()
+        if self.current:
+            self.watcher.rescanned()
+        else:
+            self.watcher.putBack(dirty)
+
+    def sendBatch(self):
+        """send the dirty paths into WORKING"""
+        batch = self.watcher.take()
+        self.method.batch = batch
+        self.log.info("ContinuousBackup - sending %d changed paths" % len(batch))
+        if not self._backup():
+            self.watcher.putBack(batch)
+
+    def snapshot(self):
+        """finalize WORKING as today's backup, the next pass starts a new
+        WORKING from it
+        """
+        self.crashplan.finishUp()
+        self.snapshot_day = TimeDate.today()
+        self.current = False
+        self.last_batch = 0
+        self.comms.openMaster()
+        self.comms.serverState()
+
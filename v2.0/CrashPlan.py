@@ -15,7 +15,9 @@ Backup Scenarios
   folder still exists.
 
 * incremental backup starts after a previous failed to complete backup.
-- Use WORKING and link to LATEST_COMPLETE to continue the backup.
+- Use WORKING and link to LATEST_COMPLETE to continue the backup. The
+  sources, and shards of sources, the failed backup finished are skipped,
+  see RunJournal.
 
 * incremental backup completes after starting from incomplete backup.
 - Once complete, rename WORKING to <Date/Time NOW> and update LATEST_COMPLETE
@@ -37,6 +39,16 @@ from RemoteComms import RemoteComms
 from MetaData import MetaData
 from Utils import TimeDate
 from CrashPlanError import CrashPlanError
+from RsyncOutput import RsyncChange, RsyncEvent
+from FileJournal import FileJournal
+from SizeHistory import SizeHistory
+from SpaceWatchdog import SpaceWatchdog
+from RunJournal import RunJournal, unitTime
+from BlockTracker import BlockTracker
+
+# times to prune more and wait for the reclaimer before giving up on a
+# backup there is no room for
+ADMIT_TRIES = 5
 
 class CrashPlanErrorCodes(Enum):
     NOT_RUN = 0
@@ -65,30 +77,79 @@ class CrashPlan():
         self.local_hostname = self.settings('local-hostname')
         self.meta = meta
         self.backup_successful = False
+        # the journal getSize() estimates from, made when first needed, and
+        # whether the method scans with it and commits it too
+        self.journal = None
+        self.journal_shared = False
+        # what getSize() predicted for each source, and what the run really
+        # took, to calibrate later predictions
+        self.sizes = SizeHistory(self.settings('settings-dir'))
+        self.predicted = {}
+        self.predicted_files = {}
+        self.transferred = 0
+        self.free_before = None
+        # the paths the backup updated and deleted, for the server's catalog,
+        # only kept when the catalog takes them rather than walking the
+        # backup, see keepChanges()
+        self.changes = None
+        self.listening = self.method.addListener(self.recordChange)
+        self.changes_decided = False
+        # the sources, and the shards of those the method splits up, this
+        # run and an interrupted one before it have finished
+        self.runs = None
+        if not dry_run:
+            self.runs = RunJournal(self.settings('settings-dir'), self.comms, self.log)
+            self.method.addRunJournal(self.runs)
+        # pauses the backup to make room when the server's disk runs low
+        self.watchdog = None
+        if self.settings('space-watchdog-mb') and not dry_run:
+            self.watchdog = SpaceWatchdog(self.comms, self.log, self.settings('space-watchdog-mb') * 1024 * 1024,
+                                          self.settings('space-watchdog-interval'),
+                                          lambda need: self.makeRoom(need=need), self.method.projection)
+            if not self.method.addWatchdog(self.watchdog):
+                self.watchdog = None
+        # the huge files that change in place, backed up a changed block at
+        # a time rather than by the method
+        self.blocks = None
+        self.block_files = [path for path in self.settings('block-files').split(',') if path]
+        if self.block_files and self.method.addBlockFiles(self.block_files) and not dry_run:
+            self.blocks = BlockTracker(self.settings('settings-dir'), self.comms, self.log,
+                                       self.settings('block-size-kb') * 1024)
 
     def doBackup(self):
         """
         call rsync for each folder in list of backup sources
         """
-        sources = [os.environ['HOME']]
-
-        for extra in self.settings("extra-backup-sources-list"):
-
-            if extra != '' and os.path.exists(extra):
-                sources.append(extra)
+        sources = self.backupSources()
+        if self.free_before is None:
+            try:
+                self.free_before = self.comms.space()['free']
+            except CrashPlanError as exc:
+                self.log.error(exc)
+        self.beginRun()
+        self.keepChanges()
         try:
             successes = 0
 
             for src in sources:
                 result = CrashPlanErrorCodes.NOT_RUN
-                if self.comms.remoteSpace() > self.settings('maximum-used-percent'):
-                    result = CrashPlanErrorCodes.DISK_FULL
+                mtime = unitTime(src)
+                if self.runs is not None and self.runs.finished(src, mtime):
+                    self.log.info("Backup of %s finished in the interrupted run" % src)
+                    successes += 1
+                    continue
+                self.makeRoom(need=self.expectedBytes(src))
+                if not self.admit(src):
+                    continue
 
                 while result in [CrashPlanErrorCodes.NOT_RUN, CrashPlanErrorCodes.DISK_FULL]:
-                    if result == CrashPlanErrorCodes.DISK_FULL:
-                        self.deleteOldestBackup()
+                    if result == CrashPlanErrorCodes.DISK_FULL and not self.makeRoom(disk_full=True):
+                        self.log.error("Backup of %s ran out of space with nothing left to prune" % src)
+                        break
                     result = self.backupFolder(src)
 
+                if self.runs is not None:
+                    self.runs.record(src, result.name, mtime, os.path.basename(src.rstrip('/')))
                 if result == CrashPlanErrorCodes.SUCCESS:
                     successes += 1
 
@@ -99,11 +160,116 @@ class CrashPlan():
         print("Backup successful? ", self.backup_successful, "len(sources) == ", len(sources))
         print("sources: ", sources)
 
+    def beginRun(self):
+        """pick up the run journal of an interrupted run into WORKING"""
+        if self.runs is not None:
+            backup_list = self.comms.getBackupList()
+            self.runs.begin(os.path.basename(backup_list[-1]) if backup_list else "")
+
+    def keepChanges(self):
+        """decide, once a backup, whether to keep the paths it changes. the
+        catalog walks the backup instead when it does not have the one
+        before or WORKING is left from an interrupted run, and a list of
+        every path of such a run is only a waste of memory
+        """
+        if self.changes_decided or not self.listening or self.dry_run:
+            return
+        self.changes_decided = True
+        try:
+            if self.comms.catalogStreams():
+                self.changes = {'updated': [], 'deleted': []}
+        except CrashPlanError as exc:
+            self.log.error(exc)
+
+    def backupSources(self):
+        """$HOME and the extra backup sources that exist"""
+        sources = [os.environ['HOME']]
+
+        for extra in self.settings("extra-backup-sources-list"):
+
+            if extra != '' and os.path.exists(extra):
+                sources.append(extra)
+        return sources
+
+    def recordChange(self, event):
+        """keep the path of each change rsync reports"""
+        if self.changes is None:
+            return
+        if event.change == RsyncChange.DELETED:
+            self.changes['deleted'].append(event.path)
+        else:
+            self.changes['updated'].append(event.path)
+
+    def expectedBytes(self, src):
+        """the bytes the backup of src is expected to take on the server, what
+        getSize() predicted calibrated by how earlier predictions turned out.
+        0 if there is no prediction.
+        """
+        if src not in self.predicted:
+            return 0
+        return self.sizes.calibrate(self.predicted[src])
+
+    def shortfall(self, space, need, files):
+        """why the server's space cannot take need bytes in files new files,
+        "" if it can. what the reclaimer has still to free counts as free, a
+        backup that runs ahead of it waits for it as one that fills the disk
+        does.
+        """
+        if space['free'] + space['pending'] < need:
+            return "%d bytes are needed and %d are free, %d of them still being reclaimed" % (
+                need, space['free'] + space['pending'], space['pending'])
+        if space['inodes'] and space['inodes_free'] < files:
+            return "%d files are needed and there are %d free inodes" % (files, space['inodes_free'])
+        return ""
+
+    def admit(self, src):
+        """check the server has room for the backup of src, the bytes and
+        the files it is expected to write, pruning more until it has.
+        returns False if it has not and nothing more can be pruned.
+        """
+        need = self.expectedBytes(src)
+        files = self.predicted_files.get(src, 0)
+        for _try in range(ADMIT_TRIES):
+            try:
+                reason = self.shortfall(self.comms.space(), need, files)
+            except CrashPlanError as exc:
+                # the backup finds out for itself
+                self.log.error(exc)
+                return True
+            if not reason:
+                return True
+            self.log.info("Not enough room for the backup of %s, %s" % (src, reason))
+            if not self.makeRoom(disk_full=True, need=need):
+                break
+        self.log.error("Backup of %s skipped, there is no room for it on the server" % src)
+        return False
+
+    def makeRoom(self, disk_full=False, need=0):
+        """trash the backups the server picks to bring the space used, less
+        what is still waiting to be reclaimed, plus the bytes the next backup
+        needs, under the limit. they are
+        chosen in one go from what each would really free, and the reclaimer
+        deletes them while the backup runs.
+
+        after the disk filled up at least one more backup goes and we wait
+        for the reclaimer to catch up. returns False if there was nothing to
+        trash and nothing left to reclaim.
+        """
+        victims = self.comms.planPrune(self.settings('maximum-used-percent'), 1 if disk_full else 0, need)
+        trashed = bool(victims) and self.comms.trashBackups(victims) > 0
+
+        if disk_full:
+            return self.comms.waitForReclaim() or trashed
+        return True
+
     def deleteOldestBackup(self):
-        """if its not the last remaining backup then delete the oldest."""
+        """if its not the last remaining backup then move the oldest to the
+        trash. returns True if one was.
+        """
         backup_list = self.comms.getBackupList()
         if len(backup_list) > 1:
-            self.comms.removeOldestBackup(backup_list[0])
+            return self.comms.trashBackup(backup_list[0])
+        return False
 
     def backupFolder(self, src):
         """
@@ -119,64 +285,167 @@ class CrashPlan():
                                    self.local_hostname, "WORKING")
 
         self.method.buildCommand(src, destination)
+        blocks_sent = self.backupBlocks(src)
 
         self.log.info("Start Backing Up of %s to - %s" % (src, destination))
 
-        result = self.method.run()
+        if self.watchdog is not None:
+            self.watchdog.start()
+        try:
+            result = self.method.run()
+        finally:
+            if self.watchdog is not None:
+                self.watchdog.stop()
+        if self.watchdog is not None and self.watchdog.aborted:
+            result = CrashPlanErrorCodes.DISK_FULL
+        if not blocks_sent and result == CrashPlanErrorCodes.SUCCESS:
+            result = CrashPlanErrorCodes.UNKNOWN_ERROR
+        self.transferred += self.method.transferredBytes()
 
         self.log.info("Backup of %s was %ssuccessful\n" % (src, '' if result == CrashPlanErrorCodes.SUCCESS else 'not '))
 
         return result
 
-    def getSize(self):
+    def backupBlocks(self, src):
+        """back up the block files in src with the BlockTracker. returns
+        False if one of them could not be
         """
+        if self.blocks is None:
+            return True
+        src = src.rstrip('/')
+        files = [path for path in self.block_files if path.startswith(src + '/')]
+        if not files:
+            return True
+        backup_list = self.comms.getBackupList()
+        base = os.path.basename(backup_list[-1]) if backup_list else ""
+        successful = True
+        for local in files:
+            path = os.path.relpath(local, os.path.dirname(src))
+            try:
+                sent = self.blocks.backup(local, path, base)
+            except FileNotFoundError:
+                continue
+            except (OSError, CrashPlanError) as exc:
+                self.log.error("Block backup of %s failed: %s" % (local, exc))
+                successful = False
+                continue
+            self.transferred += sent
+            if sent and self.changes is not None:
+                self.recordChange(RsyncEvent(RsyncChange.CHANGED, path, sent, '>f'))
+        return successful
+
+    def getSize(self, dry_run=True):
+        """return the space in kB the backup of all the sources will need.
+        without dry_run only the sources the file journal can estimate
+        locally are sized, a method that projects its size as it runs sizes
+        the others itself
         """
-        sources = [os.environ['HOME']]
-
-        for extra in self.settings("extra-backup-sources-list"):
-
-            if extra != '' and os.path.exists(extra):
-                sources.append(extra)
+        sources = self.backupSources()
+        size = 0
+        self.beginRun()
         try:
-            successes = 0
-
             for src in sources:
-                self.processSrc(src)
+                if self.runs is not None and self.runs.finished(src, unitTime(src)):
+                    continue
+                size += self.processSrc(src, dry_run)
                 
         except KeyboardInterrupt:
             self.log.info("Backup of %s was interrupted by user intevention" % src)
+        return size
 
-    def processSrc(self, src):
-        """ """
-        destination = os.path.join(self.settings('backup-destination'),
-                                   self.local_hostname, "WORKING")
-
-        self.method.buildSizeCommand(src, destination)
-
-        self.log.info("Get Size of Back Up.")
-
-        result = self.method.run2()
-
-        self.log.info("Size of Backup of %s will be %d\n" % (src, self.method.size_required))
-
-        return result
+    def processSrc(self, src, dry_run=True):
+        """return the space in kB the backup of src will need, estimated
+        locally if there is a journal of the last backup, otherwise with a
+        dry run if dry_run, or 0 and no prediction
+        """
+        estimate = self.estimateSize(src)
+        if estimate is None and not dry_run:
+            return 0
+        if estimate is None:
+            destination = os.path.join(self.settings('backup-destination'),
+                                       self.local_hostname, "WORKING")
+
+            self.method.buildSizeCommand(src, destination)
+
+            self.log.info("Get Size of Back Up.")
+
+            self.method.run2()
+            size, files = self.method.size_required, self.method.files_required
+        else:
+            size, files = estimate
+
+        self.predicted[src] = size * 1024
+        self.predicted_files[src] = files
+        self.log.info("Size of Backup of %s will be %d (%d calibrated)\n"
+                      % (src, size, self.sizes.calibrate(size)))
+
+        return size
+
+    def estimateSize(self, src):
+        """the kB the files changed since the last backup add up to, and how
+        many there are, from a scan against the journal of that backup. None
+        if there isn't one.
+        the scan is staged to become the journal of this backup.
+        """
+        if self.journal is None:
+            self.journal = FileJournal(self.settings('settings-dir'), self.settings('journal-workers'),
+                                       self.settings('journal-full-days'))
+            self.journal_shared = self.method.addFileJournal(self.journal)
+        backup_list = self.comms.getBackupList()
+        latest = os.path.basename(backup_list[-1]) if backup_list else ""
+        excludes = [x for x in self.settings('exclude-files').split(',') +
+                    self.settings('exclude-folders').split(',') if x]
+
+        scan = self.journal.scan(src, latest, excludes, full_due=False)
+        self.log.info("Estimate %s - %s" % (src, scan.asDict()))
+        if not scan.usable:
+            return None
+        return scan.bytes / 1024, len(scan.candidates)
+
+    def recordSizes(self, finished):
+        """add how the predicted size of the backup compared with what it
+        really took to the size history
+        """
+        if self.predicted and finished['stored'] is not None:
+            decrease = None
+            if self.free_before is not None and finished['free'] is not None:
+                decrease = self.free_before - finished['free']
+            predicted = sum(self.predicted.values())
+            self.sizes.record(predicted, finished['stored'], self.transferred, decrease)
+            self.log.info("Backup predicted %d bytes, stored %d, transferred %d - calibration is now %.2f"
+                          % (predicted, finished['stored'], self.transferred, self.sizes.factor()))
+        self.predicted = {}
+        self.predicted_files = {}
+        self.transferred = 0
+        self.free_before = None
 
     def finishUp(self):
-        """write .metadata file"""
+        """write .metadata file and close the shared ssh connection"""
         if self.backup_successful:
+            datedir = TimeDate.datedir()
             meta2 = MetaData(self.log, self.comms, self.settings, "")
-            meta2.set("latest-complete", TimeDate.datedir())
+            meta2.set("latest-complete", datedir)
             meta2.set("backup-today", TimeDate.today())
 
             try:
-                meta2.writeMetaData()
-
-                # move WORKING to Latest Complete Date
-                src = os.path.join(self.settings('backup-destination'),
-                                   self.settings('local-hostname'), "WORKING")
-                dest = os.path.join(self.settings('backup-destination'),
-                                    self.settings('local-hostname'), TimeDate.datedir())
-                self.comms.remoteCommand(f"mv {src} {dest}")
+                meta2.writeMetaData(copy=False)
+
+                # move WORKING to Latest Complete Date and write the remote
+                # metadata as one request
+                finished = self.comms.finalize(datedir, meta2.meta, self.changes)
+                self.recordSizes(finished)
+                self.method.backupFinished(datedir)
+                if self.runs is not None:
+                    self.runs.clear()
+                if self.journal is not None and not self.journal_shared:
+                    self.journal.commit(datedir)
+                self.changes = None
+                self.changes_decided = False
+
+                if self.settings('dedupe-after-backup'):
+                    self.comms.startDedupe()
             except CrashPlanError as exc:
                 print(exc)
                 self.log.error(exc)
+
+        self.comms.closeMaster()
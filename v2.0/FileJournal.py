@@ -0,0 +1,396 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+FileJournal
+
+A record, kept on the client, of the state of every file and folder of each
+backup source as of the last successful backup, so the next backup can find
+what changed without rsync walking the whole of $HOME and the whole of the
+previous snapshot on the server.
+
+The journal is an SQLite file in the settings folder.  For every entry it
+keeps the inode, size, mtime and ctime, and for each source the snapshot it
+describes, when it was scanned and when a full pass was last made.
+
+A scan walks the source with a pool of threads doing the system calls
+- a folder whose inode, mtime and ctime are unchanged has had nothing added,
+  removed or renamed in it, so its names are taken from the journal instead
+  of being read again; only its entries are stat'ed
+- any other folder is read with scandir, names the journal has and the folder
+  no longer does are deletions
+- an entry whose inode, size, mtime or ctime differ from the journal, or is
+  new, is a candidate for the backup
+- entries changed within RACY_SECONDS of the previous scan starting may have
+  changed again after they were stat'ed without their times showing it, they
+  are always candidates
+
+The sizes of the files found changed are what the backup will store, which
+makes a scan a quick local estimate of the space a backup needs.
+
+What a scan sees is staged and only becomes the journal once the backup it
+was made for has completed, see commit().  The result of the last scan of
+each source is kept, so the backup can take up the scan its estimate made
+rather than walk the source again, see staged().
+
+Files that have moved are found by inode, see moves(), and their contents
+hashed to confirm it with the digests cached by inode, size and mtime.
+
+The journal is not trusted, and a full rsync pass is made instead, if
+- there is no journal for the source, or it describes a different snapshot
+  to the latest one on the server
+- the last full pass is more than journal-full-days old
+- the exclusions have changed
+- the source is on a different filesystem, or the clock has gone backwards
+"""
+
+import os
+import stat
+import time
+import json
+import fnmatch
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from SnapshotDedupe import hashFile
+
+JOURNAL_FILE = "file-journal.db"
+JOURNAL_WORKERS = 8
+RACY_SECONDS = 2
+# smaller files are sent again rather than looked for
+MOVE_MIN_SIZE = 64 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    dir INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    ctime INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+CREATE INDEX IF NOT EXISTS entries_source ON entries (source);
+CREATE INDEX IF NOT EXISTS entries_ino ON entries (ino);
+CREATE TABLE IF NOT EXISTS staged (
+    path TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    dir INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    ctime INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS staged_source ON staged (source);
+CREATE TABLE IF NOT EXISTS sources (
+    source TEXT NOT NULL,
+    staged INTEGER NOT NULL,
+    snapshot TEXT,
+    dev INTEGER NOT NULL,
+    excludes TEXT NOT NULL,
+    scanned REAL NOT NULL,
+    full REAL NOT NULL,
+    PRIMARY KEY (source, staged)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS digests (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime)
+) WITHOUT ROWID;
+"""
+
+
+class ScanResult():
+    """what a scan of one source found"""
+
+    def __init__(self, usable, reason=""):
+        """"""
+        self.usable = usable
+        self.reason = reason
+        # paths relative to the source's parent, as rsync --files-from wants them
+        self.candidates = []
+        self.deletions = []
+        # the size of the files among the candidates, what the backup stores
+        self.bytes = 0
+        self.entries = 0
+        self.listed = 0
+        self.reused = 0
+        self.seconds = 0.0
+
+    def asDict(self):
+        """json friendly summary"""
+        return {'usable': self.usable, 'reason': self.reason, 'candidates': len(self.candidates),
+                'deletions': len(self.deletions), 'bytes': self.bytes, 'entries': self.entries, 'listed': self.listed,
+                'reused': self.reused, 'seconds': round(self.seconds, 3)}
+
+
+def readDir(path, names, excludes):
+    """[(name, lstat or None)] of the entries of a folder. names are the
+    entries the journal has for it, None to read the folder
+    """
+    found = []
+    if names is None:
+        with os.scandir(path) as it:
+            for entry in it:
+                if any(fnmatch.fnmatch(entry.name, pattern) for pattern in excludes):
+                    continue
+                try:
+                    found.append((entry.name, entry.stat(follow_symlinks=False)))
+                except OSError:
+                    continue
+        return found
+
+    for name in names:
+        try:
+            found.append((name, os.lstat(os.path.join(path, name))))
+        except FileNotFoundError:
+            found.append((name, None))
+    return found
+
+
+class FileJournal():
+    """the state of the backup sources at the last successful backup"""
+
+    def __init__(self, settings_dir, workers=JOURNAL_WORKERS, full_days=7):
+        """"""
+        self.workers = workers
+        self.full_days = full_days
+        self.db = sqlite3.connect(os.path.join(settings_dir, JOURNAL_FILE))
+        self.db.executescript(SCHEMA)
+        # {source: (latest, excludes key, ScanResult)} of the last scans
+        self.scans = {}
+
+    def close(self):
+        """"""
+        self.db.close()
+
+    @staticmethod
+    def excludesKey(excludes):
+        """a digest of the exclusions, a change invalidates the journal"""
+        return hashlib.sha1(json.dumps(sorted(excludes)).encode()).hexdigest()
+
+    def _source(self, source, staged=0):
+        """the journal's record of a source, None if there isn't one"""
+        row = self.db.execute("SELECT snapshot, dev, excludes, scanned, full FROM sources "
+                              "WHERE source = ? AND staged = ?", (source, staged)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('snapshot', 'dev', 'excludes', 'scanned', 'full'), row))
+
+    def suspect(self, source, latest, excludes, now=None, full_due=True):
+        """why the journal cannot be trusted for a source, "" if it can.
+        full_due False ignores a full pass being due, as estimating does
+        """
+        now = now or time.time()
+        record = self._source(source)
+        if record is None:
+            return "no journal"
+        if not latest or record['snapshot'] != latest:
+            return "journal is of %s not %s" % (record['snapshot'], latest)
+        if now < record['scanned']:
+            return "the clock has gone backwards"
+        if full_due and now - record['full'] > self.full_days * 86400:
+            return "a full pass is due"
+        if record['excludes'] != self.excludesKey(excludes):
+            return "the exclusions have changed"
+        if os.lstat(source).st_dev != record['dev']:
+            return "the source is on a different filesystem"
+        return ""
+
+    def staged(self, source, latest, excludes):
+        """the ScanResult of the last scan of a source against latest with
+        the same exclusions, once. None if there isn't one
+        """
+        scan = self.scans.pop(source.rstrip('/'), None)
+        if scan is None or scan[:2] != (latest, self.excludesKey(excludes)):
+            return None
+        return scan[2]
+
+    def _children(self, path):
+        """{name: (dir, ino, size, mtime, ctime)} of a folder in the journal"""
+        return {os.path.basename(row[0]): row[1:] for row in self.db.execute(
+            "SELECT path, dir, ino, size, mtime, ctime FROM entries WHERE parent = ?", (path,))}
+
+    @staticmethod
+    def _state(st):
+        """what the journal keeps of an lstat"""
+        return (int(stat.S_ISDIR(st.st_mode)), st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    def scan(self, source, latest, excludes, full=False, full_due=True):
+        """walk a source, staging its state, and return a ScanResult. with
+        full, or when the journal is suspect, every folder is read and the
+        result is not usable for the backup but still stages a new journal
+        """
+        started = time.time()
+        source = source.rstrip('/')
+        reason = "a full pass was asked for" if full else \
+            self.suspect(source, latest, excludes, started, full_due)
+        result = ScanResult(not reason, reason)
+        record = self._source(source) if result.usable else None
+        # anything changed since just before the previous scan is not trusted
+        racy = int(((record['scanned'] if record else started) - RACY_SECONDS) * 1e9)
+        parent = os.path.dirname(source)
+
+        with self.db:
+            self.db.execute("DELETE FROM staged WHERE source = ?", (source,))
+        rows = []
+
+        def relative(path):
+            return os.path.relpath(path, parent)
+
+        def changed(old, new):
+            return old is None or old != new or new[3] >= racy or new[4] >= racy
+
+        root = os.lstat(source)
+        rows.append((source, source, parent) + self._state(root))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {}
+
+            def submit(path, old, st):
+                """read a folder, from the journal if it has not changed"""
+                known = self._children(path) if result.usable else {}
+                names = None
+                if result.usable and not changed(old, self._state(st)):
+                    names = list(known)
+                    result.reused += 1
+                else:
+                    result.listed += 1
+                pending[pool.submit(readDir, path, names, excludes)] = (path, known, names is None)
+
+            old = self.db.execute("SELECT dir, ino, size, mtime, ctime FROM entries WHERE path = ?",
+                                  (source,)).fetchone() if result.usable else None
+            if changed(old, self._state(root)):
+                result.candidates.append(relative(source))
+            submit(source, old, root)
+
+            while pending:
+                done, _running = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, known, listed = pending.pop(future)
+                    try:
+                        found = future.result()
+                    except OSError:
+                        # unreadable now, rsync reports it properly
+                        result.candidates.append(relative(path))
+                        continue
+
+                    seen = set()
+                    for name, st in found:
+                        full_path = os.path.join(path, name)
+                        if st is None:
+                            result.deletions.append(relative(full_path))
+                            continue
+                        seen.add(name)
+                        state = self._state(st)
+                        rows.append((full_path, source, path) + state)
+                        if changed(known.get(name), state):
+                            result.candidates.append(relative(full_path))
+                            if stat.S_ISREG(st.st_mode):
+                                result.bytes += st.st_size
+                        if stat.S_ISDIR(st.st_mode):
+                            submit(full_path, known.get(name), st)
+
+                    if listed:
+                        result.deletions += [relative(os.path.join(path, name))
+                                             for name in known if name not in seen]
+                    if len(rows) >= 10000:
+                        self._stage(rows)
+                        rows = []
+
+        self._stage(rows)
+        result.entries = self.db.execute("SELECT count(*) FROM staged WHERE source = ?",
+                                         (source,)).fetchone()[0]
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO sources (source, staged, snapshot, dev, excludes, scanned, full) "
+                            "VALUES (?, 1, NULL, ?, ?, ?, ?)",
+                            (source, root.st_dev, self.excludesKey(excludes), started,
+                             record['full'] if record else started))
+        result.candidates.sort()
+        result.deletions.sort()
+        result.seconds = time.time() - started
+        self.scans[source] = (latest, self.excludesKey(excludes), result)
+        return result
+
+    def _stage(self, rows):
+        """add scanned entries to the staged journal"""
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO staged (path, source, parent, dir, ino, size, mtime, ctime) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def moves(self, source, candidates, min_size=MOVE_MIN_SIZE):
+        """the candidates that are files the journal has at another path,
+        the same inode with the same size and mtime, as [(old, new, lstat)]
+        with the paths relative to the source's parent
+        """
+        source = source.rstrip('/')
+        parent = os.path.dirname(source)
+        found = []
+        for new in candidates:
+            path = os.path.join(parent, new)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or st.st_size < min_size:
+                continue
+            olds = [row[0] for row in self.db.execute(
+                "SELECT path FROM entries WHERE ino = ? AND size = ? AND mtime = ? AND dir = 0 AND source = ?",
+                (st.st_ino, st.st_size, st.st_mtime_ns, source))]
+            # at the same path it has only had its attributes changed
+            if olds and path not in olds:
+                found.append((os.path.relpath(olds[0], parent), new, st))
+        return found
+
+    def digests(self, files):
+        """{path: sha256 hex digest} of [(path, lstat)], cached by inode,
+        size and mtime. the files not cached are hashed by the pool, None if
+        they cannot be read
+        """
+        found = {}
+        todo = []
+        for path, st in files:
+            row = self.db.execute("SELECT digest FROM digests WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?",
+                                  (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+            if row:
+                found[path] = row[0]
+            else:
+                todo.append((path, st))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            hashed = list(pool.map(hashFile, [path for path, _st in todo]))
+        with self.db:
+            for (path, st), (_path, digest) in zip(todo, hashed):
+                found[path] = digest
+                if digest is not None:
+                    self.db.execute("INSERT OR REPLACE INTO digests (dev, ino, size, mtime, digest) "
+                                    "VALUES (?, ?, ?, ?, ?)",
+                                    (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest))
+        return found
+
+    def commit(self, snapshot):
+        """the backup the staged scans were made for has completed as
+        snapshot, they become the journal
+        """
+        with self.db:
+            sources = [row[0] for row in self.db.execute("SELECT source FROM sources WHERE staged = 1")]
+            for source in sources:
+                self.db.execute("DELETE FROM entries WHERE source = ?", (source,))
+                self.db.execute("INSERT INTO entries SELECT * FROM staged WHERE source = ?", (source,))
+                self.db.execute("DELETE FROM staged WHERE source = ?", (source,))
+                self.db.execute("DELETE FROM sources WHERE source = ? AND staged = 0", (source,))
+                self.db.execute("UPDATE sources SET staged = 0, snapshot = ? WHERE source = ? AND staged = 1",
+                                (snapshot, source))
+            # only the inodes still in the journal can be looked for again
+            self.db.execute("DELETE FROM digests WHERE ino NOT IN (SELECT ino FROM entries)")
+        self.scans = {}
+        return sources
+
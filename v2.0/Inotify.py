@@ -0,0 +1,288 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+Inotify
+
+The Linux inotify calls through ctypes, so continuous mode needs nothing
+outside the standard library, and a SourceWatcher that keeps a watch on
+every folder of the backup sources and collects the paths that change.
+
+Watches
+- inotify only watches single folders, every folder of a source needs its
+  own.  The registry keeps (parent watch, name, inode) per watch rather than
+  full paths, a path is put back together from its parents when an event
+  arrives, which keeps hundreds of thousands of folders to a few tens of MB
+- excluded folders are not watched
+- the number of watches is capped below the system's max_user_watches.
+  running out, like the kernel's event queue overflowing, sets overflowed and
+  the caller falls back to scanning for changes
+- a folder created or moved into a source is walked, watched and all of it
+  marked dirty.  A folder moved within a source keeps its watch, adding a
+  watch to it again returns the same one and updates where it is.  One moved
+  out of the sources has its watch removed
+
+Dirty paths are kept in a set, however many events a path gets it is sent
+once.  The parent of an entry that is created, deleted or moved is dirty too,
+its times change.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import fnmatch
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+# events that change the folder they happen in as well as the entry
+NAME_CHANGES = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+MAX_WATCHES_FILE = "/proc/sys/fs/inotify/max_user_watches"
+# leave some of the system's watches to other programs
+WATCH_SHARE = 0.9
+
+
+class Inotify():
+    """an inotify instance"""
+
+    def __init__(self):
+        """"""
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available on this system")
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def close(self):
+        """"""
+        os.close(self.fd)
+
+    def addWatch(self, path, mask=WATCH_MASK):
+        """watch a folder, return the watch descriptor"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def removeWatch(self, wd):
+        """stop watching, the watch may already have gone"""
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """[(wd, mask, cookie, name)] of the events waiting, after waiting up
+        to timeout seconds for the first
+        """
+        events = []
+        ready, _w, _x = select.select([self.fd], [], [], timeout)
+        while ready:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+                pos += EVENT.size
+                name = os.fsdecode(data[pos:pos+length].rstrip(b'\0'))
+                pos += length
+                events.append((wd, mask, cookie, name))
+        return events
+
+
+def maxWatches():
+    """the share of the system's inotify watches we can use"""
+    try:
+        with open(MAX_WATCHES_FILE, 'r') as fp:
+            return int(int(fp.read()) * WATCH_SHARE)
+    except (OSError, ValueError):
+        return 8192
+
+
+class SourceWatcher():
+    """watch the backup sources and collect the paths that change"""
+
+    def __init__(self, sources, excludes, log, max_watches=0):
+        """"""
+        self.sources = [source.rstrip('/') for source in sources]
+        self.excludes = excludes
+        self.log = log
+        self.max_watches = max_watches or maxWatches()
+        self.inotify = Inotify()
+        # wd: (parent wd, name, inode), the sources have parent 0 and their
+        # full path as name
+        self.watches = {}
+        self.dirty = set()
+        self.overflowed = False
+        # some folders could not be watched, every batch has to scan
+        self.limited = False
+        self.first_event = None
+        self.last_event = None
+
+    def close(self):
+        """"""
+        self.inotify.close()
+
+    def start(self):
+        """watch every folder of every source"""
+        for source in self.sources:
+            self._watchTree(0, source, dirty=False)
+        self.log.info("SourceWatcher - watching %d folders" % len(self.watches))
+
+    def _excluded(self, name):
+        """is name matched by the exclude-files or exclude-folders settings"""
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.excludes)
+
+    def path(self, wd):
+        """the full path of a watched folder, None if it is no longer known"""
+        names = []
+        while wd:
+            watch = self.watches.get(wd)
+            if watch is None:
+                return None
+            wd, name, _ino = watch
+            names.append(name)
+        return os.path.join(*reversed(names)) if names else None
+
+    def _addWatch(self, parent, name, path):
+        """watch one folder, None if it cannot be"""
+        if len(self.watches) >= self.max_watches:
+            self.limited = True
+            self._overflow("the watch limit of %d has been reached" % self.max_watches)
+            return None
+        try:
+            wd = self.inotify.addWatch(path)
+            ino = os.lstat(path).st_ino
+        except OSError as exc:
+            if exc.errno == errno.ENOSPC:
+                self.limited = True
+                self._overflow("the system has run out of inotify watches")
+            return None
+        self.watches[wd] = (parent, name, ino)
+        return wd
+
+    def _watchTree(self, parent, name, dirty=True):
+        """watch a folder and everything below it, marking it all dirty"""
+        path = self.path(parent) if parent else ''
+        todo = [(parent, os.path.join(path, name) if path else name, name)]
+        while todo:
+            parent, path, name = todo.pop()
+            if dirty:
+                self.dirty.add(path)
+            wd = self._addWatch(parent, name, path)
+            if wd is None:
+                continue
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if self._excluded(entry.name):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            todo.append((wd, entry.path, entry.name))
+                        elif dirty:
+                            self.dirty.add(entry.path)
+            except OSError:
+                continue
+
+    def _overflow(self, reason):
+        """changes may have been missed"""
+        if not self.overflowed:
+            self.log.info("SourceWatcher - %s, changes will be found by scanning" % reason)
+        self.overflowed = True
+
+    def poll(self, timeout):
+        """wait up to timeout seconds for events and collect the dirty paths,
+        return the number of events
+        """
+        events = self.inotify.read(timeout)
+        if events:
+            now = time.time()
+            self.first_event = self.first_event or now
+            self.last_event = now
+
+        new_folders = []
+        moved = []
+        for wd, mask, _cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self._overflow("the event queue overflowed")
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if mask & (IN_MOVE_SELF | IN_DELETE_SELF):
+                moved.append(wd)
+                continue
+
+            folder = self.path(wd)
+            if folder is None:
+                # a folder below one that has moved away
+                self.inotify.removeWatch(wd)
+                self.watches.pop(wd, None)
+                continue
+            if not name or self._excluded(name):
+                continue
+
+            self.dirty.add(os.path.join(folder, name))
+            if mask & NAME_CHANGES:
+                self.dirty.add(folder)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                new_folders.append((wd, name))
+
+        for parent, name in new_folders:
+            self._watchTree(parent, name)
+
+        # anything that moved and was not found again by the walks above has
+        # left the sources
+        for wd in moved:
+            path = self.path(wd)
+            try:
+                gone = path is None or os.lstat(path).st_ino != self.watches[wd][2]
+            except (OSError, KeyError):
+                gone = True
+            if gone:
+                self.inotify.removeWatch(wd)
+                self.watches.pop(wd, None)
+        return len(events)
+
+    def take(self):
+        """the dirty paths collected so far, which are then forgotten"""
+        dirty, self.dirty = self.dirty, set()
+        self.first_event = None
+        return dirty
+
+    def putBack(self, dirty):
+        """paths that could not be sent, to try again with the next batch"""
+        self.dirty |= dirty
+        self.first_event = self.first_event or time.time()
+
+    def rescanned(self):
+        """a full scan has caught up with everything, including whatever
+        was missed when the watches overflowed
+        """
+        self.overflowed = self.limited
+        self.take()
+
@@ -57,6 +57,27 @@ manifest = ['CrashPlan.py',
             'MountCommand.py',
             'RemoteComms.py',
             'RsyncMethod.py',
+            'RsyncOutput.py',
+            'ParallelRsyncMethod.py',
+            'FileJournal.py',
+            'JournalRsyncMethod.py',
+            'Inotify.py',
+            'ContinuousBackup.py',
+            'SizeHistory.py',
+            'SpaceWatchdog.py',
+            'LinkDestHistory.py',
+            'RunJournal.py',
+            'RangeTransfer.py',
+            'BlockTracker.py',
+            'myocp_agent.py',
+            'SnapshotClone.py',
+            'SnapshotDelete.py',
+            'SnapshotUsage.py',
+            'SnapshotCatalog.py',
+            'SnapshotDedupe.py',
+            'Chunker.py',
+            'ChunkMethod.py',
+            'ChunkStore.py',
             'Settings.py',
             'Utils.py',
             'myowncrashplan.py']
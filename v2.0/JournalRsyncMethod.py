@@ -0,0 +1,225 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+JournalRsyncMethod
+
+rsync run over the whole of a source walks every file on the client and
+every file of the previous snapshot on the server to find the few thousand
+that changed.  This method finds them locally with a FileJournal scan and
+gives rsync just those.
+
+- WORKING is started as a hard link clone of the latest backup, made on the
+  server (SnapshotClone), so everything rsync is not told about is already in
+  place.  As with the v0.5 script's clone, a file whose permissions alone
+  change has them changed in the older backups that share its inode too
+- the candidates and the deletions go to rsync with --files-from; deletions
+  are paths that no longer exist on the client, --delete-missing-args with
+  --force removes them, folders and all, from WORKING
+- files that have moved, the same inode at a new path, are hard linked into
+  their new place in WORKING from the latest backup by the server before
+  rsync runs, once their contents are confirmed by hash, so a renamed
+  folder costs links rather than sending it all again
+- when the journal cannot be trusted, or WORKING was left by an interrupted
+  run, the source gets a normal full rsync pass; the scan still stages a
+  fresh journal for the next run
+
+The journal is the one CrashPlan estimated the backup's size from, see
+addFileJournal(), and the scan that estimate made is taken up rather than
+the source walked again, unless a full pass is due.  The staged scans become
+the journal when CrashPlan reports the backup has completed, through
+backupFinished().  Selected with the backup-method setting "journal".
+"""
+
+import os
+import shlex
+
+from CrashPlan import CrashPlanErrorCodes
+from CrashPlanError import CrashPlanError
+from RsyncMethod import RsyncMethod, RSYNC
+from RsyncOutput import RSYNC_OUTPUT_OPTIONS
+from FileJournal import FileJournal, ScanResult
+
+FILES_FROM_FILE = "myocp_files_from"
+RSYNC_JOURNAL_OPTIONS = "--timeout=300 --from0 --delete-missing-args --force "
+
+
+class JournalRsyncMethod(RsyncMethod):
+    """rsync only what a FileJournal scan found changed"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, settings, meta, log, comms, dry_run=False, getsize=False):
+        """constructor"""
+        super().__init__(settings, meta, log, comms, dry_run, getsize)
+        self.excludes = [x for x in self.settings('exclude-files').split(',') +
+                         self.settings('exclude-folders').split(',') if x]
+        self.files_from = os.path.join(self.settings('settings-dir'), FILES_FROM_FILE)
+        # made when first needed, unless CrashPlan shares its own
+        self.journal = None
+        self.cloned = None
+        self.scan = None
+        self.src = None
+
+    def addFileJournal(self, journal):
+        """scan with CrashPlan's journal, taking up the scans its estimate made"""
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = journal
+        return True
+
+    def _fileJournal(self):
+        """the journal, opened when first needed"""
+        if self.journal is None:
+            self.journal = FileJournal(self.settings('settings-dir'), self.settings('journal-workers'),
+                                       self.settings('journal-full-days'))
+        return self.journal
+
+    def _latest(self):
+        """the name of the latest complete backup on the server, "" if none"""
+        backup_list = self.comms.getBackupList()
+        return os.path.basename(backup_list[-1]) if backup_list else ""
+
+    def _cloneWorking(self):
+        """start WORKING as a clone of the latest backup, once per run.
+        returns True if WORKING holds the latest backup and nothing else
+        """
+        if self.cloned is None:
+            self.cloned = False
+            latest = self._latest()
+            if latest and not self.comms.resumed:
+                self.cloned = self.comms.cloneBackup(latest)
+        return self.cloned
+
+    def buildCommand(self, src, dest):
+        """scan the source and build either the --files-from command or a
+        full one
+        """
+        self.src = src
+        # a dry run leaves WORKING alone, rsync sizes the candidates on their own
+        full = not self.dry_run and not self._cloneWorking()
+        if self._scan(src, full):
+            self.cmd = self._journalCmd(self.dry_run)
+            self.cmd += self._journalArgs(src, dest)
+        else:
+            super().buildCommand(src, dest)
+
+    def buildSizeCommand(self, src, dest):
+        """as buildCommand, always a dry run"""
+        self.src = src
+        if self._scan(src, False):
+            self.cmd = self._journalCmd(True)
+            self.cmd += self._journalArgs(src, dest)
+        else:
+            super().buildSizeCommand(src, dest)
+
+    def _scan(self, src, full):
+        """scan a source, or take up the scan the estimate made of it, and
+        return True if the journal can be used
+        """
+        journal = self._fileJournal()
+        latest = self._latest()
+        scan = journal.staged(src, latest, self.excludes)
+        # the estimate does not make the full pass when one is due
+        if scan is None or scan.usable and journal.suspect(src, latest, self.excludes):
+            self.scan = journal.scan(src, latest, self.excludes, full)
+        elif full and scan.usable:
+            # what it staged is as good, rsync just cannot be given the list
+            self.scan = ScanResult(False, "a full pass was asked for")
+            self.scan.entries = scan.entries
+        else:
+            self.scan = scan
+        self.log.info("FileJournal %s - %s" % (src, self.scan.asDict()))
+        return self.scan.usable
+
+    def _journalArgs(self, src, dest):
+        """the paths in the files-from list are relative to the source's parent"""
+        return " %s \"%s:%s\" " % (shlex.quote(os.path.dirname(src.rstrip('/'))),
+                                   self.settings('server-address'), dest)
+
+    def _journalCmd(self, dry_run):
+        """construct the rsync --files-from command from settings"""
+        cmd = RSYNC + " -av"
+        if dry_run:
+            cmd += " --dry-run"
+        else:
+            cmd += " --log-file=%s" % self.rsync_log_file
+            cmd += self._partialDir()
+
+        cmd += " -e '%s'" % self.comms.sshCommand()
+        cmd += " --bwlimit=%d %s" % (self.bwlimit, RSYNC_JOURNAL_OPTIONS)
+        cmd += RSYNC_OUTPUT_OPTIONS
+        cmd += self._blockFilters()
+        cmd += " --exclude-from=" + self.exclude_file
+        cmd += " --files-from=" + self.files_from
+        return cmd
+
+    def _writeFilesFrom(self):
+        """write the candidates and deletions for --files-from --from0"""
+        with open(self.files_from, 'wb') as fp:
+            for path in self.scan.candidates + self.scan.deletions:
+                fp.write(os.fsencode(path) + b'\0')
+
+    def projection(self):
+        """the scan knows the size of the changes before rsync starts"""
+        parser = self.parser
+        if parser is None or self.scan is None or not self.scan.usable:
+            return super().projection()
+        return parser.storedBytes(), self.scan.bytes
+
+    def run(self):
+        """run the backup command, once the files that moved are in place"""
+        if not self.dry_run and self.scan is not None and self.scan.usable:
+            self._linkMoves()
+        return self._runJournal(super().run)
+
+    def _linkMoves(self):
+        """have the server link the files that moved since the latest backup
+        into their new places in WORKING
+        """
+        moves = self.journal.moves(self.src, self.scan.candidates)
+        if not moves:
+            return
+        parent = os.path.dirname(self.src.rstrip('/'))
+        digests = self.journal.digests([(os.path.join(parent, new), st) for _old, new, st in moves])
+        request = [[old, new, st.st_size, int(st.st_mtime), digests[os.path.join(parent, new)]]
+                   for old, new, st in moves if digests[os.path.join(parent, new)]]
+        try:
+            self.comms.linkMoves(self._latest(), request)
+        except CrashPlanError as exc:
+            # rsync sends them instead
+            self.log.error(exc)
+
+    def run2(self):
+        """run the dry run command to find the space required"""
+        self._runJournal(super().run2)
+
+    def _runJournal(self, runner):
+        """run the command with the list of changes in place, or not at all
+        if nothing has changed
+        """
+        if self.scan is None or not self.scan.usable:
+            return runner()
+
+        if not self.scan.candidates and not self.scan.deletions:
+            self.log.info("FileJournal - nothing has changed")
+            self.size_required = 0
+            self.files_required = 0
+            self.stats = None
+            return CrashPlanErrorCodes.SUCCESS
+
+        self._writeFilesFrom()
+        try:
+            return runner()
+        finally:
+            os.unlink(self.files_from)
+
+    def backupFinished(self, datedir):
+        """the backup completed as datedir, the scans become the journal"""
+        # the next backup starts a new WORKING
+        self.cloned = None
+        if self.journal is None:
+            return
+        sources = self.journal.commit(datedir)
+        self.log.info("FileJournal - journal of %s is now %s" % (", ".join(sources), datedir))
+
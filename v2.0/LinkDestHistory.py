@@ -0,0 +1,111 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+LinkDestHistory
+
+Which earlier backups rsync is given as --link-dest references, and what
+each has saved, kept in the settings folder.
+
+rsync links a file from the first reference that has it unchanged, so one
+reference, the latest backup, misses files that have gone back to an older
+version or come back after being deleted.  rsync takes up to 20.
+- the latest backup is always the first reference, most files are found
+  there with a single stat
+- the others are spaced out by age, the newest backup at least each of
+  LINK_DEST_AGES days older than the latest, up to link-dest-max in all
+- after each run the server finds which reference each file was linked
+  from (op link-hits).  A file only comes from an older reference when the
+  latest did not have it, so only the files of folders whose mtime differs
+  from the latest backup's are looked at.  The files and bytes linked from
+  each older reference are what it saved, and the stats made are what
+  finding out cost.  The latest's own count only covers those folders
+- an age that has saved nothing in the last LINK_DEST_DROP_RUNS runs it was
+  used in is left out, and tried again every LINK_DEST_RETRY runs
+
+The runs are kept per age rather than per backup, the backup at a given age
+changes from day to day.
+"""
+
+import os
+import json
+import time
+
+LINK_DEST_FILE = "link-dest-history.json"
+LINK_DEST_AGES = [1, 7, 30, 90, 365]
+LINK_DEST_LIMIT = 20
+LINK_DEST_DROP_RUNS = 5
+LINK_DEST_RETRY = 10
+HISTORY_RUNS = 100
+
+
+def backupTime(name):
+    """seconds since the epoch of a backup named by TimeDate.datedir()"""
+    try:
+        return time.mktime(time.strptime(name, "%Y-%m-%d-%H%M%S"))
+    except ValueError:
+        return None
+
+
+class LinkDestHistory():
+    """choose the --link-dest references and record what they save"""
+
+    def __init__(self, settings_dir):
+        """"""
+        self.filename = os.path.join(settings_dir, LINK_DEST_FILE)
+        self.runs = []
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r') as fp:
+                    self.runs = json.load(fp)
+            except ValueError:
+                self.runs = []
+        # the age of each reference chosen last, {backup: days}
+        self.ages = {}
+
+    def useful(self, days):
+        """has the age saved anything in the runs it was used in lately"""
+        used = [run['ages'][str(days)] for run in self.runs if str(days) in run.get('ages', {})]
+        recent = used[-LINK_DEST_DROP_RUNS:]
+        return len(recent) < LINK_DEST_DROP_RUNS or any(hits[1] for hits in recent)
+
+    def choose(self, backups, maximum):
+        """the references for a backup, latest first, from the backup names
+        oldest first
+        """
+        if not backups:
+            return []
+        refs = [backups[-1]]
+        self.ages = {}
+        latest = backupTime(backups[-1])
+        if latest is None:
+            return refs
+
+        retry = len(self.runs) % LINK_DEST_RETRY == LINK_DEST_RETRY - 1
+        for days in LINK_DEST_AGES:
+            if len(refs) >= min(maximum, LINK_DEST_LIMIT):
+                break
+            if not retry and not self.useful(days):
+                continue
+            older = [name for name in backups[:-1]
+                     if backupTime(name) is not None and latest - backupTime(name) >= days * 86400]
+            if older and older[-1] not in refs:
+                refs.append(older[-1])
+                self.ages[older[-1]] = days
+        return refs
+
+    def record(self, refs, hits):
+        """add a run's link-hits reply for the references it used"""
+        run = {'date': time.strftime("%Y-%m-%d-%H%M%S"), 'refs': refs,
+               'latest': hits['hits'][0], 'new': hits['new'],
+               'ages': {str(self.ages[ref]): found for ref, found in zip(refs[1:], hits['hits'][1:])
+                        if ref in self.ages},
+               'stats': hits['stats'], 'seconds': hits['seconds']}
+        self.runs.append(run)
+        self.runs = self.runs[-HISTORY_RUNS:]
+        with open(self.filename + ".tmp", 'w') as fp:
+            fp.write(json.dumps(self.runs, indent=1))
+        os.rename(self.filename + ".tmp", self.filename)
+        return run
+
@@ -79,22 +79,15 @@ class MetaData():
 
     def readRemoteMetaData(self):
         """read the remote metadata file"""
-        cmd = ["cat", "%s/.metadata" % os.path.join(self.settings('backup-destination'), 
-                                                    self.settings('local-hostname'))]
-        st, rt = self.comms.remoteCommand(cmd)
-
-        if st != 0:
-            if rt.find('No such file or') > -1:
-                return "{}"
-
-        return rt
+        return json.dumps(self.comms.readMetaData())
         
-    def writeMetaData(self):
+    def writeMetaData(self, copy=True):
         """write the metadata file locally and copy it to remote server"""
         metafile = os.path.join(os.environ['HOME'], self.settings("settings-dir"), '.metadata')
 
         with open(metafile, 'w') as fp:
             fp.write(repr(self))
 
-        self.comms.remoteCopy(metafile)
+        if copy:
+            self.comms.remoteCopy(metafile)
 
@@ -0,0 +1,337 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+ParallelRsyncMethod
+
+With millions of small files a single rsync is bound by per-file latency, not
+bandwidth.  This method splits a backup source into shards and runs several
+rsync workers at once into the same WORKING folder with the same --link-dest.
+
+Planning
+- the shards are the top level entries of the source. any entry whose size
+  (remembered from previous runs) is more than a worker's fair share is split
+  again into its own entries, down to SHARD_MAX_DEPTH.
+- every folder that has been split gets a non-recursive pass
+  (--no-recursive --dirs) which copies its plain files and deletes entries
+  that no longer exist, as the recursive shards below it cannot.
+- shards are queued largest first, unknown sizes first of all, and the
+  workers take the next shard as they become free.
+
+Each shard is sent with --relative so it lands at the same path it would have
+had in a single rsync.  The bandwidth limit in the settings is shared out
+between the workers as a fixed cap on each shard, an rsync's --bwlimit
+cannot be changed once it runs.  So the run as a whole stays under the
+limit, but as the last shards finish the workers still running do not
+take up the share of those that are done.
+
+Every shard and folder pass is a unit of the RunJournal, a retry after an
+interrupted run skips those that finished.
+
+The new files of range-split-mb or more that the sizing dry run comes
+across are outliers no shard can balance.  They are sent before anything
+else by RangeTransfer, as range-streams byte ranges at once, and rsync
+then finds them up to date in WORKING.  One that cannot be sent that way
+is left to rsync.
+"""
+
+import os
+import json
+import stat
+import shlex
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from CrashPlan import CrashPlanErrorCodes
+from RsyncMethod import RsyncMethod
+from CrashPlanError import CrashPlanError
+from RsyncOutput import RsyncParser, RsyncEvent, RsyncChange
+from RunJournal import unitTime
+from RangeTransfer import RangeTransfer
+
+SHARD_SIZES_FILE = "shard-sizes.json"
+SHARD_MAX_DEPTH = 2
+
+
+def combineResults(results):
+    """map the results of all the shards on to a single CrashPlanErrorCodes"""
+    if not results:
+        return CrashPlanErrorCodes.NOT_RUN
+    if CrashPlanErrorCodes.UNKNOWN_ERROR in results:
+        return CrashPlanErrorCodes.UNKNOWN_ERROR
+    if CrashPlanErrorCodes.DISK_FULL in results:
+        return CrashPlanErrorCodes.DISK_FULL
+    if CrashPlanErrorCodes.NOT_RUN in results:
+        return CrashPlanErrorCodes.NOT_RUN
+    return CrashPlanErrorCodes.SUCCESS
+
+
+class ParallelRsyncMethod(RsyncMethod):
+    """backup a source with several rsync workers"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, settings, meta, log, comms, dry_run=False, getsize=False):
+        """constructor"""
+        super().__init__(settings, meta, log, comms, dry_run, getsize)
+        self.workers = max(1, self.settings('rsync-workers'))
+        # the overall cap is shared between the workers, each shard is held
+        # to its share for the whole of its run. 0 means no limit
+        if self.bwlimit:
+            self.bwlimit = max(1, self.bwlimit // self.workers)
+
+        self.sizes_file = os.path.join(self.settings('settings-dir'), SHARD_SIZES_FILE)
+        self.excludes = [x for x in self.settings('exclude-files').split(',') +
+                         self.settings('exclude-folders').split(',') if x]
+        self.lock = threading.Lock()
+        self.src = None
+        self.dest = None
+        self.passes = []
+        self.shards = []
+        self.results = {}
+        # the RunJournal, the shards it has finished are skipped, and
+        # whether the current run records those it finishes, a dry run does not
+        self.runs = None
+        self.recording = False
+        self.skipped = []
+        # the giant new files the sizing run found, {src: {path: bytes}}
+        self.range_min = self.settings('range-split-mb') * 1024 * 1024
+        self.ranges = RangeTransfer(self.comms, self.log, self.settings('range-streams'), self.bwlimit)
+        self.giants = {}
+        self.sizing = False
+
+    def buildCommand(self, src, dest):
+        """plan the shards and the common rsync command"""
+        self.src = src.rstrip('/')
+        self.dest = dest
+        self.cmd = self._rsyncCmd()
+        self.passes, self.shards = self.planShards(self._loadSizes().get(self.src, {}))
+
+    def buildSizeCommand(self, src, dest):
+        """plan the shards and the common dry run command"""
+        self.buildCommand(src, dest)
+        self.cmd = self._rsyncSizeCmd()
+
+    def _loadSizes(self):
+        """sizes of shards seen by previous runs, {src: {shard: bytes}}"""
+        if os.path.exists(self.sizes_file):
+            with open(self.sizes_file, 'r') as fp:
+                return json.load(fp)
+        return {}
+
+    def _saveSizes(self, src_sizes):
+        """remember shard sizes for balancing the next run"""
+        sizes = self._loadSizes()
+        sizes[self.src] = src_sizes
+        with open(self.sizes_file, 'w') as fp:
+            fp.write(json.dumps(sizes, sort_keys=True, indent=1))
+
+    def _excluded(self, name):
+        """is name matched by the exclude-files or exclude-folders settings"""
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.excludes)
+
+    def _children(self, relpath):
+        """entries of a folder, relative to the source, that should be backed up"""
+        children = []
+        try:
+            with os.scandir(os.path.join(self.src, relpath)) as it:
+                for entry in it:
+                    if not self._excluded(entry.name):
+                        children.append((os.path.join(relpath, entry.name),
+                                         entry.is_dir(follow_symlinks=False)))
+        except OSError as exc:
+            self.log.error(f"(planShards): {exc}")
+        return children
+
+    def planShards(self, sizes):
+        """return the folders needing a non-recursive pass and the list of
+        shards, largest first. sizes maps shard paths to bytes from earlier runs.
+        """
+        known = sum(sizes.values())
+        share = known / self.workers if known else 0
+
+        passes = []
+        shards = []
+        pending = [('', 0)]
+
+        while pending:
+            relpath, depth = pending.pop()
+            passes.append(relpath)
+
+            for child, is_dir in self._children(relpath):
+                if not is_dir:
+                    # plain files go with their folder's non-recursive pass
+                    continue
+
+                split = [s for s in sizes if s.startswith(child + '/')]
+                size = sizes.get(child, sum(sizes[s] for s in split) if split else None)
+
+                if depth + 1 < SHARD_MAX_DEPTH and share and size is not None and size > share:
+                    pending.append((child, depth + 1))
+                else:
+                    shards.append((child, size))
+
+        # unknown sizes first, then largest first
+        shards.sort(key=lambda shard: (shard[1] is not None, -(shard[1] or 0)))
+        return passes, [shard for shard, _size in shards]
+
+    def _shardCommand(self, relpath, recursive=True):
+        """rsync command for one shard or folder pass, with --relative so the
+        shard keeps its place under the source's name in WORKING
+        """
+        parent, name = os.path.split(self.src)
+        source = os.path.join(parent, ".", name, relpath) if relpath else os.path.join(parent, ".", name)
+        cmd = self.cmd + " --relative"
+        if not self.dry_run:
+            cmd += super()._partialDir(relpath if recursive else "pass:" + relpath)
+        if not recursive:
+            # the trailing / has --dirs send the folder's files and the
+            # entries of its subfolders, not just the folder itself
+            cmd += " --no-recursive --dirs"
+            source = os.path.join(source, "")
+        cmd += " %s \"%s:%s\" " % (shlex.quote(source), self.settings('server-address'), self.dest)
+        return cmd
+
+    def _partialDir(self, shard=""):
+        """each shard has a folder of its own, see _shardCommand"""
+        return ""
+
+    def addRunJournal(self, journal):
+        """record each shard and folder pass in the journal"""
+        self.runs = journal
+        return True
+
+    def _runShard(self, relpath, recursive=True):
+        """run one rsync worker and interpret its result, unless the shard
+        finished in an interrupted run
+        """
+        key = relpath if recursive else "pass:" + relpath
+        mtime = unitTime(os.path.join(self.src, relpath))
+        if self.runs is not None and self.runs.finished(self.src, mtime, key):
+            with self.lock:
+                self.skipped.append((relpath, recursive))
+            return CrashPlanErrorCodes.SUCCESS
+
+        cmd = self._shardCommand(relpath, recursive)
+        parser = RsyncParser()
+        parser.addListener(self._notify)
+        if self.sizing and self.range_min:
+            parser.addListener(self._findGiant)
+        self.log.info(cmd)
+
+        st, rt = self._process(cmd, parser.feed)
+        stats = parser.finish()
+
+        with self.lock:
+            result = self._interpretResults(st, rt)
+            self.results[(relpath, recursive)] = (result, stats)
+        if self.recording:
+            self.runs.record(self.src, result.name, mtime,
+                             os.path.normpath(os.path.join(os.path.basename(self.src), relpath)), key)
+        return result
+
+    def _findGiant(self, event):
+        """note a new file too big for rsync to send on its own"""
+        if event.change == RsyncChange.NEW and event.itemize[1] == 'f' and event.size >= self.range_min:
+            with self.lock:
+                self.giants.setdefault(self.src, {})[event.path] = event.size
+
+    def _sendGiants(self):
+        """send the giant new files of the source as ranges in parallel,
+        biggest first
+        """
+        giants = self.giants.pop(self.src, {})
+        for path in sorted(giants, key=lambda path: -giants[path]):
+            local = os.path.join(os.path.dirname(self.src), path)
+            try:
+                st = os.lstat(local)
+                if not stat.S_ISREG(st.st_mode) or st.st_size < self.range_min:
+                    continue
+                self.ranges.send(local, path, st)
+            except (OSError, CrashPlanError) as exc:
+                self.log.error(f"(sendGiants): {exc}, {path} is left to rsync")
+                continue
+            self._notify(RsyncEvent(RsyncChange.NEW, path, st.st_size, '>f+++++++++'))
+
+    def _notify(self, event):
+        """pass events from the workers on to the listeners one at a time"""
+        with self.lock:
+            for listener in self.listeners:
+                listener(event)
+
+    def run(self):
+        """run the folder passes then the shards on a pool of workers"""
+        return self._runAll(self.runs is not None)
+
+    def _runAll(self, record):
+        """run the passes and shards, recording those that finish in the
+        RunJournal if record
+        """
+        self._create_exclude_file()
+        self.results = {}
+        self.recording = record
+        self.skipped = []
+        self.ranges.sent = 0
+        if self.sizing:
+            self.giants[self.src] = {}
+        results = []
+
+        # before the folder passes, which would send the giants in their
+        # folders themselves
+        if not (self.dry_run or self.sizing):
+            self._sendGiants()
+
+        # the folder passes create the folders the shards go in
+        for relpath in self.passes:
+            results.append(self._runShard(relpath, recursive=False))
+
+        if combineResults(results) == CrashPlanErrorCodes.SUCCESS and self.shards:
+            self.log.info(f"Backing up {self.src} as {len(self.shards)} shards with {self.workers} workers")
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                results += list(pool.map(self._runShard, self.shards))
+
+        self._remove_exclude_file()
+        self.recording = False
+        if self.skipped:
+            self.log.info(f"{len(self.skipped)} shards of {self.src} finished in the interrupted run")
+        result = combineResults(results)
+        if result == CrashPlanErrorCodes.SUCCESS:
+            self._measureLinks()
+        self.link_refs = []
+
+        sizes = {relpath: stats.total_size for (relpath, recursive), (res, stats) in self.results.items()
+                 if recursive and stats and res == CrashPlanErrorCodes.SUCCESS}
+        # the shards skipped keep the sizes they had
+        known = self._loadSizes().get(self.src, {})
+        sizes.update({relpath: known[relpath] for relpath, recursive in self.skipped
+                      if recursive and relpath in known})
+        self.size_required = sum(stats.transferred_size for _res, stats in self.results.values() if stats)/1024
+        self.files_required = sum(stats.transferred for _res, stats in self.results.values() if stats)
+        # a dry run sees the same total sizes as a real one
+        if result == CrashPlanErrorCodes.SUCCESS:
+            self._saveSizes(sizes)
+
+        return result
+
+    def projectsSize(self):
+        """each worker only sees its own shard, so the backup is sized by a
+        dry run first
+        """
+        return False
+
+    def transferredBytes(self):
+        """the bytes all the workers, and the ranges of giant files, sent to
+        the server
+        """
+        return sum(stats.bytes_sent for _res, stats in self.results.values() if stats) + self.ranges.sent
+
+    def run2(self):
+        """dry run every shard not already in WORKING to find the space
+        required, and the giant files to send in ranges
+        """
+        self.sizing = True
+        try:
+            self._runAll(False)
+        finally:
+            self.sizing = False
@@ -0,0 +1,132 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+RangeTransfer
+
+Sends a giant new file as several byte ranges at once rather than as one
+rsync stream, which is bound by one process reading, checksumming and
+feeding ssh.  Used by ParallelRsyncMethod for the outliers its sizing dry
+run finds, new files of range-split-mb or more.
+
+- the file is split into range-streams ranges, each sent by an agent of its
+  own (--put-range) over the shared ssh connection, straight into a file in
+  the server's .ranges folder
+- client and server each take the SHA-256 of every range as it goes past,
+  a range only counts once the two agree
+- the ranges already on the server from an interrupted attempt are read
+  again locally and not sent if they still match
+- the server checks the ranges make up the whole file, gives it the mode
+  and mtime of the original and links it into WORKING, where rsync finds it
+  up to date
+
+A file that changes while it is being sent is left to rsync.
+"""
+
+import os
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from CrashPlanError import CrashPlanError
+
+RANGE_BLOCK = 1024 * 1024
+
+
+def rangeName(path, st):
+    """the name the server knows the ranges of a file by, a new one when
+    the file changes
+    """
+    return hashlib.sha256(("%s\0%d\0%d" % (path, st.st_size, st.st_mtime_ns)).encode()).hexdigest()[:40]
+
+
+def splitRanges(size, streams):
+    """[(offset, length)] of up to streams ranges, each a whole number of
+    blocks but the last
+    """
+    blocks = -(-size // RANGE_BLOCK)
+    per_range = max(1, -(-blocks // max(1, streams))) * RANGE_BLOCK
+    return [(offset, min(per_range, size - offset)) for offset in range(0, size, per_range)]
+
+
+class RangeTransfer():
+    """send big files to the server as ranges in parallel"""
+
+    def __init__(self, comms, log, streams, bwlimit=0):
+        """bwlimit is each stream's limit in KB/s, 0 for none"""
+        self.comms = comms
+        self.log = log
+        self.streams = max(1, streams)
+        self.bwlimit = bwlimit
+        # the bytes sent, not counting ranges that were already there
+        self.sent = 0
+
+    def _blocks(self, local, offset, length, digest, throttle=True):
+        """read a range of local a block at a time, adding it to digest, no
+        faster than the bandwidth limit if throttle
+        """
+        started = time.time()
+        done = 0
+        with open(local, 'rb') as fp:
+            fp.seek(offset)
+            while done < length:
+                data = fp.read(min(RANGE_BLOCK, length - done))
+                if not data:
+                    raise CrashPlanError(f"ERROR: {local} got shorter while it was sent.")
+                digest.update(data)
+                done += len(data)
+                yield data
+                if throttle and self.bwlimit:
+                    ahead = done / (self.bwlimit * 1024) - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    def _digest(self, local, offset, length):
+        """the SHA-256 of a range of local"""
+        digest = hashlib.sha256()
+        for _data in self._blocks(local, offset, length, digest, throttle=False):
+            pass
+        return digest.hexdigest()
+
+    def _sendRange(self, local, name, offset, length):
+        """send one range, return its digest once the server agrees"""
+        digest = hashlib.sha256()
+        reply = self.comms.putRange(name, offset, self._blocks(local, offset, length, digest))
+        if reply['bytes'] != length or reply['digest'] != digest.hexdigest():
+            raise CrashPlanError(f"ERROR: range {offset:d} of {local} did not arrive as sent.")
+        return digest.hexdigest()
+
+    def send(self, local, path, st):
+        """send the file local, with the stat st, to path in WORKING.
+        returns the bytes sent, raises CrashPlanError if it was not
+        """
+        name = rangeName(path, st)
+        ranges = splitRanges(st.st_size, self.streams)
+        written = self.comms.rangeStatus(name)
+        digests = {}
+        for offset, length in ranges:
+            if written.get(str(offset), [None])[0] == length:
+                digest = self._digest(local, offset, length)
+                if digest == written[str(offset)][1]:
+                    digests[offset] = digest
+        todo = [(offset, length) for offset, length in ranges if offset not in digests]
+
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.streams) as pool:
+            for (offset, _length), digest in zip(todo, pool.map(lambda r: self._sendRange(local, name, *r), todo)):
+                digests[offset] = digest
+        sent = sum(length for _offset, length in todo)
+        self.sent += sent
+
+        now = os.stat(local)
+        if (now.st_size, now.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            raise CrashPlanError(f"ERROR: {local} changed while it was sent.")
+        self.comms.assembleRange(name, path, st.st_size,
+                                 [[offset, length, digests[offset]] for offset, length in ranges], st)
+        seconds = max(time.time() - started, 0.001)
+        self.log.info("RangeTransfer %s - %d bytes in %d ranges, %d already there, %.1f MB/s"
+                      % (path, st.st_size, len(ranges), len(ranges) - len(todo),
+                         sent / seconds / 1024 / 1024))
+        return sent
+
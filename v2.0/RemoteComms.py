@@ -4,12 +4,45 @@
 # pylint: disable=trailing-newlines
 
 import os
+import time
+import json
+import hashlib
 import logging
 import platform
+import shlex
+import subprocess
 from Settings import Settings
 from Utils import process
 from CrashPlanError import CrashPlanError
 
+# one multiplexed ssh connection is shared by every ssh, scp and rsync call
+# made during a run. ControlPersist bounds how long a master left behind by
+# an aborted run will linger.
+SSH_CONTROL_PATH = "ssh-%r@%h:%p"
+SSH_CONTROL_PERSIST = "600"
+
+# the server side agent and the modules it needs. they are installed in a
+# folder named after a digest of their contents so an upgraded client never
+# talks to a stale agent.
+AGENT_SCRIPT = "myocp_agent.py"
+AGENT_MANIFEST = [AGENT_SCRIPT, "SnapshotClone.py", "SnapshotDelete.py", "SnapshotUsage.py",
+                  "SnapshotCatalog.py", "SnapshotDedupe.py", "ChunkStore.py"]
+AGENT_DIR = ".myocp"
+AGENT_PYTHON = "python3"
+
+# old backups are pruned by moving them to a trash folder on the server and
+# deleted there in the background. how long to wait for the reclaimer to size
+# what was trashed, and to free it after the disk fills, checking every
+# RECLAIM_POLL seconds.
+ESTIMATE_WAIT = 300
+RECLAIM_WAIT = 1800
+RECLAIM_POLL = 2
+
+# paths sent per catalog-update request after a run
+CATALOG_CHUNK = 5000
+# moved files sent to the server per request
+MOVES_CHUNK = 2000
+
 def ping(host):
     """
     Returns True if host (str) responds to a ping request.
@@ -38,6 +71,12 @@ class RemoteComms():
 
         self.settings = settings
         self.log = log
+        self.control_path = os.path.join(self.settings('settings-dir'), SSH_CONTROL_PATH)
+        self.agent_dir = None
+        self.state = None
+        # until serverState() says otherwise assume WORKING was left by an
+        # earlier run, so this run's changes alone do not describe it
+        self.resumed = True
         
     def serverIsUp(self):
         """is the server up"""
@@ -54,9 +93,39 @@ class RemoteComms():
         return ret
         
 
+    def sshOptions(self):
+        """ssh options which route a connection through the shared master"""
+        return ["-o", "ControlMaster=auto",
+                "-o", f"ControlPath={self.control_path}",
+                "-o", f"ControlPersist={SSH_CONTROL_PERSIST}"]
+
+    def sshCommand(self):
+        """the ssh command line for rsync's -e option"""
+        return " ".join(["ssh", "-q"] + self.sshOptions())
+
+    def openMaster(self):
+        """start the multiplexed master connection used for the rest of the run.
+        ControlPersist detaches the master from our pipes once 'true' returns.
+        """
+        remote = ["ssh", "-q"] + self.sshOptions() + [self.settings('server-address'), "true"]
+
+        st, rt = process(remote)
+        if st != 0:
+            # not fatal, each call will simply make its own connection
+            self.log.error(f"(openMaster): {st:d} {rt}")
+
+        return st == 0
+
+    def closeMaster(self):
+        """tear down the multiplexed master connection"""
+        remote = ["ssh", "-q", "-O", "exit"] + self.sshOptions() + [self.settings('server-address')]
+
+        st, _rt = process(remote)
+        return st == 0
+
     def remoteCommand(self, command):
         """perform a remote command on the server and get the response"""
-        remote = ["ssh", "-q", self.settings('server-address')]
+        remote = ["ssh", "-q"] + self.sshOptions() + [self.settings('server-address')]
         remote.append(command)
 
         st, rt = process(remote)
@@ -72,9 +141,13 @@ class RemoteComms():
             dest_filename = os.path.basename(dest)
         else:
             dest_filename = os.path.basename(filename)
-        remote = ["scp", filename, self.settings('server-address')+":"+ 
-                  os.path.join(self.settings("backup-destination"), 
-                               self.settings('local-hostname'), dest_filename)]
+        self._scp(filename, os.path.join(self.settings("backup-destination"), 
+                                         self.settings('local-hostname'), dest_filename))
+
+    def _scp(self, filename, remote_path):
+        """copy a local file to a full path on the server"""
+        remote = ["scp"] + self.sshOptions()
+        remote += [filename, self.settings('server-address')+":"+remote_path]
 
         st, rt = process(remote)
 
@@ -83,35 +156,412 @@ class RemoteComms():
             self.log.error(f"(remoteCommand): {st:d} {rt}")
             raise CrashPlanError(f"ERROR: remote command failed. ({remote})")
 
+    def _agentDir(self):
+        """folder on the server the agent is installed in"""
+        if self.agent_dir is None:
+            digest = hashlib.sha1()
+            for module in AGENT_MANIFEST:
+                with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module), 'rb') as fp:
+                    digest.update(fp.read())
+            self.agent_dir = os.path.join(self.settings("backup-destination"), AGENT_DIR,
+                                          "agent-" + digest.hexdigest()[:12])
+        return self.agent_dir
+
+    def installAgent(self):
+        """copy the agent and its modules to the server"""
+        agent_dir = self._agentDir()
+        self.log.info(f"Installing server agent in {agent_dir}")
+        st, _rt = self.remoteCommand(f"mkdir -p {agent_dir}")
+        if st != 0:
+            raise CrashPlanError(f"ERROR: cannot create {agent_dir} on server.")
+
+        for module in AGENT_MANIFEST:
+            self._scp(os.path.join(os.path.dirname(os.path.abspath(__file__)), module),
+                      os.path.join(agent_dir, module))
+
+    def agent(self, requests):
+        """send a batch of requests to the server agent in one round trip and
+        return its replies in the same order. The agent is installed on first use.
+        """
+        remote = self._agentCommand()
+        input_text = "".join(json.dumps(req)+"\n" for req in requests)
+
+        # the replies are taken as they arrive, the tail process() keeps is
+        # only for reporting errors and may not hold them all
+        replies = []
+        def reply(line, is_stderr):
+            if not is_stderr and line.startswith('{'):
+                replies.append(json.loads(line))
+            self._agentProgress(line, is_stderr)
+
+        st, rt = process(remote, input_text=input_text, callback=reply)
+        if st == 2 and rt.find(AGENT_SCRIPT) > -1:
+            # python could not open the script, so it isn't installed yet
+            self.installAgent()
+            del replies[:]
+            st, rt = process(remote, input_text=input_text, callback=reply)
+
+        if st != 0 or len(replies) != len(requests):
+            self.log.error(f"(agent): {requests}")
+            self.log.error(f"(agent): {st:d} {rt}")
+            raise CrashPlanError(f"ERROR: server agent failed. ({st})")
+
+        for req, reply in zip(requests, replies):
+            if not reply['ok']:
+                self.log.error(f"(agent): {req['op']} - {reply['error']}")
+
+        return replies
+
+    def _agentCommand(self, *mode):
+        """the ssh command that runs the agent on the server, in one of its
+        other modes if mode is given. each argument is quoted, the remote
+        shell splits the command again
+        """
+        remote = ["ssh", "-q"] + self.sshOptions() + [self.settings('server-address')]
+        args = ([AGENT_PYTHON, os.path.join(self._agentDir(), AGENT_SCRIPT)] + list(mode[:1]) +
+                [self.settings("backup-destination"), self.settings('local-hostname')] + list(mode[1:]))
+        remote.append(" ".join(shlex.quote(str(arg)) for arg in args))
+        return remote
+
+    def _agentProgress(self, line, is_stderr):
+        """log the progress messages the agent writes to stderr"""
+        if is_stderr:
+            self.log.info(f"(agent): {line}")
+
+    def serverState(self):
+        """ensure the root backup dir exists and collect the backup list,
+        space and metadata from the server in a single round trip.
+        """
+        _root, backups, space, meta, journal, partial, catalog, _reclaim = self.agent(
+            [{'op': 'ensure-root'}, {'op': 'list'}, {'op': 'space'}, {'op': 'metadata'},
+             {'op': 'run-journal'}, {'op': 'partial-gc', 'max_age': self.settings('partial-max-days') * 86400},
+             {'op': 'catalog-query', 'query': 'latest'}, self._reclaimRequest()])
+        if partial.get('removed'):
+            self.log.info("Removed %d partial files, %d bytes, not sent again in %d days"
+                          % (partial['removed'], partial['bytes'], self.settings('partial-max-days')))
+        self.resumed = backups.get('working', True)
+        self.state = {'backups': backups.get('backups', []),
+                      'space': space,
+                      'metadata': meta.get('metadata', {}),
+                      'run-journal': journal.get('journal'),
+                      'catalog-latest': catalog.get('result')}
+        return self.state
+
+    def space(self):
+        """get the space on the remote server in bytes, including what the
+        reclaimer has still to free, and its free inodes
+        """
+        space, = self.agent([{'op': 'space'}])
+        if not space['ok']:
+            raise CrashPlanError(f"ERROR: cannot get space on server. ({space['error']})")
+        return space
+
     def remoteSpace(self):
-        """get percentage space used on remote server"""
-        cmd = "df -h | grep "+self.settings('backup-destination')+" | awk -F' ' '{print $5}'"
-        _st, response = self.remoteCommand(cmd)
-        return int(response.replace('%', ''))
+        """get percentage space used on remote server, not counting the
+        backups in the trash. waits a while for any just trashed to be sized.
+        """
+        space = self.space()
+        deadline = time.time() + ESTIMATE_WAIT
+        while space.get('estimating') and time.time() < deadline:
+            time.sleep(RECLAIM_POLL)
+            space = self.space()
+
+        size = space['used'] + space['free']
+        if not size:
+            return space['percent']
+        return int(round(max(0, space['used'] - space.get('pending', 0)) * 100.0 / size))
+
+    def waitForReclaim(self, timeout=RECLAIM_WAIT):
+        """wait for the reclaimer to empty the trash, return True if there was
+        anything to wait for
+        """
+        space = self.space()
+        waited = bool(space.get('pending') or space.get('estimating'))
+        deadline = time.time() + timeout
+        while (space.get('pending') or space.get('estimating')) and time.time() < deadline:
+            time.sleep(RECLAIM_POLL)
+            space = self.space()
+        return waited
     
     def createRootBackupDir(self):
         """ensure root backup dir exists on remote server"""
-        cmd = "mkdir -p %s" % os.path.join(self.settings("backup-destination"),
-                                           self.settings('local-hostname'))
-        _st, rt = self.remoteCommand(cmd)
-        return rt
+        reply, = self.agent([{'op': 'ensure-root'}])
+        return reply.get('error', '')
 
     def getBackupList(self):
-        """get list of backup folders"""
-        cmd = "ls -d %s/20*" % os.path.join(self.settings("backup-destination"), 
-                                            self.settings('local-hostname'))
-        st, response = self.remoteCommand(cmd)
-        bu_list = []
-        if st == 0:
-            bu_list = response.split('\n')
-            bu_list.sort()
+        """get list of backup folders, from the last serverState() if still valid"""
+        if self.state is not None:
+            return list(self.state['backups'])
+
+        reply, = self.agent([{'op': 'list'}])
+        return reply.get('backups', [])
+
+    def readMetaData(self):
+        """read the remote .metadata as a dict"""
+        reply, = self.agent([{'op': 'metadata'}])
+        return reply.get('metadata', {})
+
+    def finalize(self, datedir, metadata, changes=None):
+        """rename WORKING to datedir and write the metadata in one request,
+        then add the new backup to the catalog and the usage accounting.
+        changes are the paths rsync updated and deleted, None if not known.
+        returns the bytes the new backup holds on its own and the free
+        space left, None where they could not be found.
+        """
+        self.state = None
+        reply, = self.agent([{'op': 'finalize', 'datedir': datedir, 'metadata': metadata}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot finalize backup {datedir}. ({reply['error']})")
+
+        # the backup is made now, what follows only describes it, so a
+        # failure is logged rather than raised
+        try:
+            self._updateCatalog(datedir, changes)
+        except CrashPlanError as exc:
+            self.log.error(f"(finalize): {exc}, the next backup rescans the catalog")
+        try:
+            usage, space = self.agent([{'op': 'usage'}, {'op': 'space'}])
+        except CrashPlanError as exc:
+            self.log.error(exc)
+            return {'stored': None, 'free': None}
+        stored = None
+        if usage['ok']:
+            stored = usage['exclusive'].get(datedir, 0)
+            self.log.info("Backup %s holds %d bytes of its own" % (datedir, stored))
+        return {'stored': stored, 'free': space['free'] if space['ok'] else None}
+
+    def _updateCatalog(self, datedir, changes):
+        """bring the catalog up to date with a new backup, the change lists
+        sent CATALOG_CHUNK paths a request. the backup is only closed in the
+        catalog once every batch has been taken
+        """
+        if changes is None or self.resumed:
+            batches = [{'op': 'catalog-update', 'snapshot': datedir, 'full': True}]
+        else:
+            updated, deleted = changes['updated'], changes['deleted']
+            batches = ({'op': 'catalog-update', 'snapshot': datedir,
+                        'updated': updated[i:i+CATALOG_CHUNK], 'deleted': deleted[i:i+CATALOG_CHUNK]}
+                       for i in range(0, max(len(updated), len(deleted), 1), CATALOG_CHUNK))
+        for batch in batches:
+            reply, = self.agent([batch])
+            if not reply['ok']:
+                raise CrashPlanError(f"ERROR: cannot catalog {datedir}. ({reply['error']})")
+            if reply.get('rescanned') or reply.get('skipped'):
+                break
+        catalog, = self.agent([{'op': 'catalog-close', 'snapshot': datedir}])
+        if not catalog['ok']:
+            raise CrashPlanError(f"ERROR: cannot close {datedir} in the catalog. ({catalog['error']})")
+        self.log.info("Catalogued %s - %d files, %d bytes" % (datedir, catalog['files'], catalog['bytes']))
+
+    def catalogStreams(self):
+        """can the catalog take the new backup as a list of changes, ie. it
+        has the backup WORKING is built on and WORKING is not left from an
+        interrupted run. otherwise it walks the backup itself and there is no
+        point keeping the changes. from the last serverState() if still valid
+        """
+        if self.resumed:
+            return False
+        if self.state is not None:
+            latest = self.state['catalog-latest']
+            backups = self.state['backups']
+        else:
+            reply, listing = self.agent([{'op': 'catalog-query', 'query': 'latest'}, {'op': 'list'}])
+            latest = reply.get('result')
+            backups = listing.get('backups', [])
+        return latest is not None and bool(backups) and os.path.basename(backups[-1]) == latest
+
+    def cloneBackup(self, latest):
+        """start WORKING as a hard link clone of the backup latest, return
+        True if it was
+        """
+        reply, = self.agent([{'op': 'clone', 'src': latest}])
+        if not reply['ok']:
+            return False
+        self.log.info("CloneBackup( %s ) - %d files, %d dirs in %.1fs"
+                      % (latest, reply['clone']['files'], reply['clone']['dirs'], reply['clone']['seconds']))
+        return reply['clone']['errors'] == 0
+
+    def linkMoves(self, latest, moves):
+        """have the server link the files that moved, [old, new, size, mtime,
+        digest] with the paths as they are in a backup, from the backup
+        latest into WORKING. returns how many were linked and their bytes
+        """
+        linked, size = 0, 0
+        for start in range(0, len(moves), MOVES_CHUNK):
+            reply, = self.agent([{'op': 'link-moves', 'latest': latest,
+                                  'moves': moves[start:start + MOVES_CHUNK]}])
+            if not reply['ok']:
+                raise CrashPlanError(f"ERROR: cannot link moved files. ({reply['error']})")
+            linked += reply['linked']
+            size += reply['bytes']
+        self.log.info("LinkMoves( %s ) - %d of %d moved files linked, %d bytes" % (latest, linked, len(moves), size))
+        return linked, size
+
+    def rangeStatus(self, name):
+        """the ranges of the big file name already on the server,
+        {offset: [length, digest]}
+        """
+        reply, = self.agent([{'op': 'range-status', 'name': name}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot read the ranges of {name}. ({reply['error']})")
+        return reply['ranges']
+
+    def putRange(self, name, offset, blocks):
+        """send the bytes in blocks as the range of the big file name that
+        starts at offset, in an ssh session of its own over the shared
+        connection. returns the bytes the server wrote and their digest
+        """
+        remote = self._agentCommand("--put-range", name, offset)
+        with subprocess.Popen(remote, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE) as proc:
+            try:
+                for block in blocks:
+                    proc.stdin.write(block)
+            except BrokenPipeError:
+                pass
+            out, err = proc.communicate()
+        replies = [json.loads(line) for line in out.decode(errors='replace').split('\n') if line.startswith('{')]
+        if proc.returncode != 0 or not replies or not replies[0]['ok']:
+            self.log.error(f"(putRange): {proc.returncode:d} {out.decode(errors='replace')} {err.decode(errors='replace')}")
+            raise CrashPlanError(f"ERROR: cannot send range {offset:d} of {name}.")
+        return replies[0]
+
+    def assembleRange(self, name, path, size, ranges, st):
+        """have the server check the ranges, [offset, length, digest], make
+        up the big file name and link it into WORKING at path with the mode
+        and mtime of st
+        """
+        reply, = self.agent([{'op': 'range-assemble', 'name': name, 'path': path, 'size': size,
+                              'ranges': ranges, 'mode': st.st_mode, 'mtime_ns': st.st_mtime_ns}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot put {path} together. ({reply['error']})")
+        return reply['bytes']
+
+    def blockBegin(self, name, path, base, fingerprint, unchanged):
+        """start the new version of the block tracked file at path from its
+        version in the backup base. returns True if the server's version
+        there has the blocks of fingerprint, so only changes need sending
+        """
+        reply, = self.agent([{'op': 'block-begin', 'name': name, 'path': path, 'base': base,
+                              'fingerprint': fingerprint, 'unchanged': unchanged}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot start {path} from its last version. ({reply['error']})")
+        return reply['based']
+
+    def blockPut(self, name, block_size, blocks):
+        """send changed blocks, [index, digest, base64 of the zlib compressed
+        block], of a block tracked file
+        """
+        reply, = self.agent([{'op': 'block-put', 'name': name, 'block_size': block_size, 'blocks': blocks}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot store changed blocks. ({reply['error']})")
+        return reply['bytes']
+
+    def blockEnd(self, name, path, st, block_size, fingerprint, based):
+        """put the new version of a block tracked file in WORKING with the
+        mode and mtime of st, once the server has the blocks of fingerprint
+        """
+        reply, = self.agent([{'op': 'block-end', 'name': name, 'path': path, 'size': st.st_size,
+                              'mode': st.st_mode, 'mtime_ns': st.st_mtime_ns, 'block_size': block_size,
+                              'fingerprint': fingerprint, 'based': based}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot put {path} in place. ({reply['error']})")
+
+    def runJournal(self):
+        """the copy of the run journal on the server, None if there is none,
+        from the last serverState() if still valid
+        """
+        if self.state is not None:
+            return self.state['run-journal']
+        reply, = self.agent([{'op': 'run-journal'}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot read the run journal. ({reply['error']})")
+        return reply['journal']
+
+    def putRunJournal(self, journal):
+        """mirror the run journal to the server"""
+        if self.state is not None:
+            self.state['run-journal'] = journal
+        reply, = self.agent([{'op': 'run-journal', 'journal': journal}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot write the run journal. ({reply['error']})")
+
+    def workingPaths(self, paths):
+        """which of paths, as they are in a backup, are in WORKING"""
+        reply, = self.agent([{'op': 'working-paths', 'paths': paths}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot look in WORKING. ({reply['error']})")
+        return reply['present']
+
+    def linkHits(self, refs, path):
+        """which of the --link-dest references refs the files of path in
+        WORKING were linked from, see the agent's link-hits op
+        """
+        reply, = self.agent([{'op': 'link-hits', 'refs': refs, 'path': path}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot count link hits. ({reply['error']})")
+        return reply
+
+    def catalogQuery(self, query, **args):
+        """ask the server's catalog a question, see SnapshotCatalog"""
+        request = {'op': 'catalog-query', 'query': query}
+        request.update(args)
+        reply, = self.agent([request])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: catalog query failed. ({reply['error']})")
+        return reply['result']
+
+    def startDedupe(self):
+        """start a dedupe pass over every host's backups on the server"""
+        reply, = self.agent([{'op': 'dedupe', 'workers': self.settings('dedupe-workers')}])
+        if reply['ok'] and reply['last']:
+            self.log.info("Last dedupe pass - %(linked)d files linked, %(reclaimed)d bytes reclaimed"
+                          % reply['last'])
+        return reply['ok']
+
+    def planPrune(self, max_percent, minimum=0, need=0):
+        """ask the server which backups to remove to get under max_percent
+        used once need more bytes have been written, at least minimum of them
+        """
+        reply, = self.agent([{'op': 'prune-plan', 'max-percent': max_percent, 'minimum': minimum,
+                              'need': need}])
+        if not reply['ok']:
+            raise CrashPlanError(f"ERROR: cannot plan pruning on server. ({reply['error']})")
+        if reply['remove']:
+            self.log.info("PlanPrune( %d%% ) - %d backups free %d of %d bytes needed"
+                          % (max_percent, len(reply['remove']), reply['freed'], reply['target']))
+        return reply['remove']
+
+    def _reclaimRequest(self):
+        """the request to start the background reclaimer"""
+        return {'op': 'reclaim', 'workers': self.settings('prune-workers'),
+                'max-ops': self.settings('prune-max-ops')}
+
+    def trashBackup(self, oldest):
+        """move the oldest backup folder to the trash and leave the server to
+        delete it in the background
+        """
+        return self.trashBackups([oldest]) == 1
 
-        return bu_list
+    def trashBackups(self, victims):
+        """move backup folders to the trash in one round trip and start the
+        reclaimer, return how many were trashed
+        """
+        self.log.info("TrashBackups( %s )" % ", ".join(v.split('/')[-1] for v in victims))
+        self.state = None
+        replies = self.agent([{'op': 'trash', 'path': v} for v in victims] + [self._reclaimRequest()])
+        return len([reply for reply in replies[:-1] if reply['ok']])
 
     def removeOldestBackup(self, oldest):
-        """TBD - remove the oldest backup folder"""
-        self.log.info("RemoveOldestBackup( %s ) - SIMPLE IMPLEMENTATION - MAY FAIL!" % oldest.split('/')[-1])
-        cmd = f"rm -rf {oldest}"
-        response = self.remoteCommand("rm -rf %s" % (oldest))
-        #self.log.error(response)
+        """remove the oldest backup folder"""
+        self.log.info("RemoveOldestBackup( %s )" % oldest.split('/')[-1])
+        self.state = None
+        reply, = self.agent([{'op': 'remove', 'path': oldest,
+                              'workers': self.settings('prune-workers'),
+                              'max-ops': self.settings('prune-max-ops')}])
+        if reply['ok']:
+            self.log.info("RemoveOldestBackup( %s ) - %d files, %d bytes freed in %.1fs"
+                          % (oldest.split('/')[-1], reply['delete']['files'],
+                             reply['delete']['freed'], reply['delete']['seconds']))
+        return reply['ok']
 
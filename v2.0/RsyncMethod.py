@@ -5,25 +5,46 @@
 """
 RsyncMethod
 
-
+rsync is given the latest backup and older ones spaced out by age as
+--link-dest references, chosen by LinkDestHistory.  When there is more than
+one the server counts, after the run, what each saved, and the files linked
+from the older ones, which rsync does not report, are passed on to the
+listeners as changed.
+
+The files BlockTracker backs up a block at a time are kept out of rsync's
+way, excluded so they are not sent and protected so --delete leaves the
+copy BlockTracker put in WORKING alone.
 """
 
 import os
 import shlex
+import hashlib
 import logging
 from Settings import Settings
 from RemoteComms import RemoteComms
 from MetaData import MetaData
 from Utils import process
 from CrashPlan import CrashPlanErrorCodes
+from CrashPlanError import CrashPlanError
+from RsyncOutput import RsyncParser, RsyncEvent, RsyncChange, RSYNC_OUTPUT_OPTIONS
+from LinkDestHistory import LinkDestHistory
 
 BACKUPLOG_FILE = os.path.join(os.environ['HOME'], ".myocp", "backup.log")
 
 RSYNC = "/opt/local/bin/rsync"
-RSYNC_OPTIONS = "--bwlimit=2500 --timeout=300 --delete --delete-excluded "
+RSYNC_OPTIONS = "--timeout=300 --delete --delete-excluded "
 RSYNC_EXCLUDE_FILE = "myocp_excl"
 RSYNC_EXCLUDE_FILE_OPTION = "--exclude_from="
 
+# an interrupted transfer leaves what it had of a file in this folder at the
+# top of WORKING rather than throwing it away. the next attempt uses it as
+# the basis of the file, so only the blocks that do not match it are sent
+# again. rsync keeps a partial file by its name alone, so each source, and
+# each shard of one, has a folder of its own in it, see partialName(). the
+# agent takes the folder out of WORKING before it becomes a backup and
+# removes anything left in it longer than partial-max-days.
+RSYNC_PARTIAL_DIR = ".myocp-partial"
+
 # rsync return codes to deal with
 RSYNC_SUCCESS = 0
 RSYNC_FILES_VANISHED = 24
@@ -35,6 +56,13 @@ RSYNC_TIMEOUT_IN_DATA_SEND_RECIEVE = 30
 #RSYNC_DISK_FULL = -1
 #RSYNC_UNKNOWN_ERROR = -99
 
+def partialName(src, shard=""):
+    """the name of the folder in RSYNC_PARTIAL_DIR for a source, or a shard
+    of one, the same every run so an interrupted file is found again
+    """
+    return hashlib.sha1(("%s\0%s" % (src.rstrip('/'), shard)).encode()).hexdigest()[:16]
+
+
 class BaseMethod():
     def __init__(self):
         pass
@@ -47,6 +75,58 @@ class BaseMethod():
         """return one of the CrashPlanErrorCodes values"""
         pass
 
+    def addListener(self, listener):
+        """have listener(event) called with each RsyncEvent describing a
+        change the backup makes. returns False if the method cannot report
+        its changes.
+        """
+        return False
+
+    def backupFinished(self, datedir):
+        """the backup has completed and been renamed to datedir"""
+        pass
+
+    def transferredBytes(self):
+        """the bytes the last run sent to the server"""
+        return 0
+
+    def addWatchdog(self, watchdog):
+        """have the SpaceWatchdog pause the method when the server's disk
+        runs low. returns False if the method cannot be paused.
+        """
+        return False
+
+    def addRunJournal(self, journal):
+        """have the method record the parts of a source it finishes in the
+        RunJournal, and skip those an interrupted run finished. returns
+        False if a source is only ever run whole.
+        """
+        return False
+
+    def addBlockFiles(self, paths):
+        """keep the method away from the files BlockTracker backs up.
+        returns False if it cannot.
+        """
+        return False
+
+    def addFileJournal(self, journal):
+        """have the method scan with, and commit, the FileJournal the size
+        estimate was made from. returns False if it has no use for one.
+        """
+        return False
+
+    def projectsSize(self):
+        """True if the method projects what it will store as it runs, so
+        no dry run is needed to size the backup first
+        """
+        return False
+
+    def projection(self):
+        """(bytes stored so far, bytes the run is expected to store) while
+        it runs, None if there is no telling yet
+        """
+        return None
+
 class RsyncMethod(BaseMethod):
     """a method of doing backups using rsync"""
 
@@ -64,6 +144,19 @@ class RsyncMethod(BaseMethod):
         self.dry_run = dry_run
         self.getsize = getsize
         self.cmd = None
+        self.listeners = []
+        self.watchdogs = []
+        self.parser = None
+        self.stats = None
+        self.src = None
+        # the files BlockTracker backs up, left out of the transfer
+        self.block_files = []
+        # the --link-dest references of the command, latest first
+        self.link_refs = []
+        self.link_history = LinkDestHistory(self.settings('settings-dir'))
+        self.size_required = 0
+        self.files_required = 0
+        self.bwlimit = self.settings('bandwidth-limit')
         self.rsync_log_file = BACKUPLOG_FILE #self.settings('settings-dir') + "/rsync.log"
 
         self.exclude_file = os.path.join(os.environ['HOME'], self.settings('settings-dir'),
@@ -72,50 +165,147 @@ class RsyncMethod(BaseMethod):
 
     def buildCommand(self, src, dest):
         """create the backup command"""
+        self.src = src
         self.cmd = self._rsyncCmd()
         self.cmd += " %s \"%s:%s\" " % (src, self.settings('server-address'), dest)
 
     def buildSizeCommand(self, src, dest):
         """create the backup command"""
+        self.src = src
         self.cmd = self._rsyncSizeCmd()
         self.cmd += " %s \"%s:%s\" " % (src, self.settings('server-address'), dest)
 
+    def addListener(self, listener):
+        """listener(event) is called with each RsyncEvent while rsync runs"""
+        self.listeners.append(listener)
+        return True
+
+    def addWatchdog(self, watchdog):
+        """the rsync processes are paused when the server's disk runs low"""
+        self.watchdogs.append(watchdog)
+        return True
+
+    def addBlockFiles(self, paths):
+        """the files are excluded from the transfer and protected from
+        --delete
+        """
+        self.block_files = list(paths)
+        return True
+
+    def projectsSize(self):
+        """rsync's progress says how far through the files it is"""
+        return True
+
+    def projection(self):
+        """projected from the output of the running rsync"""
+        parser = self.parser
+        if parser is None:
+            return None
+        projected = parser.projectedBytes()
+        if projected is None:
+            return None
+        return parser.storedBytes(), projected
+
     def run(self):
         """run the backup command"""
         self._create_exclude_file()
         self.log.info(self.cmd)
 
-        st, rt = process(shlex.split(self.cmd))
+        st, rt = self._runParsed()
         if self.dry_run:
-            self._calculate_size(rt)
+            self._calculate_size()
             #print("DRY_RUN",st,rt)
 
         self._remove_exclude_file()
-        return self._interpretResults(st, rt)
+        result = self._interpretResults(st, rt)
+        if result == CrashPlanErrorCodes.SUCCESS:
+            self._measureLinks()
+        self.link_refs = []
+        return result
 
     def run2(self):
         """run the backup command"""
         self._create_exclude_file()
         self.log.info(self.cmd)
 
-        st, rt = process(shlex.split(self.cmd))
-        self._calculate_size(rt)
+        self._runParsed()
+        self._calculate_size()
 
         self._remove_exclude_file()
+        self.link_refs = []
+
+    def transferredBytes(self):
+        """the bytes the last run sent to the server"""
+        return self.stats.bytes_sent if self.stats else 0
+
+    def _runParsed(self):
+        """run the command streaming its output through an RsyncParser"""
+        parser = RsyncParser()
+        for listener in self.listeners:
+            parser.addListener(listener)
+
+        self.parser = parser
+        try:
+            st, rt = self._process(self.cmd, parser.feed)
+        finally:
+            self.parser = None
+        self.stats = parser.finish()
+        return st, rt
+
+    def _process(self, cmd, callback):
+        """run cmd with the watchdogs watching it"""
+        procs = []
+        def started(proc):
+            procs.append(proc)
+            for watchdog in self.watchdogs:
+                watchdog.attach(proc)
+        try:
+            return process(shlex.split(cmd), callback=callback, started=started)
+        finally:
+            for proc in procs:
+                for watchdog in self.watchdogs:
+                    watchdog.detach(proc)
+
+    def _linkDests(self):
+        """the --link-dest options, the latest backup and older ones"""
+        self.link_refs = []
+        if self.meta.get('latest-complete') != "":
+            backups = [os.path.basename(backup) for backup in self.comms.getBackupList()]
+            self.link_refs = self.link_history.choose(backups, self.settings('link-dest-max'))
+        return "".join(" --link-dest=../%s" % ref for ref in self.link_refs)
 
-    def _calculate_size(self, rt):
+    def _measureLinks(self):
+        """have the server count what each reference saved, and report the
+        files linked from the older ones as changed
+        """
+        if self.dry_run or len(self.link_refs) < 2 or self.src is None:
+            return
+        try:
+            hits = self.comms.linkHits(self.link_refs, os.path.basename(self.src.rstrip('/')))
+        except CrashPlanError as exc:
+            self.log.error(exc)
+            return
+        for path in hits['relinked']:
+            for listener in self.listeners:
+                listener(RsyncEvent(RsyncChange.CHANGED, path, 0, '>f'))
+        if not hits['complete']:
+            self.log.error("LinkDest %s - more files came from older backups than are listed, "
+                           "the catalog misses the rest" % self.src)
+        run = self.link_history.record(self.link_refs, hits)
+        self.log.info("LinkDest %s - latest %s, older %s, new %s, %d stats in %.1fs"
+                      % (self.src, run['latest'], run['ages'], run['new'], run['stats'], run['seconds']))
+
+    def _calculate_size(self):
         """when used in dry_run mode we can calculate the space required to do
-        the backup
+        the backup, in kB, and the files it writes
         """
-        size_bytes = 0
-        for line in return_str.split('\n'):
-            if line.startswith('sent '):
-                bytestr = line.split(' ')[1]
-                try:
-                    size += int(bytestr)
-                except ValueError:
-                    pass
+        size = 0
+        files = 0
+        if self.stats:
+            size = self.stats.transferred_size
+            files = self.stats.transferred
         self.size_required = size/1024
+        self.files_required = files
 
     def _rsyncCmd(self):
         """construct rsync command from settings"""
@@ -126,17 +316,43 @@ class RsyncMethod(BaseMethod):
         if self.dry_run:
             cmd += " --dry-run"
 
-        if self.meta.get('latest-complete') != "":
-            backup_list = self.comms.getBackupList()
-
-            if backup_list:
-                cmd += " --link-dest=../%s" % os.path.basename(backup_list[-1])
+        cmd += " -e '%s'" % self.comms.sshCommand()
+        cmd += self._linkDests()
+        if not self.dry_run:
+            cmd += self._partialDir()
 
-        cmd += " "+RSYNC_OPTIONS
+        cmd += " --bwlimit=%d %s" % (self.bwlimit, RSYNC_OPTIONS)
+        cmd += RSYNC_OUTPUT_OPTIONS
+        cmd += self._blockFilters()
         cmd += " --exclude-from="+self.exclude_file
 
         return cmd
 
+    def _blockFilters(self):
+        """the --filter options for the block files in the source, anchored
+        at the source's parent, where rsync's paths start
+        """
+        if self.src is None:
+            return ""
+        src = self.src.rstrip('/')
+        filters = ""
+        for path in self.block_files:
+            if not path.startswith(src + '/'):
+                continue
+            rel = os.path.relpath(path, os.path.dirname(src))
+            rel = "".join("\\" + c if c in "*?[\\" else c for c in rel)
+            filters += " --filter=%s --filter=%s" % (shlex.quote("- /" + rel), shlex.quote("P /" + rel))
+        return filters
+
+    def _partialDir(self, shard=""):
+        """the --partial-dir option for the source, or one shard of it. the
+        path is absolute, rsync would make a folder in every folder of the
+        backup otherwise, and of its own so rsyncs running side by side do
+        not write the partial files of files with the same name into one
+        """
+        return " --partial-dir=%s" % os.path.join(self.settings('backup-destination'), self.settings('local-hostname'),
+                                                  "WORKING", RSYNC_PARTIAL_DIR, partialName(self.src, shard))
+
 
     def _rsyncSizeCmd(self):
         """construct rsync command from settings so we can get the required
@@ -145,14 +361,12 @@ class RsyncMethod(BaseMethod):
         cmd = RSYNC + " -av"
         cmd += " --dry-run"
         cmd += " --log-file=%s" % self.rsync_log_file
+        cmd += " -e '%s'" % self.comms.sshCommand()
+        cmd += self._linkDests()
 
-        if self.meta.get('latest-complete') != "":
-            backup_list = self.comms.getBackupList()
-
-            if backup_list:
-                cmd += " --link-dest=../%s" % os.path.basename(backup_list[-1])
-
-        cmd += " "+RSYNC_OPTIONS
+        cmd += " --bwlimit=%d %s" % (self.bwlimit, RSYNC_OPTIONS)
+        cmd += RSYNC_OUTPUT_OPTIONS
+        cmd += self._blockFilters()
         cmd += " --exclude-from="+self.exclude_file
 
         return cmd
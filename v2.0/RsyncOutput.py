@@ -0,0 +1,176 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+RsyncOutput
+
+Incremental parser for the output of rsync run with
+
+  --out-format='%i %l %n%L' --stats --info=progress2
+
+Lines are fed in one at a time as they stream out of rsync (RsyncParser.feed
+has the same signature as the Utils.process callback). Every itemized line
+becomes an RsyncEvent handed to the registered listeners straight away, and
+the --stats block at the end becomes a single RsyncStats record, so nothing
+needs to hold the output in memory or re-parse the log afterwards.
+
+The progress lines say how many of the files found so far have been checked,
+from which projectedBytes() works out what the whole run will store while
+it is still running.  While rsync is still finding files (ir-chk) the
+count found grows, so early projections err low rather than high.
+"""
+
+import re
+from enum import Enum
+from collections import namedtuple
+
+RSYNC_OUTPUT_OPTIONS = "--out-format='%i %l %n%L' --stats --info=progress2"
+
+# YXcstpoguax itemize string, or *deleting, then the length then the name
+ITEMIZE_RE = re.compile(r'^([<>ch.*][fdLDSp]\S*)\s+(\d+) (.*)$')
+# the end of a progress line, files still to check of those found so far
+PROGRESS_RE = re.compile(r'\((?:xfr#\d+, )?(ir|to)-chk=(\d+)/(\d+)\)\s*$')
+# how far through the files a run has to be before its size is projected
+PROJECTION_MIN_FRACTION = 0.1
+
+
+class RsyncChange(Enum):
+    NEW = 1
+    CHANGED = 2
+    DELETED = 3
+    HARDLINKED = 4
+    UNCHANGED = 5
+    DIRECTORY = 6
+    SYMLINK = 7
+
+
+RsyncEvent = namedtuple('RsyncEvent', ['change', 'path', 'size', 'itemize'])
+
+# --stats labels and the RsyncStats fields they fill
+STATS_FIELDS = [
+    ("Number of files", 'files'),
+    ("Number of created files", 'created'),
+    ("Number of deleted files", 'deleted'),
+    ("Number of regular files transferred", 'transferred'),
+    ("Total file size", 'total_size'),
+    ("Total transferred file size", 'transferred_size'),
+    ("Literal data", 'literal_data'),
+    ("Matched data", 'matched_data'),
+    ("File list size", 'file_list_size'),
+    ("Total bytes sent", 'bytes_sent'),
+    ("Total bytes received", 'bytes_received'),
+]
+
+RsyncStats = namedtuple('RsyncStats', [field for _label, field in STATS_FIELDS])
+
+
+def _number(text):
+    """the leading number of a --stats value, '1,234 bytes' -> 1234"""
+    match = re.match(r'\s*([\d,.]+)', text)
+    if not match:
+        return 0
+    try:
+        return int(match.group(1).replace(',', '').split('.')[0])
+    except ValueError:
+        return 0
+
+
+def parseItemized(line):
+    """turn one itemized output line into an RsyncEvent, or None"""
+    match = ITEMIZE_RE.match(line)
+    if not match:
+        return None
+
+    itemize, size, path = match.group(1), int(match.group(2)), match.group(3)
+    update, kind, attrs = itemize[0], itemize[1], itemize[2:]
+
+    if itemize.startswith('*deleting'):
+        change = RsyncChange.DELETED
+    elif update == 'h':
+        change = RsyncChange.HARDLINKED
+        path = path.split(' => ')[0]
+    elif kind == 'd':
+        change = RsyncChange.DIRECTORY
+    elif kind == 'L':
+        change = RsyncChange.SYMLINK
+        path = path.split(' -> ')[0]
+    elif update == '.':
+        change = RsyncChange.UNCHANGED
+    elif attrs and attrs.strip('+') == '':
+        change = RsyncChange.NEW
+    else:
+        change = RsyncChange.CHANGED
+
+    return RsyncEvent(change, path, size, itemize)
+
+
+class RsyncParser():
+    """consume rsync output a line at a time"""
+
+    def __init__(self):
+        """"""
+        self.listeners = []
+        self.values = {}
+        self.counts = {change: 0 for change in RsyncChange}
+        self.bytes = {change: 0 for change in RsyncChange}
+        self.stats = None
+        # files still to check, and found so far, from the progress lines
+        self.to_check = 0
+        self.found = 0
+
+    def addListener(self, listener):
+        """listener(event) is called for every RsyncEvent as it is parsed"""
+        self.listeners.append(listener)
+
+    def feed(self, line, is_stderr=False):
+        """parse one line of output"""
+        if is_stderr:
+            return
+
+        event = parseItemized(line)
+        if event:
+            self.counts[event.change] += 1
+            self.bytes[event.change] += event.size
+            for listener in self.listeners:
+                listener(event)
+            return
+
+        progress = PROGRESS_RE.search(line)
+        if progress:
+            self.to_check, self.found = int(progress.group(2)), int(progress.group(3))
+            return
+
+        label, sep, value = line.partition(':')
+        if sep:
+            for stats_label, field in STATS_FIELDS:
+                if label.strip() == stats_label:
+                    self.values[field] = _number(value)
+
+    def storedBytes(self):
+        """bytes of new and changed files seen so far, ie. what will need storing"""
+        return self.bytes[RsyncChange.NEW] + self.bytes[RsyncChange.CHANGED]
+
+    def progress(self):
+        """the fraction of the files found so far that have been checked"""
+        if not self.found:
+            return 0.0
+        return (self.found - self.to_check) / self.found
+
+    def projectedBytes(self):
+        """what the whole run is expected to store, from what it has stored
+        so far and how far through the files it is. None until it is far
+        enough through to say.
+        """
+        progress = self.progress()
+        if progress < PROJECTION_MIN_FRACTION:
+            return None
+        return int(self.storedBytes() / progress)
+
+    def finish(self):
+        """the RsyncStats from the --stats block, None if it was not seen"""
+        if self.values:
+            self.stats = RsyncStats(**{field: self.values.get(field, 0)
+                                       for _label, field in STATS_FIELDS})
+        return self.stats
+
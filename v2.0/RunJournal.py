@@ -0,0 +1,180 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+RunJournal
+
+Which parts of a backup run have finished, so a run that dies half way is
+picked up where it stopped rather than walking every source again.
+
+- a unit is a backup source, or one shard or folder pass of a source that
+  ParallelRsyncMethod splits up.  Each records the result it finished with
+  and the mtime its folder had when it started
+- the journal is kept in the settings folder, written after every unit, and
+  mirrored to the server next to WORKING at most every MIRROR_SECONDS and at
+  the end of each source.  The mirror covers a settings folder that was lost
+  or restored, the newer of the two is used
+- it only describes WORKING as it was built on the latest backup, so it is
+  used when the server still has WORKING and the latest backup is the one
+  the journal was started on.  finalize removes the server's copy and
+  clear() the client's
+- a retry skips a unit that finished successfully once it is checked, its
+  folder must have the same mtime, so nothing was added to it or removed
+  from it at the top since, and it must be in WORKING on the server.  All
+  of them are looked for on the server in one request
+
+Anything changed deeper in a skipped unit since it finished is left for the
+next backup, as a change made while rsync is past it would be.
+"""
+
+import os
+import json
+import time
+import threading
+
+from CrashPlanError import CrashPlanError
+
+RUN_JOURNAL_FILE = "run-journal.json"
+MIRROR_SECONDS = 60
+SUCCESS = "SUCCESS"
+
+
+def unitTime(path):
+    """the mtime of a unit's folder, None if it has gone"""
+    try:
+        return os.lstat(path).st_mtime
+    except OSError:
+        return None
+
+
+class RunJournal():
+    """the units of a backup run that have finished"""
+
+    def __init__(self, settings_dir, comms, log):
+        """"""
+        self.filename = os.path.join(settings_dir, RUN_JOURNAL_FILE)
+        self.comms = comms
+        self.log = log
+        self.journal = self._new("")
+        self.mirrored = 0
+        # shards finish on the workers' threads
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _new(latest):
+        """an empty journal for a run on the backup latest"""
+        return {'started': time.strftime("%Y-%m-%d-%H%M%S"), 'latest': latest, 'updated': 0, 'sources': {}}
+
+    def _readLocal(self):
+        """the client's copy, None if there is none"""
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r') as fp:
+                    return json.load(fp)
+            except ValueError:
+                pass
+        return None
+
+    def begin(self, latest):
+        """carry on with the journal of an interrupted run into the same
+        WORKING, or start a new one. returns the number of finished units
+        that are to be skipped.
+        """
+        self.journal = self._new(latest)
+        if not self.comms.resumed:
+            self._write()
+            return 0
+
+        candidates = [self._readLocal()]
+        try:
+            candidates.append(self.comms.runJournal())
+        except CrashPlanError as exc:
+            self.log.error(exc)
+        candidates = [journal for journal in candidates
+                      if journal and journal.get('latest') == latest and 'sources' in journal]
+        if candidates:
+            self.journal = max(candidates, key=lambda journal: journal['updated'])
+            self._verifyPresent()
+        self._write()
+
+        finished = sum(1 for _src, _key, unit in self._units() if unit['result'] == SUCCESS)
+        if finished:
+            self.log.info("RunJournal - carrying on the run started %s, %d units finished"
+                          % (self.journal['started'], finished))
+        return finished
+
+    def _units(self):
+        """(src, shard key or None, unit) for every unit in the journal"""
+        for src, source in self.journal['sources'].items():
+            yield src, None, source
+            for key, unit in source.get('shards', {}).items():
+                yield src, key, unit
+
+    def _verifyPresent(self):
+        """forget the finished units that are not in WORKING on the server"""
+        finished = [(src, key, unit) for src, key, unit in self._units() if unit['result'] == SUCCESS]
+        if not finished:
+            return
+        try:
+            present = set(self.comms.workingPaths([unit['path'] for _src, _key, unit in finished]))
+        except CrashPlanError as exc:
+            self.log.error(exc)
+            present = set()
+        for src, key, unit in finished:
+            if unit['path'] in present:
+                continue
+            self.log.info("RunJournal - %s is not in WORKING, it is backed up again" % unit['path'])
+            if key is None:
+                self.journal['sources'][src]['result'] = None
+            else:
+                del self.journal['sources'][src]['shards'][key]
+
+    def finished(self, src, mtime, shard=None):
+        """did the unit finish successfully with its folder as it is now"""
+        with self.lock:
+            source = self.journal['sources'].get(src)
+            unit = source if shard is None or source is None else source.get('shards', {}).get(shard)
+            return (unit is not None and unit['result'] == SUCCESS
+                    and mtime is not None and unit['mtime'] == mtime)
+
+    # pylint: disable=too-many-arguments
+    def record(self, src, result, mtime, path, shard=None):
+        """a unit has finished with result, the name of one of the
+        CrashPlanErrorCodes. path is where it is in WORKING. the end of a
+        source is mirrored to the server at once.
+        """
+        unit = {'result': result, 'mtime': mtime, 'path': path, 'date': time.strftime("%Y-%m-%d-%H%M%S")}
+        with self.lock:
+            source = self.journal['sources'].setdefault(src, {'result': None, 'mtime': None, 'path': path})
+            if shard is None:
+                source.update(unit)
+            else:
+                source.setdefault('shards', {})[shard] = unit
+            self.journal['updated'] = time.time()
+            self._write()
+            if shard is None or time.time() - self.mirrored >= MIRROR_SECONDS:
+                self._mirror()
+
+    def _write(self):
+        """write the client's copy"""
+        with open(self.filename + ".tmp", 'w') as fp:
+            fp.write(json.dumps(self.journal, indent=1))
+        os.rename(self.filename + ".tmp", self.filename)
+
+    def _mirror(self):
+        """copy the journal to the server, a failure is not fatal, there is
+        still the client's copy
+        """
+        self.mirrored = time.time()
+        try:
+            self.comms.putRunJournal(self.journal)
+        except CrashPlanError as exc:
+            self.log.error(exc)
+
+    def clear(self):
+        """the run has completed, WORKING is a backup now"""
+        self.journal = self._new("")
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
@@ -21,10 +21,55 @@ default_settings_json = """
     "exclude-folders": "lost+found,Network Trash Folder,Temporary Items,Saved Application State,Library,Parallels,VirtualBoxVMs,VirtualBox VMs",
     "debug-level": 0,
     "settings-dir": ".myocp",
-    "maximum-used-percent" : 90
+    "maximum-used-percent" : 90,
+    "bandwidth-limit": 2500,
+    "rsync-workers": 1,
+    "prune-workers": 8,
+    "prune-max-ops": 0,
+    "dedupe-after-backup": false,
+    "dedupe-workers": 4,
+    "backup-method": "rsync",
+    "journal-workers": 8,
+    "journal-full-days": 7,
+    "continuous-interval": 300,
+    "continuous-quiet": 10,
+    "continuous-max-watches": 0,
+    "space-watchdog-mb": 2048,
+    "space-watchdog-interval": 30,
+    "link-dest-max": 2,
+    "partial-max-days": 7,
+    "range-split-mb": 4096,
+    "range-streams": 4,
+    "block-files": "",
+    "block-size-kb": 1024
 }
 """
 
+# settings added since the first release. they are not required in the
+# settings file and take these values when missing.
+optional_settings = {
+    "bandwidth-limit": 2500,
+    "rsync-workers": 1,
+    "prune-workers": 8,
+    "prune-max-ops": 0,
+    "dedupe-after-backup": False,
+    "dedupe-workers": 4,
+    "backup-method": "rsync",
+    "journal-workers": 8,
+    "journal-full-days": 7,
+    "continuous-interval": 300,
+    "continuous-quiet": 10,
+    "continuous-max-watches": 0,
+    "space-watchdog-mb": 2048,
+    "space-watchdog-interval": 30,
+    "link-dest-max": 2,
+    "partial-max-days": 7,
+    "range-split-mb": 4096,
+    "range-streams": 4,
+    "block-files": "",
+    "block-size-kb": 1024,
+}
+
 
 class Settings():
     """Settings object"""
@@ -100,6 +145,12 @@ class Settings():
             raise CrashPlanError("ERROR(Settings.verify(): Problems verifying settings file.")
 
         else:
+            for key, val in optional_settings.items():
+                self.settings.setdefault(key, val)
+
+            if self.settings['backup-method'] not in ('rsync', 'chunk', 'journal'):
+                raise CrashPlanError("ERROR(Settings.verify(): backup-method must be rsync, chunk or journal.")
+
             self.settings['settings-dir'] = os.path.join(os.environ['HOME'], self.settings['settings-dir'])
             os.makedirs(self.settings['settings-dir'], mode=0o755, exist_ok=True)
 
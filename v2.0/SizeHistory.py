@@ -0,0 +1,74 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+SizeHistory
+
+How well the size of each backup was predicted, kept in the settings folder
+so every host calibrates its own estimates.
+
+Each completed backup records
+- predicted, the bytes the dry run or the local estimate said it would store
+- stored, the bytes the new backup holds on its own on the server, in
+  blocks, so compression and hard links on the server are accounted for
+- transferred, the bytes rsync sent
+- decrease, how far the server's free space fell during the run, which
+  pruning and the reclaimer also move, so it is kept for reference only
+
+The calibration factor is the CALIBRATION_QUANTILE quantile of stored over
+predicted for the last HISTORY_RUNS runs big enough to say something.  The
+upper quartile rather than the median keeps most runs from being under
+estimated, a backup that runs out of space half way costs more than a
+backup pruned a little early.  Until there are CALIBRATION_MIN_RUNS runs the
+factor is 1.
+"""
+
+import os
+import json
+import time
+
+SIZE_HISTORY_FILE = "size-history.json"
+HISTORY_RUNS = 30
+CALIBRATION_MIN_RUNS = 3
+CALIBRATION_MIN_BYTES = 64 * 1024 * 1024
+CALIBRATION_QUANTILE = 0.75
+CALIBRATION_LIMITS = (0.05, 4.0)
+
+
+class SizeHistory():
+    """predicted against actual backup sizes"""
+
+    def __init__(self, settings_dir):
+        """"""
+        self.filename = os.path.join(settings_dir, SIZE_HISTORY_FILE)
+        self.runs = []
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r') as fp:
+                    self.runs = json.load(fp)
+            except ValueError:
+                self.runs = []
+
+    def record(self, predicted, stored, transferred, decrease):
+        """add a completed backup, all in bytes"""
+        self.runs.append({'date': time.strftime("%Y-%m-%d-%H%M%S"), 'predicted': int(predicted),
+                          'stored': stored, 'transferred': transferred, 'decrease': decrease})
+        self.runs = self.runs[-HISTORY_RUNS:]
+        with open(self.filename + ".tmp", 'w') as fp:
+            fp.write(json.dumps(self.runs, indent=1))
+        os.rename(self.filename + ".tmp", self.filename)
+
+    def factor(self):
+        """what to multiply an estimate by for the space it will really take"""
+        ratios = sorted(run['stored'] / run['predicted'] for run in self.runs
+                        if run.get('stored') is not None and run['predicted'] >= CALIBRATION_MIN_BYTES)
+        if len(ratios) < CALIBRATION_MIN_RUNS:
+            return 1.0
+        ratio = ratios[min(len(ratios) - 1, int(len(ratios) * CALIBRATION_QUANTILE))]
+        return min(max(ratio, CALIBRATION_LIMITS[0]), CALIBRATION_LIMITS[1])
+
+    def calibrate(self, predicted):
+        """the bytes a backup predicted to store predicted will take"""
+        return int(predicted * self.factor())
+
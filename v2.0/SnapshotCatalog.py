@@ -0,0 +1,318 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+SnapshotCatalog - server side
+
+A per host SQLite catalog of every snapshot and every file in it, kept in
+<backup-destination>/<local-hostname>/.catalog.db next to .metadata, so
+questions about history are an indexed lookup instead of a walk of the hard
+link trees.
+
+Files are stored as versions: a row per path, inode, size and mtime and the
+range of snapshots, first to last, it was unchanged in.  A file that never
+changes is one row however many snapshots hold it, and a path that is still
+present in the newest snapshot has no last yet.  Paths are stored once in
+their own table, with their parent folder, and referenced by id.
+
+The catalog is brought up to date after each run from the rsync itemized
+output rather than a rescan.  Every path rsync reported is looked at in the
+new snapshot:
+- a file with a different inode from the open version is a new version,
+  with --link-dest anything unchanged keeps its inode
+- a folder whose mtime differs from the open version had something added or
+  removed, its names are listed and any open children that have gone are
+  closed, folders and all
+- *deleting lines close the path and everything under it
+Anything not reported is unchanged and stays open.  When the change stream
+is not complete, a resumed run or no catalog of the previous backup, the new
+snapshot is walked and compared instead, and the client does not keep the
+paths at all.
+
+Only the standard library is used, this runs under the server agent.
+"""
+
+import os
+import stat
+import sqlite3
+
+CATALOG_DB = ".catalog.db"
+QUERY_LIMIT = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT UNIQUE NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0,
+    files INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER NOT NULL,
+    path TEXT UNIQUE NOT NULL
+);
+CREATE INDEX IF NOT EXISTS paths_parent ON paths (parent);
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    path INTEGER NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER,
+    kind TEXT NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS versions_path ON versions (path, last);
+CREATE INDEX IF NOT EXISTS versions_ino ON versions (ino);
+CREATE INDEX IF NOT EXISTS versions_first ON versions (first);
+CREATE INDEX IF NOT EXISTS versions_last ON versions (last);
+"""
+
+
+def fileKind(mode):
+    """'d', 'l' or 'f' for a folder, symlink or anything else"""
+    if stat.S_ISDIR(mode):
+        return 'd'
+    if stat.S_ISLNK(mode):
+        return 'l'
+    return 'f'
+
+
+def prefixRange(path):
+    """the [low, high) range of paths strictly under path"""
+    return path + '/', path + chr(ord('/') + 1)
+
+
+class SnapshotCatalog():
+    """the catalog database of one host's backup folder"""
+
+    def __init__(self, root):
+        """"""
+        self.root = root
+        self.db = sqlite3.connect(os.path.join(root, CATALOG_DB))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        """"""
+        self.db.close()
+
+    def snapshot(self, name):
+        """(id, complete) of a snapshot, None if it is not catalogued"""
+        return self.db.execute("SELECT id, complete FROM snapshots WHERE name = ?", (name,)).fetchone()
+
+    def latest(self):
+        """(id, name) of the newest complete snapshot, None if there isn't one"""
+        return self.db.execute("""SELECT id, name FROM snapshots WHERE complete = 1
+                                  ORDER BY id DESC LIMIT 1""").fetchone()
+
+    def _pathId(self, path):
+        """the id of a path, adding it if it is new"""
+        row = self.db.execute("SELECT id FROM paths WHERE path = ?", (path,)).fetchone()
+        if row:
+            return row[0]
+        parent = self._pathId(os.path.dirname(path)) if os.path.dirname(path) else 0
+        return self.db.execute("INSERT INTO paths (parent, path) VALUES (?, ?)",
+                               (parent, path)).lastrowid
+
+    def _open(self, path):
+        """(version id, kind, ino, mtime) of the open version of a path"""
+        return self.db.execute("""SELECT versions.id, kind, ino, mtime FROM versions
+                                  JOIN paths ON paths.id = versions.path
+                                  WHERE paths.path = ? AND last IS NULL""", (path,)).fetchone()
+
+    def begin(self, name, previous):
+        """start cataloguing snapshot name. returns its id and whether the
+        change stream can be used, ie. previous is the newest complete
+        snapshot in the catalog.
+        """
+        row = self.snapshot(name)
+        if row:
+            return row[0], not row[1]
+
+        latest = self.latest()
+        with self.db:
+            snap = self.db.execute("INSERT INTO snapshots (name) VALUES (?)", (name,)).lastrowid
+        return snap, latest is not None and latest[1] == previous
+
+    def _closeVersion(self, version, last):
+        """close one version at snapshot id last"""
+        self.db.execute("UPDATE versions SET last = ? WHERE id = ?", (last, version))
+
+    def _closeTree(self, path, last):
+        """close the open versions of path and everything under it"""
+        low, high = prefixRange(path)
+        self.db.execute("""UPDATE versions SET last = ? WHERE last IS NULL AND path IN
+                           (SELECT id FROM paths WHERE path = ? OR (path >= ? AND path < ?))""",
+                        (last, path, low, high))
+
+    def _record(self, snap, path, st, current=None):
+        """open a new version of path from its lstat, closing the current one"""
+        if current and current[1] == 'd' and not stat.S_ISDIR(st.st_mode):
+            self._closeTree(path, snap - 1)
+        elif current:
+            self._closeVersion(current[0], snap - 1)
+        self.db.execute("""INSERT INTO versions (path, first, kind, ino, size, mtime)
+                           VALUES (?, ?, ?, ?, ?, ?)""",
+                        (self._pathId(path), snap, fileKind(st.st_mode), st.st_ino,
+                         0 if stat.S_ISDIR(st.st_mode) else st.st_size, int(st.st_mtime)))
+
+    def applyChanges(self, name, updated, deleted):
+        """apply one batch of paths rsync reported for snapshot name"""
+        snap, _stream = self.begin(name, None)
+        base = os.path.join(self.root, name)
+        previous = snap - 1
+
+        with self.db:
+            for path in deleted:
+                self._closeTree(path.rstrip('/'), previous)
+
+            for path in updated:
+                path = path.rstrip('/')
+                if path in ('', '.'):
+                    continue
+                try:
+                    st = os.lstat(os.path.join(base, path))
+                except OSError:
+                    continue
+                current = self._open(path)
+                if stat.S_ISDIR(st.st_mode):
+                    if current and current[1] == 'd' and current[3] == int(st.st_mtime):
+                        continue
+                    self._record(snap, path, st, current)
+                    self._closeVanished(base, path, previous)
+                elif not current or current[2] != st.st_ino or current[3] != int(st.st_mtime):
+                    self._record(snap, path, st, current)
+
+    def _closeVanished(self, base, path, previous):
+        """close the open children of folder path that are no longer in it"""
+        try:
+            names = set(os.listdir(os.path.join(base, path)))
+        except OSError:
+            return
+        children = self.db.execute("""SELECT paths.path FROM paths
+                                      JOIN versions ON versions.path = paths.id
+                                      WHERE paths.parent = ? AND last IS NULL""",
+                                   (self._pathId(path),)).fetchall()
+        for (child,) in children:
+            if os.path.basename(child) not in names:
+                self._closeTree(child, previous)
+
+    def rescan(self, name):
+        """catalog snapshot name by walking it and comparing every path with
+        the open versions, for when the change stream cannot be trusted
+        """
+        snap, _stream = self.begin(name, None)
+        base = os.path.join(self.root, name)
+        previous = snap - 1
+        seen = set()
+
+        with self.db:
+            for dirpath, dirs, files in os.walk(base):
+                for entry in dirs + files:
+                    full = os.path.join(dirpath, entry)
+                    path = os.path.relpath(full, base)
+                    try:
+                        st = os.lstat(full)
+                    except OSError:
+                        continue
+                    current = self._open(path)
+                    kind = fileKind(st.st_mode)
+                    if not current or current[1] != kind or current[3] != int(st.st_mtime) \
+                       or (kind != 'd' and current[2] != st.st_ino):
+                        self._record(snap, path, st, current)
+                    else:
+                        seen.add(current[0])
+
+            for (version,) in self.db.execute(
+                    "SELECT id FROM versions WHERE last IS NULL AND first < ?", (snap,)).fetchall():
+                if version not in seen:
+                    self._closeVersion(version, previous)
+
+    def finish(self, name):
+        """mark snapshot name complete and record its totals"""
+        snap, _stream = self.begin(name, None)
+        files, size = self.db.execute("""SELECT count(*), coalesce(sum(size), 0) FROM versions
+                                         WHERE last IS NULL AND kind != 'd'""").fetchone()
+        with self.db:
+            self.db.execute("UPDATE snapshots SET complete = 1, files = ?, bytes = ? WHERE id = ?",
+                            (files, size, snap))
+        return {'files': files, 'bytes': size}
+
+    def drop(self, current):
+        """forget the snapshots not in the list current, and the versions
+        that were only in them
+        """
+        current = set(current)
+        gone = [row for row in self.db.execute("SELECT id, name FROM snapshots")
+                if row[1] not in current]
+        if not gone:
+            return []
+        with self.db:
+            self.db.executemany("DELETE FROM snapshots WHERE id = ?", [(row[0],) for row in gone])
+            self.db.execute("""DELETE FROM versions WHERE last IS NOT NULL AND NOT EXISTS
+                               (SELECT 1 FROM snapshots
+                                WHERE snapshots.id BETWEEN versions.first AND versions.last)""")
+        return [row[1] for row in gone]
+
+    # queries
+
+    def _names(self):
+        """{snapshot id: name} of the snapshots still present"""
+        return dict(self.db.execute("SELECT id, name FROM snapshots"))
+
+    def _describe(self, rows, names):
+        """turn version rows into dicts naming the snapshots holding them"""
+        ids = sorted(names)
+        result = []
+        for path, first, last, kind, ino, size, mtime in rows:
+            held = [names[i] for i in ids if i >= first and (last is None or i <= last)]
+            result.append({'path': path, 'kind': kind, 'ino': ino, 'size': size,
+                           'mtime': mtime, 'snapshots': held})
+        return result
+
+    def snapshots(self):
+        """every snapshot with its file count and size"""
+        return [{'name': name, 'files': files, 'bytes': size, 'complete': bool(complete)}
+                for name, files, size, complete in self.db.execute(
+                    "SELECT name, files, bytes, complete FROM snapshots ORDER BY id")]
+
+    def history(self, path, limit=QUERY_LIMIT):
+        """every version of path, and of anything under it"""
+        path = path.strip('/')
+        low, high = prefixRange(path)
+        rows = self.db.execute("""SELECT paths.path, first, last, kind, ino, size, mtime
+                                  FROM paths JOIN versions ON versions.path = paths.id
+                                  WHERE paths.path = ? OR (paths.path >= ? AND paths.path < ?)
+                                  ORDER BY paths.path, first LIMIT ?""",
+                               (path, low, high, limit)).fetchall()
+        return self._describe(rows, self._names())
+
+    def inode(self, ino, limit=QUERY_LIMIT):
+        """every path an inode has been seen at"""
+        rows = self.db.execute("""SELECT paths.path, first, last, kind, ino, size, mtime
+                                  FROM versions JOIN paths ON paths.id = versions.path
+                                  WHERE ino = ? LIMIT ?""", (ino, limit)).fetchall()
+        return self._describe(rows, self._names())
+
+    def changes(self, name, limit=QUERY_LIMIT):
+        """what changed in snapshot name since the snapshot before it"""
+        row = self.snapshot(name)
+        if not row:
+            raise ValueError("%s is not in the catalog" % name)
+        snap = row[0]
+        previous = self.db.execute("SELECT max(id) FROM snapshots WHERE id < ?", (snap,)).fetchone()[0]
+
+        added = [path for (path,) in self.db.execute(
+            """SELECT paths.path FROM versions JOIN paths ON paths.id = versions.path
+               WHERE first = ? AND kind != 'd' ORDER BY paths.path LIMIT ?""", (snap, limit))]
+        removed = []
+        if previous is not None:
+            removed = [path for (path,) in self.db.execute(
+                """SELECT paths.path FROM versions JOIN paths ON paths.id = versions.path
+                   WHERE last >= ? AND last < ? AND kind != 'd' AND NOT EXISTS
+                   (SELECT 1 FROM versions AS v WHERE v.path = versions.path AND v.first = ?)
+                   ORDER BY paths.path LIMIT ?""", (previous, snap, snap, limit))]
+        return {'changed': added, 'removed': removed}
+
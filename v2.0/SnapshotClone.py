@@ -0,0 +1,148 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+SnapshotClone - server side
+
+Make a new snapshot folder that is a hard link farm of an existing one, the
+job createNextBackupFolder() did in the server based v0.5 script.
+
+That walked LATEST/ with os.walk, called os.stat three times per file, linked
+each file by full path and checked islink on every prefix of every folder.
+Here
+- folders are read with os.scandir, whose entries carry the type and, where
+  a stat is needed, cache it
+- files and symlinks are linked with linkat() relative to open folder fds, so
+  no path is resolved more than once
+- a hard link shares the inode, so there is nothing to copy for files; only
+  folders need their mode and times set, once their contents are complete
+- folders are handed out to a pool of worker threads, the system calls drop
+  the GIL so the threads really do run in parallel
+
+Only the standard library is used, this runs under the server agent.
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+CLONE_WORKERS = 8
+DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+
+
+class CloneStats():
+    """counts kept while cloning"""
+
+    def __init__(self):
+        """"""
+        self.files = 0
+        self.dirs = 0
+        self.errors = []
+        self.started = time.time()
+        self.seconds = 0.0
+
+    def rate(self):
+        """entries cloned per second"""
+        return (self.files + self.dirs) / self.seconds if self.seconds else 0.0
+
+    def asDict(self):
+        """json friendly summary"""
+        return {'files': self.files, 'dirs': self.dirs, 'errors': len(self.errors),
+                'seconds': round(self.seconds, 3), 'rate': round(self.rate(), 1)}
+
+
+class SnapshotClone():
+    """clone one snapshot folder into another with hard links"""
+
+    def __init__(self, src, dest, workers=CLONE_WORKERS):
+        """"""
+        self.src = src
+        self.dest = dest
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.stats = CloneStats()
+        # (relative path, stat) of every folder, its times are set last
+        self.folders = []
+
+    def _cloneDir(self, relpath):
+        """link every file in one folder, create its sub folders and return
+        them so they can be handed to the pool
+        """
+        subdirs = []
+        files = 0
+        errors = []
+
+        try:
+            src_fd = os.open(os.path.join(self.src, relpath), DIR_FLAGS)
+        except OSError as exc:
+            with self.lock:
+                self.stats.errors.append(f"{relpath}: {exc}")
+            return subdirs
+
+        try:
+            dest_fd = os.open(os.path.join(self.dest, relpath), DIR_FLAGS)
+            try:
+                with os.scandir(src_fd) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                st = entry.stat(follow_symlinks=False)
+                                os.mkdir(entry.name, 0o700, dir_fd=dest_fd)
+                                subdirs.append((os.path.join(relpath, entry.name), st))
+                            else:
+                                os.link(entry.name, entry.name, src_dir_fd=src_fd,
+                                        dst_dir_fd=dest_fd, follow_symlinks=False)
+                                files += 1
+                        except OSError as exc:
+                            errors.append(f"{os.path.join(relpath, entry.name)}: {exc}")
+            finally:
+                os.close(dest_fd)
+        finally:
+            os.close(src_fd)
+
+        with self.lock:
+            self.stats.files += files
+            self.stats.dirs += len(subdirs)
+            self.stats.errors += errors
+            self.folders += subdirs
+
+        return [sub for sub, _st in subdirs]
+
+    def _finishFolders(self):
+        """set the mode and times of the folders, deepest first, now that
+        adding their entries can no longer change them
+        """
+        self.folders.sort(key=lambda folder: folder[0].count(os.sep), reverse=True)
+        for relpath, st in self.folders:
+            path = os.path.join(self.dest, relpath)
+            try:
+                os.chmod(path, st.st_mode & 0o7777)
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            except OSError as exc:
+                self.stats.errors.append(f"{relpath}: {exc}")
+
+    def clone(self):
+        """clone the whole tree, return the CloneStats"""
+        root = os.stat(self.src)
+        os.mkdir(self.dest, 0o700)
+        self.folders = [('', root)]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {pool.submit(self._cloneDir, '')}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for sub in future.result():
+                        pending.add(pool.submit(self._cloneDir, sub))
+
+        self._finishFolders()
+        self.stats.seconds = time.time() - self.stats.started
+        return self.stats
+
+
+def cloneSnapshot(src, dest, workers=CLONE_WORKERS):
+    """clone snapshot src to the new folder dest, return the CloneStats"""
+    return SnapshotClone(src, dest, workers).clone()
+
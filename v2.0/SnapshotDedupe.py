@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+SnapshotDedupe - server side
+
+  python3 SnapshotDedupe.py [-w workers] [-m min-size] [--ignore-times] <backup-destination>
+
+--link-dest only shares a file with the same path in the previous backup of
+the same host.  This pass finds identical files anywhere in the backup
+destination, across backups and across hosts, and replaces the copies with
+hard links to one canonical file.
+
+- the backups of every host are walked oldest first, WORKING and the trash
+  are left alone
+- file contents are hashed by a pool of processes; hashes are cached by
+  (device, inode, size, mtime) in <backup-destination>/.dedupe.db, so an inode
+  is read once however many backups link to it and never again on later runs
+- files are only linked together when their size, mode, owner and mtime also
+  match, as rsync would, otherwise the next --link-dest run would see the
+  difference and send the file again.  --ignore-times drops the mtime check
+  at that cost
+- a copy is replaced by linking the canonical file to a temporary name in
+  the same folder and renaming it over the copy, so the path never goes
+  missing
+- backups that have been done are recorded, an interrupted pass picks up
+  where it stopped and later passes only walk new backups
+- the bytes reclaimed are counted as the last link to each copy goes
+
+Changing which inodes backups share makes the usage accounting of the hosts
+affected stale, their .usage.db is removed to be rebuilt.
+
+Only the standard library is used, this runs on the server.
+"""
+
+import os
+import sys
+import json
+import stat
+import time
+import fcntl
+import getopt
+import hashlib
+import sqlite3
+from multiprocessing import Pool
+
+DEDUPE_DB = ".dedupe.db"
+DEDUPE_LOCK = ".dedupe.lock"
+DEDUPE_REPORT = ".dedupe.json"
+DEDUPE_WORKERS = 4
+DEDUPE_MIN_SIZE = 4096
+HASH_CHUNK = 1024 * 1024
+COMMIT_EVERY = 1000
+USAGE_DB = ".usage.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS canonical (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS done (
+    backup TEXT PRIMARY KEY
+) WITHOUT ROWID;
+"""
+
+
+def hashFile(path):
+    """(path, sha256 hex digest) of a file's contents, digest None if unreadable"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(HASH_CHUNK), b''):
+                digest.update(block)
+    except OSError:
+        return path, None
+    return path, digest.hexdigest()
+
+
+def cachedDigest(db, st):
+    """the digest a dedupe pass has cached in db for an inode, None if it
+    has not been hashed
+    """
+    row = db.execute("SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?",
+                     (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime))).fetchone()
+    return row[0] if row else None
+
+
+class DedupeStats():
+    """counts kept during a pass"""
+
+    def __init__(self):
+        """"""
+        self.backups = 0
+        self.files = 0
+        self.hashed = 0
+        self.linked = 0
+        self.reclaimed = 0
+        self.errors = 0
+        self.started = time.time()
+
+    def asDict(self):
+        """json friendly summary"""
+        return {'backups': self.backups, 'files': self.files, 'hashed': self.hashed,
+                'linked': self.linked, 'reclaimed': self.reclaimed, 'errors': self.errors,
+                'seconds': round(time.time() - self.started, 3)}
+
+
+class SnapshotDedupe():
+    """hard link identical files across every backup in a destination"""
+
+    def __init__(self, destination, workers=DEDUPE_WORKERS, min_size=DEDUPE_MIN_SIZE,
+                 ignore_times=False):
+        """"""
+        self.destination = destination
+        self.workers = workers
+        self.min_size = min_size
+        self.ignore_times = ignore_times
+        self.db = sqlite3.connect(os.path.join(destination, DEDUPE_DB))
+        self.db.executescript(SCHEMA)
+        self.stats = DedupeStats()
+        self.changed_hosts = set()
+
+    def close(self):
+        """"""
+        self.db.close()
+
+    def backups(self):
+        """(host, backup path) of every completed backup, oldest first"""
+        found = []
+        for host in sorted(os.listdir(self.destination)):
+            hostdir = os.path.join(self.destination, host)
+            if host.startswith('.') or not os.path.isdir(hostdir):
+                continue
+            for name in os.listdir(hostdir):
+                if name.startswith('20') and os.path.isdir(os.path.join(hostdir, name)):
+                    found.append((name, host, os.path.join(hostdir, name)))
+        return [(host, path) for _name, host, path in sorted(found)]
+
+    def _key(self, digest, st):
+        """what must match for two files to become one inode"""
+        key = [digest, st.st_size, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid]
+        if not self.ignore_times:
+            key.append(int(st.st_mtime))
+        return json.dumps(key)
+
+    def _candidates(self, path):
+        """the regular files worth looking at in one backup, with their lstat"""
+        for dirpath, _dirs, files in os.walk(path):
+            for name in files:
+                full = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(full)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode) and st.st_size >= self.min_size:
+                    yield full, st
+
+    def _cached(self, st):
+        """the cached digest of an inode, None if it has not been hashed"""
+        return cachedDigest(self.db, st)
+
+    def dedupeBackup(self, host, path, pool):
+        """hash and link the files of one backup"""
+        files = {}
+        digests = {}
+        todo = []
+        for full, st in self._candidates(path):
+            files[full] = st
+            digest = self._cached(st)
+            if digest:
+                digests[full] = digest
+            else:
+                todo.append(full)
+
+        # hash each inode once, any other links to it share the result
+        inodes = {}
+        for full in todo:
+            st = files[full]
+            inodes.setdefault((st.st_dev, st.st_ino), []).append(full)
+
+        for full, digest in pool.imap_unordered(hashFile, [paths[0] for paths in inodes.values()], 16):
+            st = files[full]
+            if digest is None:
+                self.stats.errors += 1
+                continue
+            self.stats.hashed += 1
+            self.db.execute("INSERT OR REPLACE INTO hashes (dev, ino, size, mtime, digest) VALUES (?, ?, ?, ?, ?)",
+                            (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime), digest))
+            for other in inodes[(st.st_dev, st.st_ino)]:
+                digests[other] = digest
+            # keep what has been hashed if the pass is interrupted
+            if self.stats.hashed % COMMIT_EVERY == 0:
+                self.db.commit()
+        self.db.commit()
+
+        with self.db:
+            for full in sorted(digests):
+                self.stats.files += 1
+                self._link(host, full, files[full], digests[full])
+            self.db.execute("INSERT OR REPLACE INTO done (backup) VALUES (?)",
+                            (os.path.relpath(path, self.destination),))
+        self.stats.backups += 1
+
+    def _link(self, host, full, st, digest):
+        """make full a link to the canonical copy of its contents, or make it
+        the canonical copy if there is none
+        """
+        key = self._key(digest, st)
+        row = self.db.execute("SELECT path FROM canonical WHERE key = ?", (key,)).fetchone()
+        try:
+            canon = os.lstat(os.path.join(self.destination, row[0])) if row else None
+        except OSError:
+            canon = None
+
+        if canon is None or canon.st_dev != st.st_dev:
+            self.db.execute("INSERT OR REPLACE INTO canonical (key, path) VALUES (?, ?)",
+                            (key, os.path.relpath(full, self.destination)))
+            return
+        if canon.st_ino == st.st_ino:
+            return
+
+        folder = os.path.dirname(full)
+        tmp = os.path.join(folder, ".dedupe-%d.tmp" % os.getpid())
+        try:
+            times = os.lstat(folder)
+            os.link(os.path.join(self.destination, row[0]), tmp)
+        except OSError:
+            # most likely the canonical copy has run out of links, this
+            # copy takes over from it
+            self.db.execute("UPDATE canonical SET path = ? WHERE key = ?",
+                            (os.path.relpath(full, self.destination), key))
+            return
+
+        try:
+            current = os.lstat(full)
+            os.rename(tmp, full)
+        except OSError:
+            self.stats.errors += 1
+            return
+        finally:
+            # rename is a no-op if both are already the same inode
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            # the backup's folder keeps the times rsync gave it
+            os.utime(folder, ns=(times.st_atime_ns, times.st_mtime_ns))
+
+        self.stats.linked += 1
+        self.changed_hosts.add(host)
+        if current.st_nlink == 1:
+            self.stats.reclaimed += current.st_blocks * 512
+
+    def run(self):
+        """dedupe every backup not done yet, return the DedupeStats"""
+        done = {row[0] for row in self.db.execute("SELECT backup FROM done")}
+        with Pool(self.workers) as pool:
+            for host, path in self.backups():
+                if os.path.relpath(path, self.destination) not in done:
+                    self.dedupeBackup(host, path, pool)
+
+        for host in self.changed_hosts:
+            usage = os.path.join(self.destination, host, USAGE_DB)
+            if os.path.exists(usage):
+                os.unlink(usage)
+        return self.stats
+
+
+def dedupe(destination, workers=DEDUPE_WORKERS, min_size=DEDUPE_MIN_SIZE, ignore_times=False):
+    """run a dedupe pass unless one is already running and write its report
+    to .dedupe.json. returns the report, None if a pass was already running.
+    """
+    with open(os.path.join(destination, DEDUPE_LOCK), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return None
+
+        engine = SnapshotDedupe(destination, workers, min_size, ignore_times)
+        try:
+            report = engine.run().asDict()
+        finally:
+            engine.close()
+        report['finished'] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+        with open(os.path.join(destination, DEDUPE_REPORT + ".tmp"), 'w') as fp:
+            fp.write(json.dumps(report)+"\n")
+        os.rename(os.path.join(destination, DEDUPE_REPORT + ".tmp"),
+                  os.path.join(destination, DEDUPE_REPORT))
+        return report
+
+
+def main(argv):
+    """run a pass from the command line"""
+    try:
+        opts, args = getopt.getopt(argv, 'w:m:', ['ignore-times'])
+    except getopt.error as cause:
+        sys.stderr.write("%s\n" % cause)
+        args = []
+    if len(args) != 1:
+        sys.stderr.write("usage: SnapshotDedupe.py [-w workers] [-m min-size] [--ignore-times] <backup-destination>\n")
+        return 2
+
+    options = dict(opts)
+    report = dedupe(args[0], int(options.get('-w', DEDUPE_WORKERS)),
+                    int(options.get('-m', DEDUPE_MIN_SIZE)), '--ignore-times' in options)
+    if report is None:
+        sys.stderr.write("a dedupe pass is already running\n")
+        return 1
+
+    print("%(backups)d backups, %(files)d files, %(hashed)d hashed, %(linked)d linked, "
+          "%(reclaimed)d bytes reclaimed in %(seconds).1fs" % report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
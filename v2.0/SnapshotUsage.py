@@ -0,0 +1,220 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+SnapshotUsage - server side
+
+How much space each snapshot really holds, and which snapshots to remove to
+get a given amount back.
+
+Snapshots are hard link farms, so deleting one only frees the inodes that
+have no links left anywhere else; deleting the oldest and checking df again
+often frees next to nothing.  Instead every inode is recorded with its link
+count and the snapshots holding its links, in a small SQLite database next
+to the host's .metadata.  An inode can be reclaimed by removing a set of
+snapshots when every one of its links is inside that set.
+
+- the database is kept up to date incrementally: only snapshots that are new
+  since the last update are walked, snapshots that have gone are dropped
+  along with their links
+- the inodes are grouped by the set of snapshots that hold them, which for
+  backups made with --link-dest is a small number of runs of consecutive
+  snapshots, and the planner works on those groups
+- the planner picks greedily the snapshot that frees most when added to the
+  ones already picked, the oldest when that is nothing, then drops any pick
+  the target can be met without
+- backups made by the chunk method hold little more than their manifests,
+  the chunks they refer to are grouped the same way by the backups that
+  refer to them, see ChunkStore.chunkGroups
+
+Only the standard library is used, this runs under the server agent.
+"""
+
+import os
+import stat
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from ChunkStore import chunkGroups
+
+USAGE_DB = ".usage.db"
+USAGE_WORKERS = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    dirbytes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS inodes (
+    ino INTEGER PRIMARY KEY,
+    bytes INTEGER NOT NULL,
+    nlink INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS links (
+    snapshot INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (snapshot, ino)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS links_ino ON links (ino);
+"""
+
+
+def scanSnapshot(path, workers=USAGE_WORKERS):
+    """walk one snapshot, return ({ino: [bytes, nlink, count]}, folder bytes)"""
+    inodes = {}
+    dirbytes = [0]
+    lock = threading.Lock()
+
+    def scanDir(relpath):
+        """record one folder's files and return its sub folders"""
+        subdirs = []
+        found = []
+        size = 0
+        try:
+            with os.scandir(os.path.join(path, relpath)) as it:
+                for entry in it:
+                    st = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(st.st_mode):
+                        subdirs.append(os.path.join(relpath, entry.name))
+                        size += st.st_blocks * 512
+                    else:
+                        found.append((st.st_ino, st.st_blocks * 512, st.st_nlink))
+        except OSError:
+            pass
+        with lock:
+            dirbytes[0] += size
+            for ino, nbytes, nlink in found:
+                if ino in inodes:
+                    inodes[ino][2] += 1
+                else:
+                    inodes[ino] = [nbytes, nlink, 1]
+        return subdirs
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(scanDir, '')}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for sub in future.result():
+                    pending.add(pool.submit(scanDir, sub))
+
+    return inodes, dirbytes[0] + os.lstat(path).st_blocks * 512
+
+
+class SnapshotUsage():
+    """the usage database of one host's backup folder"""
+
+    def __init__(self, root, workers=USAGE_WORKERS):
+        """"""
+        self.root = root
+        self.workers = workers
+        self.db = sqlite3.connect(os.path.join(root, USAGE_DB))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        """"""
+        self.db.close()
+
+    def names(self):
+        """the snapshots in the database, oldest first"""
+        return [row[0] for row in self.db.execute("SELECT name FROM snapshots ORDER BY name")]
+
+    def update(self, current):
+        """bring the database in line with the list of snapshot names current,
+        walking only the new ones. returns the names added and dropped.
+        """
+        known = set(self.names())
+        dropped = sorted(known - set(current))
+        added = sorted(set(current) - known)
+
+        with self.db:
+            for name in dropped:
+                self._drop(name)
+
+        for name in added:
+            inodes, dirbytes = scanSnapshot(os.path.join(self.root, name), self.workers)
+            with self.db:
+                cur = self.db.execute("INSERT INTO snapshots (name, dirbytes) VALUES (?, ?)",
+                                      (name, dirbytes))
+                snap = cur.lastrowid
+                # the walk saw the current link count, which includes the
+                # links this snapshot just added to older inodes
+                self.db.executemany("INSERT OR REPLACE INTO inodes (ino, bytes, nlink) VALUES (?, ?, ?)",
+                                    ((ino, val[0], val[1]) for ino, val in inodes.items()))
+                self.db.executemany("INSERT INTO links (snapshot, ino, count) VALUES (?, ?, ?)",
+                                    ((snap, ino, val[2]) for ino, val in inodes.items()))
+
+        return added, dropped
+
+    def _drop(self, name):
+        """forget a snapshot, its links no longer count towards the inodes"""
+        row = self.db.execute("SELECT id FROM snapshots WHERE name = ?", (name,)).fetchone()
+        self.db.execute("""UPDATE inodes SET nlink = nlink -
+                           (SELECT count FROM links WHERE snapshot = ? AND links.ino = inodes.ino)
+                           WHERE ino IN (SELECT ino FROM links WHERE snapshot = ?)""", (row[0], row[0]))
+        self.db.execute("DELETE FROM links WHERE snapshot = ?", (row[0],))
+        self.db.execute("DELETE FROM inodes WHERE nlink <= 0")
+        self.db.execute("DELETE FROM snapshots WHERE id = ?", (row[0],))
+
+    def groups(self):
+        """{tuple of snapshot names: bytes} for the inodes and chunks held
+        only by snapshots, by the set of snapshots holding them. folders
+        belong to their own snapshot.
+        """
+        ids = dict(self.db.execute("SELECT id, name FROM snapshots"))
+        groups = {}
+        for holders, nbytes in self.db.execute(
+                """SELECT group_concat(links.snapshot), inodes.bytes FROM links
+                   JOIN inodes ON inodes.ino = links.ino
+                   GROUP BY links.ino HAVING sum(links.count) = inodes.nlink"""):
+            key = tuple(sorted(ids[int(i)] for i in holders.split(',')))
+            groups[key] = groups.get(key, 0) + nbytes
+        for name, dirbytes in self.db.execute("SELECT name, dirbytes FROM snapshots"):
+            groups[(name,)] = groups.get((name,), 0) + dirbytes
+        for key, nbytes in chunkGroups(os.path.dirname(self.root), os.path.basename(self.root),
+                                       ids.values()).items():
+            groups[key] = groups.get(key, 0) + nbytes
+        return groups
+
+    def exclusive(self):
+        """{snapshot name: bytes freed by removing just that snapshot}"""
+        exclusive = {name: 0 for name in self.names()}
+        for holders, nbytes in self.groups().items():
+            if len(holders) == 1:
+                exclusive[holders[0]] += nbytes
+        return exclusive
+
+
+def freedBy(groups, chosen):
+    """bytes freed by removing the set of snapshots chosen"""
+    return sum(nbytes for holders, nbytes in groups.items() if chosen.issuperset(holders))
+
+
+def planPrune(groups, candidates, target, minimum=0):
+    """pick the snapshots from candidates, oldest first, to remove to free at
+    least target bytes, and at least minimum snapshots. returns the picks,
+    oldest first, and the bytes they free together.
+    """
+    order = {name: index for index, name in enumerate(candidates)}
+    remaining = set(candidates)
+    chosen = set()
+    freed = 0
+
+    while remaining and (freed < target or len(chosen) < minimum):
+        best = max(remaining, key=lambda name: (freedBy(groups, chosen | {name}), -order[name]))
+        remaining.discard(best)
+        chosen.add(best)
+        freed = freedBy(groups, chosen)
+
+    # a later pick may have made an earlier one unnecessary
+    for name in sorted(chosen, key=order.get, reverse=True):
+        if len(chosen) > minimum and freedBy(groups, chosen - {name}) >= target:
+            chosen.discard(name)
+            freed = freedBy(groups, chosen)
+
+    return sorted(chosen, key=order.get), freed
+
@@ -0,0 +1,175 @@
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+SpaceWatchdog
+
+Watches the server's free space while a backup runs, so a backup that is
+about to fill the disk waits for room to be made rather than running out.
+
+- every space-watchdog-interval seconds the free space is read from the
+  agent, in a thread of its own
+- below space-watchdog-mb more backups are trashed to bring the free space
+  back to twice that.  Choosing them can take a while on the server, so
+  the transfer carries on meanwhile
+- if the free space is still low and the reclaimer has backups to free,
+  the running rsync processes are stopped with SIGSTOP and carry on with
+  SIGCONT once it has freed enough
+- rsync on the server gives up on a sender that has been quiet for
+  --timeout seconds, so a pause never lasts longer than PAUSE_MAX.  If
+  there is still no room by then, or nothing could be trashed, the backup
+  carries on and a disk that fills is dealt with as before
+
+While the method projects what the run will store (see projection() in
+RsyncMethod), that is checked too.  When the bytes still to come will not
+fit in the free space, counting what the reclaimer has still to free, more
+backups are trashed for them.  If that cannot make room the transfer is
+stopped there and then, rather than when the disk is full, and the backup
+ends as one that filled the disk does.
+
+Only the methods that run processes can be paused, addWatchdog() says if
+a method can.
+"""
+
+import os
+import time
+import signal
+import threading
+
+from CrashPlanError import CrashPlanError
+
+# well inside rsync's --timeout=300
+PAUSE_MAX = 240
+PAUSE_POLL = 2
+
+
+class SpaceWatchdog():
+    """pause the transfer and make room when the server's disk runs low"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, comms, log, low_water, interval, make_room, project=None):
+        """make_room(need) trashes backups to leave need bytes free.
+        project() gives the method's projection, if it has one.
+        """
+        self.comms = comms
+        self.log = log
+        self.low_water = low_water
+        self.high_water = 2 * low_water
+        self.interval = interval
+        self.make_room = make_room
+        self.project = project
+        self.procs = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.pauses = 0
+        # the transfer was stopped, it would not fit
+        self.aborted = False
+
+    def attach(self, proc):
+        """watch a process the method has started"""
+        with self.lock:
+            self.procs.add(proc)
+
+    def detach(self, proc):
+        """the process has finished"""
+        with self.lock:
+            self.procs.discard(proc)
+
+    def start(self):
+        """start watching"""
+        self.stopping.clear()
+        self.aborted = False
+        self.thread = threading.Thread(target=self._run, name="SpaceWatchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """stop watching, anything paused carries on"""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self._signal(signal.SIGCONT)
+
+    def _run(self):
+        """check the space until stopped"""
+        while not self.stopping.wait(self.interval):
+            try:
+                self.check()
+            except CrashPlanError as exc:
+                self.log.error(exc)
+
+    def _running(self):
+        """the processes still running"""
+        with self.lock:
+            return [proc for proc in self.procs if proc.poll() is None]
+
+    def _signal(self, sig):
+        """send sig to the processes still running"""
+        procs = self._running()
+        for proc in procs:
+            try:
+                os.kill(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+        return len(procs)
+
+    def check(self):
+        """look at the free space once, pausing to make room if it is low
+        and making room for what the transfer is projected to need. returns
+        True if the transfer was paused or stopped.
+        """
+        space = self.comms.space()
+        if space['free'] >= self.low_water:
+            return self._checkProjection(space)
+        if not self._running():
+            return False
+
+        self.log.info("SpaceWatchdog - %d bytes free, making room" % space['free'])
+        self.make_room(self.high_water)
+        space = self.comms.space()
+        if space['free'] >= self.low_water or not (space['pending'] or space['estimating']):
+            return False
+        if not self._signal(signal.SIGSTOP):
+            return False
+
+        self.pauses += 1
+        self.log.info("SpaceWatchdog - %d bytes free, pausing the backup while the reclaimer frees %d"
+                      % (space['free'], space['pending']))
+        started = time.time()
+        try:
+            while space['free'] < self.high_water and (space['pending'] or space['estimating']):
+                if time.time() - started >= PAUSE_MAX or self.stopping.wait(PAUSE_POLL):
+                    break
+                space = self.comms.space()
+        finally:
+            self._signal(signal.SIGCONT)
+        self.log.info("SpaceWatchdog - resuming after %d seconds with %d bytes free"
+                      % (time.time() - started, space['free']))
+        return True
+
+    def _checkProjection(self, space):
+        """make room for the bytes still to come, stop the transfer if there
+        is none to be made. returns True if it was stopped.
+        """
+        projection = self.project() if self.project else None
+        if projection is None:
+            return False
+        stored, projected = projection
+        remaining = max(0, projected - stored)
+        if space['free'] + space['pending'] >= remaining + self.low_water:
+            return False
+
+        self.log.info("SpaceWatchdog - %d more bytes are expected and %d are free, making room"
+                      % (remaining, space['free'] + space['pending']))
+        self.make_room(remaining + self.high_water)
+        space = self.comms.space()
+        if space['estimating'] or space['free'] + space['pending'] >= remaining:
+            return False
+
+        self.log.error("SpaceWatchdog - %d more bytes are expected and only %d can be made free, stopping the backup"
+                       % (remaining, space['free'] + space['pending']))
+        self.aborted = True
+        return self._signal(signal.SIGTERM) > 0
+
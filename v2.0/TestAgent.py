@@ -0,0 +1,231 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import os
+import sys
+import time
+import json
+import hashlib
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest.mock import patch
+
+from myocp_agent import Agent
+from SnapshotDelete import deleteSnapshot
+
+
+class TestAgent(unittest.TestCase):
+    """Test the server side agent"""
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.agent = Agent(self.dest, "laptop")
+        self.root = os.path.join(self.dest, "laptop")
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def test_ensure_root_and_list(self):
+        """verify the root is created and only dated folders are listed"""
+        self.assertEqual(self.agent.handle({'op': 'ensure-root'}), {'ok': True})
+        for name in ['2019-01-02-000000', '2019-01-01-000000', 'WORKING']:
+            os.mkdir(os.path.join(self.root, name))
+        reply = self.agent.handle({'op': 'list'})
+        self.assertTrue(reply['ok'])
+        self.assertTrue(reply['working'])
+        self.assertEqual(reply['backups'], [os.path.join(self.root, '2019-01-01-000000'),
+                                            os.path.join(self.root, '2019-01-02-000000')])
+
+    def test_space(self):
+        """verify space is reported in bytes"""
+        reply = self.agent.handle({'op': 'space'})
+        self.assertTrue(reply['ok'])
+        self.assertGreater(reply['total'], 0)
+        self.assertLessEqual(reply['free'], reply['total'])
+        self.assertLessEqual(reply['free'] + reply['reserved'] + reply['used'], reply['total'])
+        self.assertLessEqual(reply['inodes_free'], reply['inodes'])
+        self.assertTrue(0 <= reply['percent'] <= 100)
+
+    def test_metadata_missing(self):
+        """verify missing metadata is an empty dict"""
+        self.assertEqual(self.agent.handle({'op': 'metadata'}), {'ok': True, 'metadata': {}})
+
+    def test_finalize(self):
+        """verify finalize renames WORKING and writes the metadata"""
+        os.makedirs(os.path.join(self.root, 'WORKING'))
+        meta = {'latest-complete': '2019-01-03-000000', 'backup-today': '2019-01-03'}
+        reply = self.agent.handle({'op': 'finalize', 'datedir': '2019-01-03-000000', 'metadata': meta})
+        self.assertTrue(reply['ok'])
+        self.assertTrue(os.path.isdir(os.path.join(self.root, '2019-01-03-000000')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'WORKING')))
+        self.assertEqual(self.agent.handle({'op': 'metadata'})['metadata'], meta)
+
+    def test_run_journal(self):
+        """verify the run journal is kept next to WORKING until the backup is finalized"""
+        os.makedirs(os.path.join(self.root, 'WORKING', 'judge', 'Music'))
+        self.assertEqual(self.agent.handle({'op': 'run-journal'}), {'ok': True, 'journal': None})
+        journal = {'latest': '', 'sources': {'/Users/judge': {'result': 'SUCCESS'}}}
+        self.assertTrue(self.agent.handle({'op': 'run-journal', 'journal': journal})['ok'])
+        self.assertEqual(self.agent.handle({'op': 'run-journal'})['journal'], journal)
+        self.assertEqual(self.agent.handle({'op': 'list'})['backups'], [])
+
+        reply = self.agent.handle({'op': 'working-paths', 'paths': ['judge', 'judge/Music', 'judge/Pictures']})
+        self.assertEqual(reply['present'], ['judge', 'judge/Music'])
+        for path in ['../x', '/x', '.']:
+            self.assertFalse(self.agent.handle({'op': 'working-paths', 'paths': [path]})['ok'])
+
+        self.agent.handle({'op': 'finalize', 'datedir': '2019-01-03-000000', 'metadata': {}})
+        self.assertEqual(self.agent.handle({'op': 'run-journal'})['journal'], None)
+
+    def test_partial(self):
+        """verify old partial files are removed and none are left in the backup"""
+        partial = os.path.join(self.root, 'WORKING', '.myocp-partial')
+        for shard, name, age in [('a1', 'old.img', 8 * 86400), ('b2', 'old.img', 8 * 86400), ('b2', 'new.img', 60)]:
+            os.makedirs(os.path.join(partial, shard), exist_ok=True)
+            with open(os.path.join(partial, shard, name), 'wb') as fp:
+                fp.write(b'x' * 100)
+            os.utime(os.path.join(partial, shard, name), (time.time() - age, time.time() - age))
+        reply = self.agent.handle({'op': 'partial-gc', 'max_age': 7 * 86400})
+        self.assertEqual(reply, {'ok': True, 'removed': 2, 'bytes': 200, 'kept': 1})
+        self.assertEqual(os.listdir(partial), ['b2'])
+        self.assertEqual(os.listdir(os.path.join(partial, 'b2')), ['new.img'])
+
+        self.agent.handle({'op': 'finalize', 'datedir': '2019-01-03-000000', 'metadata': {}})
+        self.assertEqual(os.listdir(os.path.join(self.root, '2019-01-03-000000')), [])
+        self.assertEqual(self.agent.handle({'op': 'partial-gc', 'max_age': 0})['removed'], 0)
+
+    def test_finalize_without_working(self):
+        """verify a failed finalize leaves the old metadata alone"""
+        os.makedirs(self.root)
+        reply = self.agent.handle({'op': 'finalize', 'datedir': '2019-01-03-000000', 'metadata': {}})
+        self.assertFalse(reply['ok'])
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_remove(self):
+        """verify remove copes with read only folders and rejects paths outside the host folder"""
+        folder = os.path.join(self.root, '2019-01-01-000000', 'sub')
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'file'), 'w') as fp:
+            fp.write('x')
+        os.chmod(folder, 0o500)
+        self.assertTrue(self.agent.handle({'op': 'remove', 'path': os.path.join(self.root, '2019-01-01-000000')})['ok'])
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertFalse(self.agent.handle({'op': 'remove', 'path': '..'})['ok'])
+
+    def test_trash_and_reclaim(self):
+        """verify trashing is a rename, the space still to reclaim is reported, and the reclaimer empties the trash"""
+        folder = os.path.join(self.root, '2019-01-01-000000', 'sub')
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'file'), 'wb') as fp:
+            fp.write(b'x' * 100000)
+        reply = self.agent.handle({'op': 'trash', 'path': os.path.join(self.root, '2019-01-01-000000')})
+        self.assertTrue(reply['ok'])
+        self.assertEqual(self.agent.handle({'op': 'list'})['backups'], [])
+        self.assertEqual(self.agent.handle({'op': 'space'})['estimating'], 1)
+
+        spaces = []
+        def delete(*args):
+            spaces.append(self.agent.handle({'op': 'space'}))
+            return deleteSnapshot(*args)
+
+        with patch('myocp_agent.deleteSnapshot', side_effect=delete):
+            self.assertGreaterEqual(self.agent.reclaim(), 100000)
+        self.assertEqual(spaces[0]['estimating'], 0)
+        self.assertGreaterEqual(spaces[0]['pending'], 100000)
+        self.assertEqual(os.listdir(os.path.join(self.root, '.trash')), ['.reclaim.lock'])
+        space = self.agent.handle({'op': 'space'})
+        self.assertEqual((space['pending'], space['estimating']), (0, 0))
+
+    def test_reclaim_nothing(self):
+        """verify the reclaimer is not started for an empty trash"""
+        self.assertEqual(self.agent.handle({'op': 'reclaim'}), {'ok': True, 'started': False})
+
+    def test_unknown_op(self):
+        """verify unknown requests are reported, not raised"""
+        self.assertEqual(self.agent.handle({'op': 'spam'}), {'ok': False, 'error': 'unknown request spam'})
+
+    def test_batch_over_stdin(self):
+        """verify a batch of requests is answered one reply per line"""
+        requests = [{'op': 'ensure-root'}, {'op': 'list'}, {'op': 'metadata'}]
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'myocp_agent.py')
+        out = subprocess.run([sys.executable, script, self.dest, 'laptop'], check=True,
+                             input="".join(json.dumps(r)+"\n" for r in requests).encode(),
+                             stdout=subprocess.PIPE).stdout.decode()
+        replies = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual(len(replies), 3)
+        self.assertTrue(all(r['ok'] for r in replies))
+        self.assertEqual(replies[1]['backups'], [])
+
+    def test_link_moves(self):
+        """verify moved files are linked into WORKING only when they match"""
+        os.makedirs(os.path.join(self.root, '2019-01-01-000000', 'judge'))
+        os.makedirs(os.path.join(self.root, 'WORKING', 'judge'))
+        old = os.path.join(self.root, '2019-01-01-000000', 'judge', 'photo')
+        with open(old, 'wb') as fp:
+            fp.write(b'photo' * 1000)
+        st = os.lstat(old)
+        digest = hashlib.sha256(b'photo' * 1000).hexdigest()
+        moves = [['judge/photo', 'judge/Pictures/photo', st.st_size, int(st.st_mtime), digest],
+                 ['judge/photo', 'judge/other', st.st_size, int(st.st_mtime), 'x' * 64],
+                 ['judge/gone', 'judge/lost', st.st_size, int(st.st_mtime), digest]]
+        reply = self.agent.handle({'op': 'link-moves', 'latest': '2019-01-01-000000', 'moves': moves})
+        self.assertEqual(reply, {'ok': True, 'linked': 1, 'bytes': 5000, 'present': 0, 'mismatched': 2})
+        self.assertEqual(os.lstat(os.path.join(self.root, 'WORKING', 'judge', 'Pictures', 'photo')).st_ino, st.st_ino)
+
+        reply = self.agent.handle({'op': 'link-moves', 'latest': '2019-01-01-000000', 'moves': moves[:1]})
+        self.assertEqual(reply['present'], 1)
+        reply = self.agent.handle({'op': 'link-moves', 'latest': '2019-01-01-000000',
+                                   'moves': [['judge/photo', '../../elsewhere', 1, 1, digest]]})
+        self.assertFalse(reply['ok'])
+        reply = self.agent.handle({'op': 'link-moves', 'latest': '2019-01-01-000000',
+                                   'moves': [['.', 'judge/copy', 1, 1, digest]]})
+        self.assertFalse(reply['ok'])
+
+
+    def test_link_hits(self):
+        """verify each file is put down to the reference it was linked from"""
+        for folder in ['2019-01-01-000000', '2019-01-02-000000', 'WORKING']:
+            os.makedirs(os.path.join(self.root, folder, 'judge'))
+        def write(folder, name, data):
+            with open(os.path.join(self.root, folder, 'judge', name), 'wb') as fp:
+                fp.write(data)
+        def link(folder, name):
+            os.link(os.path.join(self.root, folder, 'judge', name), os.path.join(self.root, 'WORKING', 'judge', name))
+        write('2019-01-02-000000', 'same', b'1' * 10)
+        write('2019-01-01-000000', 'reverted', b'2' * 20)
+        write('2019-01-02-000000', 'reverted', b'3' * 30)
+        write('WORKING', 'new', b'4' * 40)
+        link('2019-01-02-000000', 'same')
+        link('2019-01-01-000000', 'reverted')
+        reply = self.agent.handle({'op': 'link-hits', 'refs': ['../2019-01-02-000000', '../2019-01-01-000000'], 'path': 'judge'})
+        self.assertTrue(reply['ok'])
+        self.assertEqual(reply['hits'], [[1, 10], [1, 20]])
+        self.assertEqual(reply['new'], [1, 40])
+        self.assertEqual(reply['relinked'], ['judge/reverted'])
+        self.assertTrue(reply['complete'])
+        self.assertEqual(reply['stats'], 2 + 3 + 1 + 2 + 2)
+
+        # a folder with the latest backup's mtime has nothing from older references
+        for folder in ['2019-01-02-000000', 'WORKING']:
+            os.makedirs(os.path.join(self.root, folder, 'judge', 'docs'))
+            os.utime(os.path.join(self.root, folder, 'judge', 'docs'), ns=(10 ** 18, 10 ** 18))
+        with open(os.path.join(self.root, 'WORKING', 'judge', 'docs', 'old'), 'wb') as fp:
+            fp.write(b'5' * 50)
+        os.utime(os.path.join(self.root, 'WORKING', 'judge', 'docs'), ns=(10 ** 18, 10 ** 18))
+        with patch('myocp_agent.LINK_HITS_LIMIT', 0):
+            reply = self.agent.handle({'op': 'link-hits', 'refs': ['../2019-01-02-000000', '../2019-01-01-000000'], 'path': 'judge'})
+        self.assertEqual(reply['new'], [1, 40])
+        self.assertEqual((reply['relinked'], reply['complete']), ([], False))
+        self.assertEqual(reply['stats'], 2 + 2 + 3 + 1 + 2 + 2)
+
+        for path in ['../elsewhere', '/elsewhere', '.']:
+            self.assertFalse(self.agent.handle({'op': 'link-hits', 'refs': [], 'path': path})['ok'])
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
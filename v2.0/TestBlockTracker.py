@@ -0,0 +1,171 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import os
+import zlib
+import base64
+import random
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from myocp_agent import Agent
+from CrashPlanError import CrashPlanError
+from BlockTracker import BlockTracker
+from TestRsyncMethod import FakeLog
+
+KB = 1024
+BLOCK = 64 * KB
+
+
+class FakeBlockComms():
+    """hands the requests straight to an agent"""
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.puts = []
+
+    def request(self, request):
+        reply = self.agent.handle(request)
+        if not reply['ok']:
+            raise CrashPlanError(reply['error'])
+        return reply
+
+    def blockBegin(self, name, path, base, fingerprint, unchanged):
+        return self.request({'op': 'block-begin', 'name': name, 'path': path, 'base': base,
+                             'fingerprint': fingerprint, 'unchanged': unchanged})['based']
+
+    def blockPut(self, name, block_size, blocks):
+        self.puts.extend(index for index, _digest, _data in blocks)
+        return self.request({'op': 'block-put', 'name': name, 'block_size': block_size, 'blocks': blocks})['bytes']
+
+    def blockEnd(self, name, path, st, block_size, fingerprint, based):
+        self.request({'op': 'block-end', 'name': name, 'path': path, 'size': st.st_size,
+                      'mode': st.st_mode, 'mtime_ns': st.st_mtime_ns, 'block_size': block_size,
+                      'fingerprint': fingerprint, 'based': based})
+
+
+class TestBlockTracker(unittest.TestCase):
+    """Test backing up huge files a changed block at a time"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.settings_dir = os.path.join(self.tmp, "settings")
+        os.makedirs(self.settings_dir)
+        self.agent = Agent(os.path.join(self.tmp, "server"), "laptop")
+        self.host = os.path.join(self.tmp, "server", "laptop")
+        os.makedirs(os.path.join(self.host, "WORKING"))
+        self.comms = FakeBlockComms(self.agent)
+        self.local = os.path.join(self.tmp, "vm.img")
+        with open(self.local, 'wb') as fp:
+            fp.write(random.Random(7).randbytes(10 * BLOCK + 99))
+        self.tracker = BlockTracker(self.settings_dir, self.comms, FakeLog(), BLOCK)
+
+    def tearDown(self):
+        self.tracker.close()
+        shutil.rmtree(self.tmp)
+
+    def finish(self, datedir):
+        """WORKING becomes the backup datedir, and a new WORKING is started"""
+        os.rename(os.path.join(self.host, "WORKING"), os.path.join(self.host, datedir))
+        os.makedirs(os.path.join(self.host, "WORKING"))
+
+    def stored(self, folder="WORKING"):
+        with open(os.path.join(self.host, folder, "judge", "vm.img"), 'rb') as fp:
+            return fp.read()
+
+    def local_data(self):
+        with open(self.local, 'rb') as fp:
+            return fp.read()
+
+    def change(self, offset, data):
+        with open(self.local, 'r+b') as fp:
+            fp.seek(offset)
+            fp.write(data)
+        st = os.stat(self.local)
+        os.utime(self.local, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+    def test_first_backup(self):
+        """verify every block is sent when there is nothing to start from"""
+        self.assertGreater(self.tracker.backup(self.local, "judge/vm.img", ""), 0)
+        self.assertEqual(self.comms.puts, list(range(11)))
+        self.assertEqual(self.stored(), self.local_data())
+        st = os.stat(self.local)
+        stored = os.stat(os.path.join(self.host, "WORKING", "judge", "vm.img"))
+        self.assertEqual((stored.st_mode, stored.st_mtime_ns), (st.st_mode, st.st_mtime_ns))
+
+    def test_changed_block(self):
+        """verify only the changed blocks are sent and the backup is left alone"""
+        self.tracker.backup(self.local, "judge/vm.img", "")
+        self.finish("2024-01-01-000000")
+        self.comms.puts = []
+
+        self.change(3 * BLOCK + 5, b"changed")
+        self.change(10 * BLOCK + 50, b"end")
+        sent = self.tracker.backup(self.local, "judge/vm.img", "2024-01-01-000000")
+        self.assertEqual(self.comms.puts, [3, 10])
+        self.assertLess(sent, 3 * BLOCK)
+        self.assertEqual(self.stored(), self.local_data())
+        self.assertNotEqual(self.stored("2024-01-01-000000"), self.local_data())
+
+    def test_grown_and_shrunk(self):
+        """verify a file that grows or shrinks comes out as it is"""
+        self.tracker.backup(self.local, "judge/vm.img", "")
+        self.finish("2024-01-01-000000")
+        with open(self.local, 'ab') as fp:
+            fp.write(b"x" * (BLOCK + 10))
+        self.tracker.backup(self.local, "judge/vm.img", "2024-01-01-000000")
+        self.assertEqual(self.stored(), self.local_data())
+
+        self.finish("2024-01-02-000000")
+        self.comms.puts = []
+        os.truncate(self.local, 4 * BLOCK + 1)
+        self.tracker.backup(self.local, "judge/vm.img", "2024-01-02-000000")
+        self.assertEqual(self.comms.puts, [4])
+        self.assertEqual(self.stored(), self.local_data())
+
+    def test_unchanged(self):
+        """verify an unchanged file is linked from the backup, nothing sent"""
+        self.tracker.backup(self.local, "judge/vm.img", "")
+        self.finish("2024-01-01-000000")
+        self.comms.puts = []
+
+        self.assertEqual(self.tracker.backup(self.local, "judge/vm.img", "2024-01-01-000000"), 0)
+        self.assertEqual(self.comms.puts, [])
+        self.assertEqual(os.stat(os.path.join(self.host, "WORKING", "judge", "vm.img")).st_ino,
+                         os.stat(os.path.join(self.host, "2024-01-01-000000", "judge", "vm.img")).st_ino)
+
+    def test_base_not_as_mapped(self):
+        """verify every block is sent when the backup does not hold the version the client last sent"""
+        self.tracker.backup(self.local, "judge/vm.img", "")
+        shutil.rmtree(os.path.join(self.host, "WORKING"))
+        os.makedirs(os.path.join(self.host, "2024-01-01-000000"))
+        os.makedirs(os.path.join(self.host, "WORKING"))
+        self.comms.puts = []
+
+        self.change(0, b"changed")
+        self.tracker.backup(self.local, "judge/vm.img", "2024-01-01-000000")
+        self.assertEqual(self.comms.puts, list(range(11)))
+        self.assertEqual(self.stored(), self.local_data())
+
+    def test_bad_path(self):
+        """verify a path outside the backup is refused"""
+        for path in ["../../etc/passwd", "/etc/passwd", "judge/../../x", "."]:
+            with self.assertRaises(CrashPlanError):
+                self.comms.blockBegin("ab12", path, "2024-01-01-000000", "", True)
+        with self.assertRaises(CrashPlanError):
+            self.comms.blockBegin("ab12", "judge/vm.img", "../laptop", "", True)
+
+    def test_bad_block(self):
+        """verify a block that does not match its digest is refused"""
+        self.comms.blockBegin("ab12", "judge/vm.img", "", "", False)
+        data = base64.b64encode(zlib.compress(b"block")).decode()
+        with self.assertRaises(CrashPlanError):
+            self.comms.blockPut("ab12", BLOCK, [[0, hashlib.sha256(b"other").hexdigest(), data]])
+        with self.assertRaises(CrashPlanError):
+            self.comms.blockEnd("ab12", "judge/vm.img", os.stat(self.local), BLOCK, "", False)
+        self.assertFalse(os.path.exists(os.path.join(self.host, "WORKING", "judge", "vm.img")))
@@ -0,0 +1,187 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import io
+import os
+import random
+import shutil
+import socket
+import tempfile
+import unittest
+
+from unittest.mock import patch
+from Settings import Settings
+from CrashPlan import CrashPlanErrorCodes
+from ChunkMethod import ChunkMethod
+from ChunkStore import ChunkStore
+from Chunker import chunks, CHUNK_MIN, CHUNK_MAX
+from myocp_agent import Agent
+from TestRsyncMethod import FakeLog, FakeMetaData, FakeRemoteComms
+
+
+class FakeAgentComms(FakeRemoteComms):
+    """answer agent requests with an in process agent"""
+
+    def __init__(self, settings, log, agent):
+        super().__init__(settings, log)
+        self.server = agent
+        self.requests = []
+
+    def agent(self, requests):
+        self.requests += requests
+        return [self.server.handle(request) for request in requests]
+
+
+class TestChunker(unittest.TestCase):
+    """Test content defined chunking"""
+
+    def test_chunks_follow_content(self):
+        """verify an insertion only changes the chunks around it"""
+        data = os.urandom(12 * 1024 * 1024)
+        before = list(chunks(io.BytesIO(data)))
+        self.assertEqual(b''.join(chunk for _digest, chunk in before), data)
+        self.assertTrue(all(CHUNK_MIN <= len(chunk) <= CHUNK_MAX for _digest, chunk in before[:-1]))
+
+        after = list(chunks(io.BytesIO(data[:5000000] + b'inserted' + data[5000000:])))
+        common = {digest for digest, _chunk in before} & {digest for digest, _chunk in after}
+        self.assertGreaterEqual(len(common), len(before) - 2)
+
+    def test_no_anchors(self):
+        """verify data without anchors is cut at the maximum size"""
+        sizes = [len(chunk) for _digest, chunk in chunks(io.BytesIO(bytes(CHUNK_MAX * 2 + 10)))]
+        self.assertEqual(sizes, [CHUNK_MAX, CHUNK_MAX, 10])
+
+
+class TestChunkMethod(unittest.TestCase):
+    """Test the chunk store backup method"""
+
+    def setUp(self):
+        self.log = FakeLog()
+        jstr = """{ "debug-level": false,
+            "backup-destination": "mydest",
+            "exclude-files": ".DS_Store",
+            "exclude-folders": "Library",
+            "settings-dir": "test_myocp",
+            "extra-backup-sources": "",
+            "maximum-used-percent": 90,
+            "server-address": "",
+            "server-name": "myhost",
+            "backup-method": "chunk"
+        }"""
+        with patch.object(socket, 'gethostbyname', return_value='15.0.0.1'):
+            self.settings = Settings(jstr, self.log)
+
+        self.tmp = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp, "dest")
+        os.makedirs(os.path.join(self.dest, "laptop"))
+        self.comms = FakeAgentComms(self.settings, self.log, Agent(self.dest, "laptop"))
+        self.meta = FakeMetaData(self.log, self.comms, self.settings, "")
+
+        self.src = os.path.join(self.tmp, "judge")
+        for folder in ["Documents", "Library", "empty"]:
+            os.makedirs(os.path.join(self.src, folder))
+        # the same data every run, where the chunk boundaries fall decides
+        # how much an append costs
+        self.mailbox = random.Random(3).randbytes(3 * 1024 * 1024)
+        self.write("Documents/mailbox", self.mailbox)
+        self.write("Documents/copy", self.mailbox)
+        self.write("Documents/.DS_Store", b'x')
+        self.write("Library/cache", b'x')
+        os.symlink("Documents/mailbox", os.path.join(self.src, "link"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        with open(os.path.join(self.src, name), 'wb') as fp:
+            fp.write(data)
+
+    def backup(self):
+        method = ChunkMethod(self.settings, self.meta, self.log, self.comms)
+        method.cache_file = os.path.join(self.tmp, "chunk-cache.db")
+        method.buildCommand(self.src, "mydest/laptop/WORKING")
+        self.assertEqual(method.run(), CrashPlanErrorCodes.SUCCESS)
+        return method
+
+    def test_backup_and_restore(self):
+        """verify a backup is stored once as chunks and restores to the same files"""
+        first = self.backup()
+        # the copy shares the mailbox's chunks
+        self.assertLess(first.sent, len(self.mailbox) * 1.5)
+
+        restored = os.path.join(self.tmp, "restored")
+        store = ChunkStore(self.dest)
+        store.restore(os.path.join(self.dest, "laptop", "WORKING"), restored)
+        store.close()
+        with open(os.path.join(restored, "judge/Documents/mailbox"), 'rb') as fp:
+            self.assertEqual(fp.read(), self.mailbox)
+        self.assertEqual(os.readlink(os.path.join(restored, "judge/link")), "Documents/mailbox")
+        self.assertTrue(os.path.isdir(os.path.join(restored, "judge/empty")))
+        self.assertFalse(os.path.exists(os.path.join(restored, "judge/Library")))
+        self.assertFalse(os.path.exists(os.path.join(restored, "judge/Documents/.DS_Store")))
+
+        # nothing changed, nothing is read or sent
+        self.comms.requests = []
+        self.assertEqual(self.backup().sent, 0)
+        self.assertFalse([r for r in self.comms.requests if r['op'] == 'chunks-put'])
+
+        # an appended message costs the last chunk or two
+        self.write("Documents/mailbox", self.mailbox + b'another message')
+        self.assertLess(self.backup().sent, len(self.mailbox) / 2)
+
+    def test_lost_chunks_are_sent_again(self):
+        """verify cached files are checked against the store"""
+        self.backup()
+        shutil.rmtree(os.path.join(self.dest, ".chunks"))
+        self.assertGreater(self.backup().sent, len(self.mailbox))
+
+    def test_gc(self):
+        """verify chunks no manifest refers to are dropped"""
+        self.backup()
+        shutil.rmtree(os.path.join(self.dest, "laptop", "WORKING"))
+        store = ChunkStore(self.dest)
+        # a running backup may be about to refer to chunks it was just told of
+        self.assertEqual(store.gc(), (0, 0))
+        dropped, freed = store.gc(grace=0)
+        store.close()
+        self.assertGreater(dropped, 0)
+        self.assertEqual(freed, 0)
+
+    def test_trash_and_reclaim(self):
+        """verify a trashed chunk backup is sized by its own chunks and the reclaimer drops them"""
+        agent = self.comms.server
+        host = os.path.join(self.dest, "laptop")
+        self.backup()
+        os.rename(os.path.join(host, "WORKING"), os.path.join(host, "2024-01-01-000000"))
+        self.mailbox = random.Random(4).randbytes(3 * 1024 * 1024)
+        self.write("Documents/mailbox", self.mailbox)
+        self.write("Documents/copy", b'copy')
+        self.backup()
+        os.rename(os.path.join(host, "WORKING"), os.path.join(host, "2024-01-02-000000"))
+
+        exclusive = agent.handle({'op': 'usage'})['exclusive']
+        self.assertGreater(exclusive["2024-01-01-000000"], len(self.mailbox))
+        self.assertGreater(exclusive["2024-01-02-000000"], len(self.mailbox))
+
+        agent.handle({'op': 'trash', 'path': "2024-01-01-000000"})
+        self.assertEqual(agent.handle({'op': 'space'})['pending'], exclusive["2024-01-01-000000"])
+
+        store = ChunkStore(self.dest)
+        old = [digest for digest, _chunk in chunks(io.BytesIO(random.Random(3).randbytes(3 * 1024 * 1024)))]
+        with store.db:
+            store.db.execute("UPDATE chunks SET seen = 0")
+        agent.reclaim()
+        self.assertEqual(store.missing(old), old)
+        self.assertEqual(store.missing([d for d, _c in chunks(io.BytesIO(self.mailbox))]), [])
+        store.close()
+        space = agent.handle({'op': 'space'})
+        self.assertEqual((space['pending'], space['estimating']), (0, 0))
+        self.assertEqual(os.listdir(os.path.join(host, ".trash")), [".reclaim.lock"])
+
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
@@ -0,0 +1,189 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from unittest.mock import patch
+from Settings import Settings
+from ContinuousBackup import ContinuousBackup
+from Inotify import SourceWatcher
+from TestRsyncMethod import FakeLog, FakeMetaData
+from TestFileJournal import FakeCloneComms
+
+
+@unittest.skipUnless(hasattr(os, 'O_CLOEXEC') and os.path.exists("/proc/sys/fs/inotify"), "needs inotify")
+class TestSourceWatcher(unittest.TestCase):
+    """Test watching the sources with inotify"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "judge")
+        for folder in ["Documents/a", "Pictures", "Library/Caches"]:
+            os.makedirs(os.path.join(self.src, folder))
+        self.watcher = SourceWatcher([self.src], ["Library"], FakeLog())
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmp)
+
+    def write(self, name):
+        with open(os.path.join(self.src, name), 'w') as fp:
+            fp.write(name)
+
+    def test_watches_folders(self):
+        """verify every folder but the excluded ones is watched"""
+        self.assertEqual(sorted(self.watcher.path(wd) for wd in self.watcher.watches),
+                         [self.src] + [os.path.join(self.src, f) for f in ["Documents", "Documents/a", "Pictures"]])
+
+    def test_dirty_paths(self):
+        """verify changed files and their folders are collected once each"""
+        self.write("Documents/a/one")
+        self.write("Documents/a/one")
+        self.write("Library/Caches/ignored")
+        self.watcher.poll(1)
+        self.assertEqual(self.watcher.take(), {os.path.join(self.src, "Documents/a"),
+                                               os.path.join(self.src, "Documents/a/one")})
+        self.assertEqual(self.watcher.dirty, set())
+
+    def test_new_folder(self):
+        """verify a folder moved in is watched and all of it is dirty"""
+        outside = os.path.join(self.tmp, "new")
+        os.makedirs(os.path.join(outside, "sub"))
+        with open(os.path.join(outside, "sub", "two"), 'w') as fp:
+            fp.write("two")
+        os.rename(outside, os.path.join(self.src, "Pictures", "new"))
+        self.watcher.poll(1)
+        self.assertIn(os.path.join(self.src, "Pictures/new/sub/two"), self.watcher.take())
+
+        self.write("Pictures/new/sub/three")
+        self.watcher.poll(1)
+        self.assertIn(os.path.join(self.src, "Pictures/new/sub/three"), self.watcher.take())
+
+    def test_folder_moved_within(self):
+        """verify a renamed folder's events carry its new path"""
+        os.rename(os.path.join(self.src, "Documents"), os.path.join(self.src, "Papers"))
+        self.watcher.poll(1)
+        self.watcher.take()
+        self.write("Papers/a/four")
+        self.watcher.poll(1)
+        self.assertEqual(self.watcher.take(), {os.path.join(self.src, "Papers/a"),
+                                               os.path.join(self.src, "Papers/a/four")})
+
+    def test_watch_limit(self):
+        """verify running out of watches falls back to scanning"""
+        watcher = SourceWatcher([self.src], ["Library"], FakeLog(), max_watches=2)
+        watcher.start()
+        watcher.close()
+        self.assertTrue(watcher.overflowed)
+        watcher.rescanned()
+        self.assertTrue(watcher.overflowed)
+
+
+class FakeWatcher():
+    def __init__(self):
+        self.dirty = set()
+        self.overflowed = False
+        self.last_event = None
+
+    def take(self):
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def putBack(self, dirty):
+        self.dirty |= dirty
+
+    def rescanned(self):
+        self.overflowed = False
+
+
+class TestContinuousBackup(unittest.TestCase):
+    """Test sending batches and snapshots"""
+
+    def setUp(self):
+        self.log = FakeLog()
+        self.tmp = tempfile.mkdtemp()
+        jstr = """{ "debug-level": false,
+            "backup-destination": "mydest",
+            "exclude-files": ".a,.b",
+            "exclude-folders": "Library,c",
+            "settings-dir": "%s",
+            "extra-backup-sources": "",
+            "maximum-used-percent": 90,
+            "server-address": "",
+            "server-name": "myhost"
+        }""" % self.tmp
+        with patch.object(socket, 'gethostbyname', return_value='15.0.0.1'):
+            self.settings = Settings(jstr, self.log)
+        self.comms = FakeCloneComms(self.settings, self.log)
+        self.meta = FakeMetaData(self.log, self.comms, self.settings, "")
+        self.meta.meta['backup-today'] = '2019-01-01'
+
+        self.backup = ContinuousBackup(self.settings, self.meta, self.log, self.comms)
+        self.backup.watcher = FakeWatcher()
+        self.runs = []
+        self.backup._backup = lambda: self.runs.append(self.backup.method.batch) or True
+        self.snapshots = []
+        self.backup.snapshot = lambda: self.snapshots.append(1)
+
+        self.src = os.path.join(self.tmp, "judge")
+        os.makedirs(os.path.join(self.src, "Documents"))
+        with open(os.path.join(self.src, "Documents", "one"), 'w') as fp:
+            fp.write("one")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_batches(self):
+        """verify a scan pass comes first and then batches once things are quiet"""
+        with patch('Utils.TimeDate.today', return_value='2019-01-01'):
+            self.backup.step(1000)
+            self.assertEqual(self.runs, [None])
+
+            self.backup.watcher.dirty = {'x'}
+            self.backup.watcher.last_event = 1250
+            self.backup.step(1255)
+            self.backup.step(1299)
+            self.assertEqual(len(self.runs), 1)
+            self.backup.step(1310)
+            self.assertEqual(self.runs, [None, {'x'}])
+            self.assertEqual(self.snapshots, [])
+
+    def test_snapshot(self):
+        """verify the last changes are sent before the day's snapshot"""
+        with patch('Utils.TimeDate.today', return_value='2019-01-01'):
+            self.backup.step(1000)
+        self.backup.watcher.dirty = {'x'}
+        self.backup.watcher.last_event = 1010
+        with patch('Utils.TimeDate.today', return_value='2019-01-02'):
+            self.backup.step(1011)
+        self.assertEqual(self.runs, [None, {'x'}])
+        self.assertEqual(self.snapshots, [1])
+
+    def test_overflow(self):
+        """verify lost events make the next batch a scan"""
+        with patch('Utils.TimeDate.today', return_value='2019-01-01'):
+            self.backup.step(1000)
+            self.backup.watcher.overflowed = True
+            self.backup.watcher.dirty = {'x'}
+            self.backup.step(1400)
+        self.assertEqual(self.runs, [None, None])
+        self.assertFalse(self.backup.watcher.overflowed)
+        self.assertEqual(self.backup.watcher.dirty, set())
+
+    def test_batch_command(self):
+        """verify the batch is split into changes and deletions of the source"""
+        method = self.backup.method
+        method.batch = {self.src + "/Documents", self.src + "/Documents/one", self.src + "/gone", "/elsewhere/x"}
+        method.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+        self.assertEqual(method.scan.candidates, ['judge/Documents', 'judge/Documents/one'])
+        self.assertEqual(method.scan.deletions, ['judge/gone'])
+        self.assertIn("--files-from=", method.cmd)
+
@@ -6,8 +6,11 @@
 # pylint: disable=too-many-public-methods
 
 import os
+import json
+import shutil
 import socket
 import logging
+import tempfile
 import unittest
 
 from io import StringIO
@@ -17,8 +20,10 @@ from RemoteComms import RemoteComms
 from MetaData import MetaData
 from CrashPlan import CrashPlan
 from RsyncMethod import BaseMethod
+from RsyncOutput import RsyncEvent, RsyncChange
 from CrashPlanError import CrashPlanError
 from CrashPlan import CrashPlanErrorCodes
+from SizeHistory import SizeHistory
 
 class FakeLog(logging.Logger):
     def __init__(self):
@@ -43,6 +48,10 @@ class FakeRemoteComms(RemoteComms):
         self.status = settings
         self.settings = settings
         self.message = log
+        self.resumed = False
+        self.run_journal = None
+        self.working = []
+        self.catalogued = True
         
     def remoteCommand(self, cmd):
         return self.status, self.message
@@ -61,6 +70,42 @@ class FakeRemoteComms(RemoteComms):
 
     def removeOldestBackup(self, which):
         pass
+
+    def trashBackup(self, which):
+        return self.trashBackups([which]) == 1
+
+    def trashBackups(self, victims):
+        self.trashed = getattr(self, 'trashed', []) + victims
+        return len(victims)
+
+    def planPrune(self, max_percent, minimum=0, need=0):
+        return self.getBackupList()[:-1][:minimum]
+
+    def space(self):
+        return {'free': 1000, 'used': 3000, 'pending': 0, 'inodes': 100, 'inodes_free': 50}
+
+    def waitForReclaim(self):
+        return False
+
+    def closeMaster(self):
+        pass
+
+    def runJournal(self):
+        return self.run_journal
+
+    def putRunJournal(self, journal):
+        self.run_journal = json.loads(json.dumps(journal))
+
+    def workingPaths(self, paths):
+        return [path for path in paths if path in self.working]
+
+    def catalogStreams(self):
+        return self.catalogued and not self.resumed
+
+    def finalize(self, datedir, metadata, changes=None):
+        self.finalized = (datedir, metadata)
+        self.changes = changes
+        return {'stored': 200 * 1024 * 1024, 'free': 500}
         
 
 class FakeMetaData(MetaData):
@@ -74,6 +119,16 @@ class FakeMetaData(MetaData):
 class FakeMethod(BaseMethod):
     def __init__(self, settings, meta, log, comms):
         super().__init__()
+        self.size_required = 0
+        self.files_required = 0
+        self.dry_runs = []
+
+    def buildSizeCommand(self, src, dest):
+        self.dry_runs.append(src)
+
+    def run2(self):
+        self.size_required = 5
+        self.files_required = 2
 
 class TestCrashPlan(unittest.TestCase):
     """Test CrashPlan"""
@@ -130,6 +185,8 @@ class TestCrashPlan(unittest.TestCase):
         with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
             CP.backup_successful = True
             CP.finishUp()
+        datedir, metadata = self.comms.finalized
+        self.assertEqual(metadata['latest-complete'], datedir)
         #assert mock_backup.called
         #with patch.object(CrashPlan, "backupFolder", return_value=CrashPlanErrorCodes.SUCCESS) as mock_backup:
 
@@ -137,8 +194,191 @@ class TestCrashPlan(unittest.TestCase):
         """verify deleteOldestBackup"""
         CP = CrashPlan(self.settings, self.meta, self.log, self.comms, self.method, False)
         with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
-            CP.deleteOldestBackup()
-        
+            self.assertTrue(CP.deleteOldestBackup())
+        self.assertEqual(self.comms.trashed, ['one'])
+
+    def test_makeRoom(self):
+        """verify the planned backups are trashed in one go, and that a full disk with nothing to prune gives up"""
+        CP = CrashPlan(self.settings, self.meta, self.log, self.comms, self.method, False)
+        with patch.object(FakeRemoteComms, "planPrune", return_value=['one', 'two']) as mock_plan:
+            self.assertTrue(CP.makeRoom())
+        mock_plan.assert_called_with(90, 0, 0)
+        self.assertEqual(self.comms.trashed, ['one', 'two'])
+
+        with patch.object(FakeRemoteComms, "getBackupList", return_value=['one']):
+            self.assertFalse(CP.makeRoom(disk_full=True))
+
+    def test_do_backup_disk_full(self):
+        """verify a backup that fills the disk is retried once room is made, and abandoned when none can be"""
+        CP = CrashPlan(self.settings, self.meta, self.log, self.comms, self.method, False)
+        results = [CrashPlanErrorCodes.DISK_FULL, CrashPlanErrorCodes.SUCCESS, CrashPlanErrorCodes.SUCCESS]
+        with patch.object(CrashPlan, "backupFolder", side_effect=lambda src: results.pop(0)):
+            with patch('sys.stdout', new_callable=StringIO):
+                CP.doBackup()
+        self.assertTrue(CP.backup_successful)
+        self.assertEqual(self.comms.trashed, ['one'])
+
+        with patch.object(FakeRemoteComms, "getBackupList", return_value=['one']):
+            with patch.object(CrashPlan, "backupFolder", return_value=CrashPlanErrorCodes.DISK_FULL) as mock_backup:
+                with patch('sys.stdout', new_callable=StringIO):
+                    CP.doBackup()
+        self.assertFalse(CP.backup_successful)
+        self.assertEqual(mock_backup.call_count, 2)
+
+    def test_getSize(self):
+        """verify the size is estimated locally once there is a journal of the last backup, and by a dry run before"""
+        tmp = tempfile.mkdtemp()
+        try:
+            self.settings.set('settings-dir', tmp)
+            src = os.path.join(tmp, "judge")
+            os.makedirs(src)
+            CP = CrashPlan(self.settings, self.meta, self.log, self.comms, self.method, False)
+            with patch.object(CrashPlan, "backupSources", return_value=[src]):
+                self.assertEqual(CP.getSize(), 5)
+                self.assertEqual(self.method.dry_runs, [src])
+
+                # the estimate's scan becomes the journal of the backup
+                with patch('sys.stdout', new_callable=StringIO):
+                    CP.backup_successful = True
+                    CP.finishUp()
+                with patch.object(FakeRemoteComms, "getBackupList", return_value=['one', self.comms.finalized[0]]):
+                    with open(os.path.join(src, "new"), 'wb') as fp:
+                        fp.write(bytes(4096))
+                    self.assertEqual(CP.getSize(), 4)
+                self.assertEqual(self.method.dry_runs, [src])
+
+                # a method that projects its size is left to it, the estimate is still made
+                CP.predicted = {}
+                self.assertEqual(CP.getSize(dry_run=False), 0)
+                self.assertEqual((self.method.dry_runs, CP.predicted), ([src], {}))
+                with patch.object(FakeRemoteComms, "getBackupList", return_value=['one', self.comms.finalized[0]]):
+                    self.assertEqual(CP.getSize(dry_run=False), 4)
+                self.assertEqual((self.method.dry_runs, CP.predicted), ([src], {src: 4096}))
+            CP.journal.close()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_admit(self):
+        """verify a backup is only started when the server has the bytes and inodes it is expected to need"""
+        CP = CrashPlan(self.settings, self.meta, self.log, self.comms, self.method, False)
+        space = {'free': 1000, 'pending': 500, 'inodes': 100, 'inodes_free': 50}
+        self.assertEqual(CP.shortfall(space, 1500, 50), "")
+        self.assertEqual(CP.shortfall(space, 1501, 0), "1501 bytes are needed and 1500 are free, 500 of them still being reclaimed")
+        self.assertEqual(CP.shortfall(space, 0, 51), "51 files are needed and there are 50 free inodes")
+        self.assertEqual(CP.shortfall(dict(space, inodes=0), 0, 51), "")
+
+        CP.predicted = {'/bin': 2000}
+        with patch.object(CrashPlan, "backupSources", return_value=['/bin']):
+            with patch.object(FakeRemoteComms, "getBackupList", return_value=['one']):
+                with patch.object(CrashPlan, "backupFolder", return_value=CrashPlanErrorCodes.SUCCESS) as mock_backup:
+                    with patch('sys.stdout', new_callable=StringIO):
+                        CP.doBackup()
+        self.assertFalse(mock_backup.called)
+        self.assertFalse(CP.backup_successful)
+
+    def test_calibration(self):
+        """verify the prune plan is asked for room for the calibrated estimate, and the backup's real size is recorded"""
+        tmp = tempfile.mkdtemp()
+        try:
+            mb = 1024 * 1024
+            history = SizeHistory(tmp)
+            self.assertEqual(history.calibrate(100 * mb), 100 * mb)
+            for stored in [150, 200, 100, 180]:
+                history.record(100 * mb, stored * mb, 0, None)
+            self.assertEqual(history.factor(), 2.0)
+            # too small to say anything
+            history.record(mb, 100 * mb, 0, None)
+            self.assertEqual(SizeHistory(tmp).factor(), 2.0)
+
+            self.settings.set('settings-dir', tmp)
+            CP = CrashPlan(self.settings, self.meta, self.log, self.comms, self.method, False)
+            CP.predicted = {'/bin': 100 * mb}
+            space = {'free': 1000 * mb, 'used': 3000 * mb, 'pending': 0, 'inodes': 0, 'inodes_free': 0}
+            with patch.object(FakeRemoteComms, "planPrune", return_value=[]) as mock_plan:
+                with patch.object(FakeRemoteComms, "space", return_value=space):
+                    with patch.object(CrashPlan, "backupSources", return_value=['/bin']):
+                        with patch.object(CrashPlan, "backupFolder", return_value=CrashPlanErrorCodes.SUCCESS):
+                            CP.doBackup()
+            mock_plan.assert_called_with(90, 0, 200 * mb)
+            self.assertEqual(CP.free_before, 1000 * mb)
+
+            CP.finishUp()
+            run = SizeHistory(tmp).runs[-1]
+            self.assertEqual((run['predicted'], run['stored'], run['decrease']), (100 * mb, 200 * mb, 1000 * mb - 500))
+            self.assertEqual(CP.predicted, {})
+        finally:
+            shutil.rmtree(tmp)
+
+
+    def test_changes_kept(self):
+        """verify the changed paths are only kept when the catalog takes them as a list"""
+        listeners = []
+        with patch.object(FakeMethod, "addListener", side_effect=lambda listener: listeners.append(listener) or True, create=True):
+            for catalogued, resumed, expected in [(True, False, {'updated': ['judge/a'] * 2, 'deleted': ['judge/b'] * 2}),
+                                                  (False, False, None), (True, True, None)]:
+                self.comms.catalogued, self.comms.resumed = catalogued, resumed
+                CP = CrashPlan(self.settings, self.meta, self.log, self.comms, self.method, False)
+                def backup(_src):
+                    listeners[-1](RsyncEvent(RsyncChange.CHANGED, 'judge/a', 1, '>f'))
+                    listeners[-1](RsyncEvent(RsyncChange.DELETED, 'judge/b', 0, '*deleting'))
+                    return CrashPlanErrorCodes.SUCCESS
+                with patch.object(CrashPlan, "backupFolder", side_effect=backup):
+                    with patch('sys.stdout', new_callable=StringIO):
+                        CP.doBackup()
+                        CP.finishUp()
+                self.assertEqual(self.comms.changes, expected)
+                self.assertIsNone(CP.changes)
+
+    def test_resume(self):
+        """verify a retry skips the sources an interrupted run finished, while they are unchanged and in WORKING"""
+        tmp = tempfile.mkdtemp()
+        try:
+            self.settings.set('settings-dir', tmp)
+            sources = [os.path.join(tmp, "a"), os.path.join(tmp, "b")]
+            for src in sources:
+                os.makedirs(src)
+                os.utime(src, (1000, 1000))
+
+            def backup(results):
+                CP = CrashPlan(self.settings, self.meta, self.log, self.comms, self.method, False)
+                with patch.object(CrashPlan, "backupSources", return_value=sources):
+                    with patch.object(CrashPlan, "backupFolder", side_effect=lambda src: results.pop(0)) as mock_backup:
+                        with patch('sys.stdout', new_callable=StringIO):
+                            CP.doBackup()
+                return CP, [args[0][0] for args in mock_backup.call_args_list]
+
+            CP, run = backup([CrashPlanErrorCodes.SUCCESS, CrashPlanErrorCodes.UNKNOWN_ERROR])
+            self.assertEqual(run, sources)
+            self.assertEqual(self.comms.run_journal['sources'][sources[0]]['result'], 'SUCCESS')
+
+            # WORKING is still there, as the server's copy of the journal is
+            self.comms.resumed = True
+            self.comms.working = ['a', 'b']
+            os.unlink(os.path.join(tmp, "run-journal.json"))
+            CP, run = backup([CrashPlanErrorCodes.UNKNOWN_ERROR])
+            self.assertEqual(run, sources[1:])
+            with patch.object(CrashPlan, "backupSources", return_value=sources):
+                CP.getSize()
+            self.assertEqual(self.method.dry_runs, sources[1:])
+
+            # changed since, or not in WORKING after all
+            os.utime(sources[0], (2000, 2000))
+            _CP, run = backup([CrashPlanErrorCodes.SUCCESS, CrashPlanErrorCodes.SUCCESS])
+            self.assertEqual(run, sources)
+            self.comms.working = ['b']
+            CP, run = backup([CrashPlanErrorCodes.SUCCESS])
+            self.assertEqual(run, sources[:1])
+            self.assertTrue(CP.backup_successful)
+
+            # a completed backup leaves nothing to carry on
+            with patch('sys.stdout', new_callable=StringIO):
+                CP.finishUp()
+            self.assertFalse(os.path.exists(os.path.join(tmp, "run-journal.json")))
+            self.comms.resumed = False
+            _CP, run = backup([CrashPlanErrorCodes.SUCCESS, CrashPlanErrorCodes.SUCCESS])
+            self.assertEqual(run, sources)
+        finally:
+            shutil.rmtree(tmp)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,244 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import os
+import shutil
+import hashlib
+import socket
+import tempfile
+import unittest
+
+from unittest.mock import patch
+from Settings import Settings
+from CrashPlan import CrashPlanErrorCodes
+from FileJournal import FileJournal
+from JournalRsyncMethod import JournalRsyncMethod
+from RsyncMethod import partialName
+from TestRsyncMethod import FakeLog, FakeMetaData, FakeRemoteComms
+
+
+class FakeCloneComms(FakeRemoteComms):
+    def __init__(self, settings, log):
+        super().__init__(settings, log)
+        self.resumed = False
+        self.clones = []
+
+    def cloneBackup(self, latest):
+        self.clones.append(latest)
+        return True
+
+
+class TestFileJournal(unittest.TestCase):
+    """Test the client side file journal"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "judge")
+        for folder in ["Documents/a", "Documents/b", "Pictures", "Library/Caches"]:
+            os.makedirs(os.path.join(self.src, folder))
+        for name in ["Documents/a/one", "Documents/b/two", "Pictures/three", ".profile"]:
+            with open(os.path.join(self.src, name), 'w') as fp:
+                fp.write(name)
+        self.journal = FileJournal(self.tmp)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmp)
+
+    @classmethod
+    def setUpClass(cls):
+        # the files are all made in the same second as the scans, that is
+        # not recent enough to distrust here
+        cls.racy = patch('FileJournal.RACY_SECONDS', -10)
+        cls.racy.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.racy.stop()
+
+    def firstRun(self):
+        result = self.journal.scan(self.src, "", ["Library"])
+        self.journal.commit("2019-01-01-012345")
+        return result
+
+    def test_no_journal(self):
+        """verify a first scan is not usable but becomes the journal once committed"""
+        result = self.firstRun()
+        self.assertFalse(result.usable)
+        self.assertEqual(result.reason, "no journal")
+        self.assertEqual(result.entries, 9)
+        self.assertEqual(self.journal.suspect(self.src, "2019-01-01-012345", ["Library"]), "")
+
+    def test_nothing_changed(self):
+        """verify an unchanged tree is not read again and has nothing to send"""
+        self.firstRun()
+        result = self.journal.scan(self.src, "2019-01-01-012345", ["Library"])
+        self.assertTrue(result.usable)
+        self.assertEqual((result.candidates, result.deletions), ([], []))
+        self.assertEqual(result.listed, 0)
+        self.assertEqual(result.reused, 5)
+
+    def test_changes(self):
+        """verify changed, new and deleted entries are found"""
+        self.firstRun()
+        with open(os.path.join(self.src, "Documents/a/one"), 'a') as fp:
+            fp.write("more")
+        with open(os.path.join(self.src, "Pictures/four"), 'w') as fp:
+            fp.write("four")
+        shutil.rmtree(os.path.join(self.src, "Documents/b"))
+        os.unlink(os.path.join(self.src, ".profile"))
+
+        result = self.journal.scan(self.src, "2019-01-01-012345", ["Library"])
+        self.assertTrue(result.usable)
+        self.assertEqual(result.candidates, ['judge', 'judge/Documents', 'judge/Documents/a/one',
+                                             'judge/Pictures', 'judge/Pictures/four'])
+        self.assertEqual(result.deletions, ['judge/.profile', 'judge/Documents/b'])
+        # Documents/a kept its names, only its file changed
+        self.assertEqual(result.listed, 3)
+
+    def test_staged_until_commit(self):
+        """verify a scan does not replace the journal until its backup completes"""
+        self.firstRun()
+        os.unlink(os.path.join(self.src, "Pictures/three"))
+        self.journal.scan(self.src, "2019-01-01-012345", ["Library"])
+        self.assertEqual(self.journal.db.execute("SELECT count(*) FROM entries WHERE path LIKE '%three'").fetchone()[0], 1)
+        self.journal.commit("2019-01-02-012345")
+        self.assertEqual(self.journal.db.execute("SELECT count(*) FROM entries WHERE path LIKE '%three'").fetchone()[0], 0)
+
+    def test_moves(self):
+        """verify files that moved are found by inode and their digests cached"""
+        self.firstRun()
+        os.rename(os.path.join(self.src, "Documents"), os.path.join(self.src, "Papers"))
+        with open(os.path.join(self.src, "Pictures/three"), 'a') as fp:
+            fp.write("more")
+        result = self.journal.scan(self.src, "2019-01-01-012345", ["Library"])
+        moves = self.journal.moves(self.src, result.candidates, 0)
+        self.assertEqual([(old, new) for old, new, _st in moves],
+                         [('judge/Documents/a/one', 'judge/Papers/a/one'), ('judge/Documents/b/two', 'judge/Papers/b/two')])
+        self.assertEqual(self.journal.moves(self.src, result.candidates), [])
+
+        files = [(os.path.join(self.tmp, new), st) for _old, new, st in moves]
+        digests = self.journal.digests(files)
+        self.assertEqual(digests[files[0][0]], hashlib.sha256(b"Documents/a/one").hexdigest())
+        with patch('FileJournal.hashFile') as mock_hash:
+            self.assertEqual(self.journal.digests(files), digests)
+        self.assertFalse(mock_hash.called)
+
+    def test_suspect(self):
+        """verify the journal is not trusted when it may not match the server"""
+        self.firstRun()
+        now = os.path.getmtime(self.src) + 1
+        self.assertEqual(self.journal.suspect(self.src, "2019-01-02-012345", ["Library"], now),
+                         "journal is of 2019-01-01-012345 not 2019-01-02-012345")
+        self.assertEqual(self.journal.suspect(self.src, "2019-01-01-012345", ["Library", "c"], now),
+                         "the exclusions have changed")
+        self.assertEqual(self.journal.suspect(self.src, "2019-01-01-012345", ["Library"], now - 3600),
+                         "the clock has gone backwards")
+        self.assertEqual(self.journal.suspect(self.src, "2019-01-01-012345", ["Library"], now + 8 * 86400),
+                         "a full pass is due")
+
+
+class TestJournalRsyncMethod(unittest.TestCase):
+    """Test the rsync method driven by the file journal"""
+
+    def setUp(self):
+        self.log = FakeLog()
+        self.tmp = tempfile.mkdtemp()
+        jstr = """{ "debug-level": false,
+            "backup-destination": "mydest",
+            "exclude-files": ".a,.b",
+            "exclude-folders": "Library,c",
+            "settings-dir": "%s",
+            "extra-backup-sources": "",
+            "maximum-used-percent": 90,
+            "server-address": "",
+            "server-name": "myhost",
+            "backup-method": "journal"
+        }""" % self.tmp
+        with patch.object(socket, 'gethostbyname', return_value='15.0.0.1'):
+            self.settings = Settings(jstr, self.log)
+        self.comms = FakeCloneComms(self.settings, self.log)
+        self.meta = FakeMetaData(self.log, self.comms, self.settings, "")
+
+        self.src = os.path.join(self.tmp, "judge")
+        os.makedirs(os.path.join(self.src, "Documents"))
+        with open(os.path.join(self.src, "Documents", "one"), 'w') as fp:
+            fp.write("one")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_full_pass_without_journal(self):
+        """verify a source with no journal gets a normal rsync"""
+        rsync = JournalRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        rsync.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+        self.assertEqual(self.comms.clones, ['two'])
+        self.assertFalse(rsync.scan.usable)
+        self.assertIn("--delete ", rsync.cmd)
+        self.assertIn(" --partial-dir=mydest/%s/WORKING/.myocp-partial/%s " % (self.settings('local-hostname'), partialName(self.src)), rsync.cmd)
+        self.assertNotIn("--files-from", rsync.cmd)
+
+    def test_block_files(self):
+        """verify the block tracked files in the source are excluded and protected"""
+        rsync = JournalRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        self.assertTrue(rsync.addBlockFiles([os.path.join(self.src, "VMs", "disk [1].img"), "/elsewhere/db"]))
+        rsync.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+        self.assertIn(" --filter='- /judge/VMs/disk \\[1].img' --filter='P /judge/VMs/disk \\[1].img' ", rsync.cmd)
+        self.assertNotIn("elsewhere", rsync.cmd)
+
+    def test_shared_journal(self):
+        """verify the scan the estimate made is taken up rather than made again, unless a full pass is due"""
+        rsync = JournalRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        rsync.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+        rsync.backupFinished('two')
+
+        journal = FileJournal(self.tmp)
+        rsync = JournalRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        self.assertTrue(rsync.addFileJournal(journal))
+        estimate = journal.scan(self.src, 'two', rsync.excludes, full_due=False)
+        with patch.object(journal, 'scan', wraps=journal.scan) as scan:
+            rsync.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+            self.assertEqual(scan.call_count, 0)
+            self.assertIs(rsync.scan, estimate)
+
+            journal.scan(self.src, 'two', rsync.excludes, full_due=False)
+            journal.full_days = -1
+            rsync.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+            self.assertEqual(scan.call_count, 2)
+            self.assertEqual(rsync.scan.reason, "a full pass is due")
+        rsync.backupFinished('three')
+        journal.full_days = 7
+        self.assertEqual(journal.suspect(self.src, 'three', rsync.excludes), "")
+        journal.close()
+
+    def test_files_from(self):
+        """verify a usable journal gives rsync the list of changes"""
+        rsync = JournalRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        rsync.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+        rsync.backupFinished('two')
+        with open(os.path.join(self.src, "Documents", "two"), 'w') as fp:
+            fp.write("two")
+
+        rsync = JournalRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        with patch('FileJournal.RACY_SECONDS', -10):
+            rsync.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+        self.assertTrue(rsync.scan.usable)
+        self.assertIn("--files-from=%s/myocp_files_from" % self.tmp, rsync.cmd)
+        self.assertIn("--delete-missing-args", rsync.cmd)
+        self.assertIn("--partial-dir=", rsync.cmd)
+        self.assertNotIn("--delete ", rsync.cmd)
+        self.assertTrue(rsync.cmd.endswith(" %s \"15.0.0.1:/zdata/myowncrashplan/host/WORKING\" " % self.tmp))
+
+        written = []
+        def fake_run():
+            with open(rsync.files_from, 'rb') as fp:
+                written.append(fp.read())
+            return CrashPlanErrorCodes.SUCCESS
+        with patch('RsyncMethod.RsyncMethod.run', side_effect=fake_run):
+            self.assertEqual(rsync.run(), CrashPlanErrorCodes.SUCCESS)
+        self.assertEqual(written, [b'judge/Documents\0judge/Documents/two\0'])
+        self.assertFalse(os.path.exists(rsync.files_from))
+
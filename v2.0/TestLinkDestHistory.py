@@ -0,0 +1,58 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import shutil
+import tempfile
+import unittest
+
+from LinkDestHistory import LinkDestHistory
+
+BACKUPS = ['2018-01-01-010000', '2018-12-01-010000', '2018-12-20-010000', '2018-12-26-010000',
+           '2018-12-31-010000', '2019-01-01-010000', '2019-01-02-010000']
+
+
+def hits(*found):
+    return {'hits': [[n, n * 100] for n in found], 'new': [1, 10], 'relinked': [], 'complete': True, 'stats': 50, 'seconds': 0.5}
+
+
+class TestLinkDestHistory(unittest.TestCase):
+    """Test choosing the --link-dest references"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.history = LinkDestHistory(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_choose(self):
+        """verify the latest comes first and the others are spaced out by age"""
+        self.assertEqual(self.history.choose([], 4), [])
+        self.assertEqual(self.history.choose(BACKUPS, 1), ['2019-01-02-010000'])
+        self.assertEqual(self.history.choose(BACKUPS, 20),
+                         ['2019-01-02-010000', '2019-01-01-010000', '2018-12-26-010000',
+                          '2018-12-01-010000', '2018-01-01-010000'])
+        self.assertEqual(self.history.ages, {'2019-01-01-010000': 1, '2018-12-26-010000': 7,
+                                             '2018-12-01-010000': 30, '2018-01-01-010000': 90})
+
+    def test_drop_and_retry(self):
+        """verify an age that saves nothing is left out and tried again now and then"""
+        for _run in range(5):
+            refs = self.history.choose(BACKUPS, 3)
+            self.history.record(refs, hits(100, 0, 3))
+        self.assertEqual(LinkDestHistory(self.tmp).runs[-1]['ages'], {'1': [0, 0], '7': [3, 300]})
+        self.assertEqual(self.history.choose(BACKUPS, 3),
+                         ['2019-01-02-010000', '2018-12-26-010000', '2018-12-01-010000'])
+
+        for _run in range(4):
+            self.history.record(self.history.choose(BACKUPS, 3), hits(100, 0, 0))
+        self.assertEqual(self.history.choose(BACKUPS, 3),
+                         ['2019-01-02-010000', '2019-01-01-010000', '2018-12-26-010000'])
+
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
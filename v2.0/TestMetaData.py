@@ -6,6 +6,7 @@
 
 
 import os
+import json
 import shutil
 import logging
 import unittest
@@ -43,6 +44,10 @@ class FakeRemoteComms(RemoteComms):
         
     def getFilename(self):
         return self.filename
+
+    def readMetaData(self):
+        # the agent reports an empty dict when there is no .metadata
+        return json.loads(self.message) if self.status == 0 else {}
         
         
 class FakeMetaDataSettings(Settings):
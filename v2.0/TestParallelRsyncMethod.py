@@ -0,0 +1,171 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import os
+import shlex
+import shutil
+import socket
+import tempfile
+import unittest
+
+from unittest.mock import patch
+from Settings import Settings
+from CrashPlan import CrashPlanErrorCodes
+from ParallelRsyncMethod import ParallelRsyncMethod, combineResults
+from RunJournal import RunJournal
+from TestRsyncMethod import FakeLog, FakeMetaData, FakeRemoteComms
+from TestCrashPlan import FakeRemoteComms as FakeJournalComms
+
+
+class TestParallelRsyncMethod(unittest.TestCase):
+    """Test ParallelRsyncMethod"""
+
+    def setUp(self):
+        self.log = FakeLog()
+        jstr = """{ "debug-level": false,
+            "backup-destination": "mydest",
+            "exclude-files": ".a,.b",
+            "exclude-folders": "Library,c",
+            "settings-dir": "test_myocp",
+            "extra-backup-sources": "",
+            "maximum-used-percent": 90,
+            "server-address": "",
+            "server-name": "myhost",
+            "rsync-workers": 4,
+            "bandwidth-limit": 2000
+        }"""
+        with patch.object(socket, 'gethostbyname', return_value='15.0.0.1'):
+            self.settings = Settings(jstr, self.log)
+        self.comms = FakeRemoteComms(self.settings, self.log)
+        self.meta = FakeMetaData(self.log, self.comms, self.settings, "")
+
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "judge")
+        for folder in ["Documents/a", "Documents/b", "Pictures", "Music", "Library/Caches"]:
+            os.makedirs(os.path.join(self.src, folder))
+        with open(os.path.join(self.src, ".profile"), 'w') as fp:
+            fp.write("x")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_bandwidth_is_shared(self):
+        """verify each worker gets a share of the bandwidth limit"""
+        rsync = ParallelRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        self.assertEqual(rsync.bwlimit, 500)
+
+    def test_plan_without_history(self):
+        """verify top level folders become shards and excluded folders are skipped"""
+        rsync = ParallelRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        rsync.src = self.src
+        passes, shards = rsync.planShards({})
+        self.assertEqual(passes, [''])
+        self.assertEqual(sorted(shards), ['Documents', 'Music', 'Pictures'])
+
+    def test_plan_splits_large_shards(self):
+        """verify a folder bigger than a worker's share is split and queued largest first"""
+        rsync = ParallelRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        rsync.src = self.src
+        sizes = {'Documents': 9000, 'Pictures': 800, 'Music': 200}
+        passes, shards = rsync.planShards(sizes)
+        self.assertEqual(passes, ['', 'Documents'])
+        # the split folders have no history yet, so they go first
+        self.assertEqual(sorted(shards[:2]), ['Documents/a', 'Documents/b'])
+        self.assertEqual(shards[2:], ['Pictures', 'Music'])
+
+    def test_shard_command(self):
+        """verify shards are sent relative to the source's parent"""
+        rsync = ParallelRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        rsync.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+        args = shlex.split(rsync._shardCommand('Documents/a'))
+        self.assertIn('--bwlimit=500', args)
+        self.assertIn('--relative', args)
+        self.assertEqual(args[-2:], [os.path.join(self.tmp, '.', 'judge', 'Documents/a'),
+                                     '15.0.0.1:/zdata/myowncrashplan/host/WORKING'])
+        args = shlex.split(rsync._shardCommand('', recursive=False))
+        self.assertIn('--dirs', args)
+        self.assertEqual(args[-2], os.path.join(self.tmp, '.', 'judge') + '/')
+        args = shlex.split(rsync._shardCommand('Documents', recursive=False))
+        self.assertEqual(args[-2], os.path.join(self.tmp, '.', 'judge', 'Documents') + '/')
+
+        # shards running side by side each keep their partial files apart
+        partials = [[arg for arg in shlex.split(rsync._shardCommand(*shard)) if arg.startswith('--partial-dir=')]
+                    for shard in [('Documents/a',), ('Documents/b',), ('Documents', False)]]
+        self.assertEqual([len(partial) for partial in partials], [1, 1, 1])
+        self.assertEqual(len({partial[0] for partial in partials}), 3)
+
+    def test_combine_results(self):
+        """verify the shard results map on to one result"""
+        self.assertEqual(combineResults([CrashPlanErrorCodes.SUCCESS] * 3), CrashPlanErrorCodes.SUCCESS)
+        self.assertEqual(combineResults([CrashPlanErrorCodes.SUCCESS, CrashPlanErrorCodes.DISK_FULL]), CrashPlanErrorCodes.DISK_FULL)
+        self.assertEqual(combineResults([CrashPlanErrorCodes.DISK_FULL, CrashPlanErrorCodes.UNKNOWN_ERROR]), CrashPlanErrorCodes.UNKNOWN_ERROR)
+        self.assertEqual(combineResults([]), CrashPlanErrorCodes.NOT_RUN)
+
+
+    def test_resume_shards(self):
+        """verify a retry only runs the shards that did not finish, and a dry run records nothing"""
+        self.settings.set('settings-dir', self.tmp)
+        runs = RunJournal(self.tmp, FakeJournalComms(self.settings, self.log), self.log)
+        runs.begin("")
+        rsync = ParallelRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        self.assertTrue(rsync.addRunJournal(runs))
+        rsync.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+        sent = []
+        failing = ['judge/Music']
+        def process(cmd, _callback):
+            sent.append(shlex.split(cmd)[-2].split("/./")[1].rstrip('/'))
+            if sent[-1] in failing:
+                failing.remove(sent[-1])
+                return 30, ""
+            return 0, ""
+
+        with patch.object(ParallelRsyncMethod, "_process", side_effect=process):
+            self.assertNotEqual(rsync.run(), CrashPlanErrorCodes.SUCCESS)
+            self.assertEqual(sorted(sent), ['judge', 'judge/Documents', 'judge/Music', 'judge/Pictures'])
+            self.assertEqual(runs.journal['sources'][self.src]['shards']['Pictures']['path'], 'judge/Pictures')
+
+            del sent[:]
+            rsync.run2()
+            self.assertEqual(sent, ['judge/Music'])
+            self.assertEqual(runs.journal['sources'][self.src]['shards']['Music']['result'], 'FAILURE')
+
+            del sent[:]
+            self.assertEqual(rsync.run(), CrashPlanErrorCodes.SUCCESS)
+            self.assertEqual(sent, ['judge/Music'])
+
+    def test_giants(self):
+        """verify the giant new files the sizing run finds are sent in ranges before anything else"""
+        self.settings.set('settings-dir', self.tmp)
+        self.settings.set('range-split-mb', 1)
+        with open(os.path.join(self.src, "Music", "big.wav"), 'wb') as fp:
+            fp.write(bytes(2 * 1024 * 1024))
+        rsync = ParallelRsyncMethod(self.settings, self.meta, self.log, self.comms)
+        rsync.buildCommand(self.src, "/zdata/myowncrashplan/host/WORKING")
+        events = []
+        rsync.addListener(events.append)
+        sent = []
+        def process(cmd, callback):
+            sent.append(shlex.split(cmd)[-2].split("/./")[1].rstrip('/'))
+            if sent[-1] == 'judge/Music':
+                callback(">f+++++++++ 2097152 judge/Music/big.wav", False)
+                callback(">f+++++++++ 1000 judge/Music/small.wav", False)
+                callback(">f.st...... 3000000 judge/Music/changed.wav", False)
+            return 0, ""
+
+        with patch.object(ParallelRsyncMethod, "_process", side_effect=process):
+            rsync.run2()
+            self.assertEqual(rsync.giants, {self.src: {'judge/Music/big.wav': 2097152}})
+            with patch.object(rsync.ranges, "send", side_effect=lambda local, path, st: sent.append(path)) as mock_send:
+                self.assertEqual(rsync.run(), CrashPlanErrorCodes.SUCCESS)
+        mock_send.assert_called_once()
+        self.assertEqual(mock_send.call_args[0][0], os.path.join(self.src, "Music", "big.wav"))
+        self.assertEqual(sent[4], 'judge/Music/big.wav')
+        self.assertEqual(rsync.giants, {})
+        self.assertIn(('judge/Music/big.wav', '>f+++++++++'), [(event.path, event.itemize) for event in events])
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
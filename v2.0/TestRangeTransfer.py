@@ -0,0 +1,124 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import patch
+from myocp_agent import Agent
+from CrashPlanError import CrashPlanError
+from RangeTransfer import RangeTransfer, splitRanges, rangeName
+from TestRsyncMethod import FakeLog
+
+MB = 1024 * 1024
+
+
+class FakeRangeComms():
+    """hands the requests straight to an agent"""
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.puts = []
+
+    def rangeStatus(self, name):
+        return self.agent.handle({'op': 'range-status', 'name': name})['ranges']
+
+    def putRange(self, name, offset, blocks):
+        self.puts.append(offset)
+        return self.agent.putRange(name, offset, io.BytesIO(b"".join(blocks)))
+
+    def assembleRange(self, name, path, size, ranges, st):
+        reply = self.agent.handle({'op': 'range-assemble', 'name': name, 'path': path, 'size': size,
+                                   'ranges': ranges, 'mode': st.st_mode, 'mtime_ns': st.st_mtime_ns})
+        if not reply['ok']:
+            raise CrashPlanError(reply['error'])
+        return reply['bytes']
+
+
+class TestRangeTransfer(unittest.TestCase):
+    """Test sending giant files as ranges in parallel"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.agent = Agent(os.path.join(self.tmp, "server"), "laptop")
+        self.working = os.path.join(self.tmp, "server", "laptop", "WORKING")
+        os.makedirs(self.working)
+        self.comms = FakeRangeComms(self.agent)
+        self.local = os.path.join(self.tmp, "disk.img")
+        with open(self.local, 'wb') as fp:
+            fp.write(random.Random(5).randbytes(5 * MB + 123))
+        os.chmod(self.local, 0o640)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_split(self):
+        """verify the ranges cover the file in whole blocks"""
+        self.assertEqual(splitRanges(10 * MB, 4), [(0, 3 * MB), (3 * MB, 3 * MB), (6 * MB, 3 * MB), (9 * MB, MB)])
+        self.assertEqual(splitRanges(MB + 1, 4), [(0, MB), (MB, 1)])
+        self.assertEqual(splitRanges(100, 4), [(0, 100)])
+
+    def test_send(self):
+        """verify the file is put together on the server and linked into WORKING as it was"""
+        st = os.stat(self.local)
+        transfer = RangeTransfer(self.comms, FakeLog(), 4)
+        self.assertEqual(transfer.send(self.local, "judge/disk.img", st), st.st_size)
+        self.assertEqual(sorted(self.comms.puts), [0, 2 * MB, 4 * MB])
+
+        copy = os.path.join(self.working, "judge", "disk.img")
+        with open(self.local, 'rb') as one, open(copy, 'rb') as two:
+            self.assertEqual(one.read(), two.read())
+        self.assertEqual((os.stat(copy).st_mode, os.stat(copy).st_mtime_ns), (st.st_mode, st.st_mtime_ns))
+        self.assertEqual(os.listdir(os.path.join(self.tmp, "server", "laptop", ".ranges")), [])
+
+    def test_resume(self):
+        """verify the ranges already on the server are not sent again, unless they no longer match"""
+        st = os.stat(self.local)
+        name = rangeName("judge/disk.img", st)
+        with open(self.local, 'rb') as fp:
+            self.agent.putRange(name, 0, io.BytesIO(fp.read(2 * MB)))
+            fp.seek(2 * MB)
+            self.agent.putRange(name, 2 * MB, io.BytesIO(b'x' + fp.read(2 * MB)[1:]))
+        transfer = RangeTransfer(self.comms, FakeLog(), 4)
+        self.assertEqual(transfer.send(self.local, "judge/disk.img", st), st.st_size - 2 * MB)
+        self.assertEqual(sorted(self.comms.puts), [2 * MB, 4 * MB])
+
+    def test_changed(self):
+        """verify a file that changes while it is sent is left alone"""
+        st = os.stat(self.local)
+        os.utime(self.local, ns=(st.st_mtime_ns + 10 ** 9, st.st_mtime_ns + 10 ** 9))
+        with self.assertRaises(CrashPlanError):
+            RangeTransfer(self.comms, FakeLog(), 4).send(self.local, "judge/disk.img", st)
+        self.assertFalse(os.path.exists(os.path.join(self.working, "judge")))
+
+    def test_assemble_checks(self):
+        """verify the server only puts together ranges it wrote as the client read them"""
+        st = os.stat(self.local)
+        name = rangeName("judge/disk.img", st)
+        reply = self.agent.putRange(name, 0, io.BytesIO(b'abc'))
+        request = {'op': 'range-assemble', 'name': name, 'path': 'judge/disk.img', 'size': 3,
+                   'mode': st.st_mode, 'mtime_ns': st.st_mtime_ns}
+        self.assertFalse(self.agent.handle(dict(request, ranges=[[0, 3, 'f' * 64]]))['ok'])
+        self.assertFalse(self.agent.handle(dict(request, ranges=[[0, 3, reply['digest']]], size=4))['ok'])
+        self.assertFalse(self.agent.handle(dict(request, ranges=[[0, 3, reply['digest']]], path='../x'))['ok'])
+        self.assertFalse(self.agent.handle({'op': 'range-status', 'name': '../x'})['ok'])
+        self.assertTrue(self.agent.handle(dict(request, ranges=[[0, 3, reply['digest']]]))['ok'])
+
+    def test_bandwidth_limit(self):
+        """verify each stream keeps to its limit"""
+        transfer = RangeTransfer(self.comms, FakeLog(), 4, bwlimit=1024)
+        with patch('RangeTransfer.time.sleep') as mock_sleep:
+            transfer.send(self.local, "judge/disk.img", os.stat(self.local))
+        self.assertGreater(sum(args[0][0] for args in mock_sleep.call_args_list), 3)
+
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
@@ -6,10 +6,13 @@
 # pylint: disable=too-many-public-methods
 
 import os
+import socket
 import logging
+import shlex
 import getpass
 import unittest
 
+from unittest.mock import patch
 from subprocess import getstatusoutput as unix
 from Settings import Settings
 from RemoteComms import RemoteComms
@@ -29,6 +32,23 @@ class FakeLog(logging.Logger):
     def error(self, val):
         self.val['error'].append(val)
 
+    def debug(self, val):
+        self.val['debug'].append(val)
+
+
+def agentRuns(*runs):
+    """a process() that answers each call with the next (status, output),
+    the output passed to the callback a line at a time and the last line
+    kept as the tail
+    """
+    runs = list(runs)
+    def fake(_cmd, input_text=None, callback=None):
+        status, output = runs.pop(0)
+        for line in output.split('\n'):
+            callback(line, False)
+        return status, output.split('\n')[-1]
+    return fake
+
 
 # Only run this test as me as it relies on my local environment
 # It uses the current settings.json file in ~/.myocp/
@@ -105,9 +125,9 @@ class TestRemoteComms(unittest.TestCase):
             remote.remoteCopy('/Users/judge/Development/Projects/myowncrashplan/v2.0/spam.log')
 
         self.assertIsInstance(cpe.exception, CrashPlanError)
-        self.assertEqual(repr(cpe.exception.value), "\"ERROR: remote command failed. (['scp', '/Users/judge/Development/Projects/myowncrashplan/v2.0/spam.log', '192.168.0.7:/tmp/fred/spam.log'])\"")
+        self.assertEqual(repr(cpe.exception.value), "\"ERROR: remote command failed. (['scp', '-o', 'ControlMaster=auto', '-o', 'ControlPath=/Users/judge/.myocp/ssh-%r@%h:%p', '-o', 'ControlPersist=600', '/Users/judge/Development/Projects/myowncrashplan/v2.0/spam.log', '192.168.0.7:/tmp/fred/spam.log'])\"")
         
-        self.assertEqual(remote.log.getVal('error').split('|')[0], "(remoteCommand): ['scp', '/Users/judge/Development/Projects/myowncrashplan/v2.0/spam.log', '192.168.0.7:/tmp/fred/spam.log']")
+        self.assertEqual(remote.log.getVal('error').split('|')[0], "(remoteCommand): ['scp', '-o', 'ControlMaster=auto', '-o', 'ControlPath=/Users/judge/.myocp/ssh-%r@%h:%p', '-o', 'ControlPersist=600', '/Users/judge/Development/Projects/myowncrashplan/v2.0/spam.log', '192.168.0.7:/tmp/fred/spam.log']")
         self.assertEqual(remote.log.getVal('error').split('|')[1], "(remoteCommand): 1 scp: /tmp/fred/spam.log: No such file or directory")
     
         st, rt = remote.remoteCommand("ls -l /tmp/fred/spam.log")
@@ -130,6 +150,109 @@ class TestRemoteComms(unittest.TestCase):
         self.assertEqual(st, 0)
         self.assertEqual(rt, '')
 
+class TestRemoteCommsMaster(unittest.TestCase):
+    """Test the multiplexed ssh master used by RemoteComms"""
+
+    def setUp(self):
+        self.log = FakeLog()
+        jstr = """{ "debug-level": false,
+            "backup-destination": "/zdata/myowncrashplan",
+            "exclude-files": ".a,.b",
+            "exclude-folders": "c,d",
+            "settings-dir": "test_myocp",
+            "extra-backup-sources": "",
+            "maximum-used-percent": 90,
+            "server-address": "",
+            "server-name": "myhost"
+        }"""
+        with patch.object(socket, 'gethostbyname', return_value='15.0.0.1'):
+            self.settings = Settings(jstr, self.log)
+        self.remote = RemoteComms(self.settings, self.log)
+
+    def test_ssh_options(self):
+        """verify every connection is routed through the same control socket"""
+        opts = self.remote.sshOptions()
+        control_path = os.path.join(os.environ['HOME'], 'test_myocp', 'ssh-%r@%h:%p')
+        self.assertIn("ControlPath=%s" % control_path, opts)
+        self.assertIn("ControlMaster=auto", opts)
+        self.assertTrue(self.remote.sshCommand().startswith("ssh -q -o ControlMaster=auto"))
+
+    @patch('RemoteComms.process', return_value=(0, 'ok'))
+    def test_remote_command_uses_master(self, mock_process):
+        """verify remoteCommand and remoteCopy share the control socket"""
+        self.remote.remoteCommand("ls")
+        cmd = mock_process.call_args[0][0]
+        self.assertEqual(cmd[0], 'ssh')
+        self.assertEqual(cmd[-2:], ['15.0.0.1', 'ls'])
+        self.assertIn("ControlPath=%s" % self.remote.control_path, cmd)
+
+        self.remote.remoteCopy('spam.log')
+        cmd = mock_process.call_args[0][0]
+        self.assertEqual(cmd[0], 'scp')
+        self.assertIn("ControlPath=%s" % self.remote.control_path, cmd)
+
+    @patch('RemoteComms.process', return_value=(0, ''))
+    def test_open_close_master(self, mock_process):
+        """verify the master is started and torn down"""
+        self.assertTrue(self.remote.openMaster())
+        self.assertEqual(mock_process.call_args[0][0][-2:], ['15.0.0.1', 'true'])
+        self.assertTrue(self.remote.closeMaster())
+        self.assertEqual(mock_process.call_args[0][0][:4], ['ssh', '-q', '-O', 'exit'])
+
+    @patch.object(RemoteComms, 'installAgent')
+    @patch('RemoteComms.process')
+    def test_agent_installed_on_first_use(self, mock_process, mock_install):
+        """verify a missing agent is installed and the batch retried"""
+        mock_process.side_effect = agentRuns((2, "python3: can't open file '/x/myocp_agent.py'"),
+                                             (0, '{"ok": true}\n{"ok": true, "backups": []}'))
+        replies = self.remote.agent([{'op': 'ensure-root'}, {'op': 'list'}])
+        assert mock_install.called
+        self.assertEqual(replies[1]['backups'], [])
+        self.assertEqual(mock_process.call_args[1]['input_text'], '{"op": "ensure-root"}\n{"op": "list"}\n')
+
+    def test_agent_command_quoted(self):
+        """verify the remote shell gets each argument of the agent command back as it was"""
+        self.settings.set('backup-destination', "/backups/my disk;rm -rf ~")
+        remote = self.remote._agentCommand("--put-range", "ab12", 1024)
+        self.assertEqual(shlex.split(remote[-1])[-5:], ["--put-range", "/backups/my disk;rm -rf ~",
+                                                        self.settings('local-hostname'), "ab12", "1024"])
+
+    @patch('RemoteComms.process', return_value=(255, 'Connection refused'))
+    def test_agent_failure(self, mock_process):
+        """verify a failed round trip raises CrashPlanError"""
+        with self.assertRaises(CrashPlanError):
+            self.remote.agent([{'op': 'list'}])
+
+    @patch('RemoteComms.process')
+    def test_agent_replies_beyond_tail(self, mock_process):
+        """verify every reply is taken, however few lines process() keeps"""
+        mock_process.side_effect = agentRuns((0, "\n".join('{"ok": true, "n": %d}' % n for n in range(3000))))
+        replies = self.remote.agent([{'op': 'space'}] * 3000)
+        self.assertEqual([reply['n'] for reply in replies], list(range(3000)))
+
+    @patch('RemoteComms.CATALOG_CHUNK', 2)
+    @patch('RemoteComms.process')
+    def test_finalize(self, mock_process):
+        """verify the catalog batches go one a call after the backup is made, and a failure among them is not fatal"""
+        self.remote.resumed = False
+        mock_process.side_effect = agentRuns((0, '{"ok": true}'),
+                                             (0, '{"ok": true, "rescanned": false}'),
+                                             (0, '{"ok": true, "rescanned": false}'),
+                                             (0, '{"ok": true, "files": 5, "bytes": 50}'),
+                                             (0, '{"ok": true, "exclusive": {"2019-01-03-000000": 10}}\n{"ok": true, "free": 7}'))
+        finished = self.remote.finalize('2019-01-03-000000', {}, {'updated': ['a', 'b', 'c'], 'deleted': []})
+        self.assertEqual(finished, {'stored': 10, 'free': 7})
+        ops = [[line for line in call[1]['input_text'].split('\n') if line] for call in mock_process.call_args_list]
+        self.assertEqual([len(batch) for batch in ops], [1, 1, 1, 1, 2])
+        self.assertIn('"updated": ["c"]', ops[2][0])
+
+        mock_process.side_effect = agentRuns((0, '{"ok": true}'), (255, 'Connection reset'),
+                                             (0, '{"ok": true, "exclusive": {}}\n{"ok": true, "free": 7}'))
+        finished = self.remote.finalize('2019-01-04-000000', {}, None)
+        self.assertEqual(finished, {'stored': 0, 'free': 7})
+        self.assertIn('full', mock_process.call_args_list[-2][1]['input_text'])
+
+
 if __name__ == '__main__':
 
     unittest.main(verbosity=1)
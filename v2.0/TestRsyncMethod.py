@@ -15,7 +15,7 @@ from unittest.mock import patch, Mock
 from Settings import Settings
 from RemoteComms import RemoteComms
 from MetaData import MetaData
-from RsyncMethod import RsyncMethod
+from RsyncMethod import RsyncMethod, RSYNC, BACKUPLOG_FILE, partialName
 from CrashPlan import CrashPlanErrorCodes
 
 class FakeLog(logging.Logger):
@@ -59,6 +59,9 @@ class FakeRemoteComms(RemoteComms):
         
     def getBackupList(self):
         return ['one', 'two']
+
+    def sshCommand(self):
+        return 'ssh -q -o ControlPath=/tmp/ctl'
         
 class FakeStdOut():
     def __init__(self):
@@ -113,14 +116,14 @@ class TestRsyncMethod(unittest.TestCase):
         rsync = RsyncMethod(self.settings, self.meta, self.log, self.comms, False)
         rsync.settings.set("backup-destination", '/tmp')
         rsync.buildCommand("/Users/judge", "/zdata/myowncrashplan/Prometheus.local/WORKING")
-        self.assertEqual(rsync.cmd, 'rsync -av --log-file=/Users/judge/.myocp/backup.log --link-dest=../two --bwlimit=2500 --timeout=300 --delete --delete-excluded  --exclude-from=/Users/judge/test_myocp/myocp_excl /Users/judge "15.0.0.1:/zdata/myowncrashplan/Prometheus.local/WORKING" ')
+        self.assertEqual(rsync.cmd, RSYNC + ' -av --log-file=' + BACKUPLOG_FILE + ' -e \'ssh -q -o ControlPath=/tmp/ctl\' --link-dest=../two --partial-dir=/tmp/' + self.settings('local-hostname') + '/WORKING/.myocp-partial/' + partialName("/Users/judge") + ' --bwlimit=2500 --timeout=300 --delete --delete-excluded --out-format=\'%i %l %n%L\' --stats --info=progress2 --exclude-from=' + os.path.join(os.environ['HOME'], 'test_myocp', 'myocp_excl') + ' /Users/judge "15.0.0.1:/zdata/myowncrashplan/Prometheus.local/WORKING" ')
 
     def test_buildCommand_2(self):
         """verify buildCommand returns expected string"""
         rsync = RsyncMethod(self.settings, self.meta, self.log, self.comms, True)
         rsync.settings.set("backup-destination", '/tmp')
         rsync.buildCommand("/Users/judge", "/zdata/myowncrashplan/Prometheus.local/WORKING")
-        self.assertEqual(rsync.cmd, 'rsync -av --log-file=/Users/judge/.myocp/backup.log --dry-run --link-dest=../two --bwlimit=2500 --timeout=300 --delete --delete-excluded  --exclude-from=/Users/judge/test_myocp/myocp_excl /Users/judge "15.0.0.1:/zdata/myowncrashplan/Prometheus.local/WORKING" ')
+        self.assertEqual(rsync.cmd, RSYNC + ' -av --dry-run -e \'ssh -q -o ControlPath=/tmp/ctl\' --link-dest=../two --bwlimit=2500 --timeout=300 --delete --delete-excluded --out-format=\'%i %l %n%L\' --stats --info=progress2 --exclude-from=' + os.path.join(os.environ['HOME'], 'test_myocp', 'myocp_excl') + ' /Users/judge "15.0.0.1:/zdata/myowncrashplan/Prometheus.local/WORKING" ')
 
     def test__create_excl_file_1(self):
         """verify rsync_excl fie is  created."""
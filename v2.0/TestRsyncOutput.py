@@ -0,0 +1,95 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import unittest
+
+from RsyncOutput import RsyncParser, RsyncChange, parseItemized
+
+SAMPLE = """sending incremental file list
+cd+++++++++ 4096 judge/
+>f+++++++++ 1200 judge/new file.txt
+>f.st...... 3400 judge/changed.txt
+*deleting   0 judge/old.txt
+cL+++++++++ 7 judge/link -> new file.txt
+hf          1200 judge/copy.txt => judge/new file.txt
+.f          99 judge/same.txt
+
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 3 (reg: 1, dir: 1, link: 1)
+Number of deleted files: 1 (reg: 1)
+Number of regular files transferred: 2
+Total file size: 12,345,678 bytes
+Total transferred file size: 4,600 bytes
+Literal data: 4,600 bytes
+Matched data: 0 bytes
+File list size: 65,432
+File list generation time: 0.003 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 80,000
+Total bytes received: 1,024
+
+sent 80,000 bytes  received 1,024 bytes  16,204.80 bytes/sec
+total size is 12,345,678  speedup is 152.37
+"""
+
+
+class TestRsyncOutput(unittest.TestCase):
+    """Test the rsync output parser"""
+
+    def test_parse_itemized(self):
+        """verify each kind of itemized line"""
+        self.assertEqual(parseItemized('>f+++++++++ 1200 judge/new file.txt').change, RsyncChange.NEW)
+        self.assertEqual(parseItemized('<f.st...... 10 judge/a').change, RsyncChange.CHANGED)
+        self.assertEqual(parseItemized('*deleting   0 judge/old.txt').path, 'judge/old.txt')
+        self.assertEqual(parseItemized('cL+++++++++ 7 judge/link -> target').path, 'judge/link')
+        self.assertEqual(parseItemized('hf          5 a => b').change, RsyncChange.HARDLINKED)
+        self.assertIsNone(parseItemized('sent 80 bytes  received 1 bytes  16.80 bytes/sec'))
+        self.assertIsNone(parseItemized('total size is 12  speedup is 1.00'))
+
+    def test_parser_events_and_stats(self):
+        """verify events are streamed to listeners and the stats are collected"""
+        events = []
+        parser = RsyncParser()
+        parser.addListener(events.append)
+        for line in SAMPLE.split('\n'):
+            parser.feed(line)
+        parser.feed('rsync: link_stat "/x" failed: No such file or directory (2)', True)
+        stats = parser.finish()
+
+        self.assertEqual([e.change for e in events],
+                         [RsyncChange.DIRECTORY, RsyncChange.NEW, RsyncChange.CHANGED, RsyncChange.DELETED,
+                          RsyncChange.SYMLINK, RsyncChange.HARDLINKED, RsyncChange.UNCHANGED])
+        self.assertEqual(events[1].path, 'judge/new file.txt')
+        self.assertEqual(parser.storedBytes(), 4600)
+        self.assertEqual(stats.files, 1234)
+        self.assertEqual(stats.deleted, 1)
+        self.assertEqual(stats.total_size, 12345678)
+        self.assertEqual(stats.transferred_size, 4600)
+        self.assertEqual(stats.file_list_size, 65432)
+        self.assertEqual(stats.bytes_received, 1024)
+
+    def test_projection(self):
+        """verify the size of the run is projected from the progress lines once it is far enough through"""
+        parser = RsyncParser()
+        parser.feed('>f+++++++++ 1000 judge/a')
+        parser.feed('          1,000 100%    1.00MB/s    0:00:00 (xfr#1, ir-chk=95/100)')
+        self.assertIsNone(parser.projectedBytes())
+        parser.feed('>f.st...... 1000 judge/b')
+        parser.feed('          2,000 100%    1.00MB/s    0:00:00 (xfr#2, to-chk=150/200)')
+        self.assertEqual(parser.progress(), 0.25)
+        self.assertEqual(parser.projectedBytes(), 8000)
+        self.assertIsNone(parser.finish())
+
+    def test_parser_without_stats(self):
+        """verify finish returns None if rsync died before the stats"""
+        parser = RsyncParser()
+        parser.feed('>f+++++++++ 1200 judge/new')
+        self.assertIsNone(parser.finish())
+
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
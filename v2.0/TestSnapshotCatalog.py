@@ -0,0 +1,106 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from SnapshotClone import cloneSnapshot
+from SnapshotCatalog import CATALOG_DB
+from myocp_agent import Agent
+
+
+class TestSnapshotCatalog(unittest.TestCase):
+    """Test the snapshot catalog"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, "laptop")
+        self.snap1 = "2019-01-01-000000"
+        self.snap2 = "2019-01-02-000000"
+        self.agent = Agent(self.tmp, "laptop")
+        for name in ["user/a/x", "user/a/y", "user/a/sub/f", "user/b/z"]:
+            self.write(self.snap1, name, name)
+        self.catalog(self.snap1, full=True)
+
+        # the next backup, as --link-dest would leave it
+        cloneSnapshot(os.path.join(self.root, self.snap1), os.path.join(self.root, self.snap2))
+        os.unlink(self.path(self.snap2, "user/a/x"))
+        self.write(self.snap2, "user/a/x", "changed")
+        self.write(self.snap2, "user/a/new", "new")
+        os.unlink(self.path(self.snap2, "user/a/y"))
+        shutil.rmtree(self.path(self.snap2, "user/a/sub"))
+        os.utime(self.path(self.snap2, "user/a"), (1000000000, 1000000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, snap, name):
+        return os.path.join(self.root, snap, name)
+
+    def write(self, snap, name, text):
+        os.makedirs(os.path.dirname(self.path(snap, name)), exist_ok=True)
+        with open(self.path(snap, name), 'w') as fp:
+            fp.write(text)
+
+    def catalog(self, snap, full=False, updated=(), deleted=()):
+        reply = self.agent.handle({'op': 'catalog-update', 'snapshot': snap, 'full': full,
+                                   'updated': list(updated), 'deleted': list(deleted)})
+        self.assertTrue(reply['ok'])
+        reply = self.agent.handle({'op': 'catalog-close', 'snapshot': snap})
+        self.assertTrue(reply['ok'])
+        return reply
+
+    def query(self, query, **args):
+        request = {'op': 'catalog-query', 'query': query}
+        request.update(args)
+        reply = self.agent.handle(request)
+        self.assertTrue(reply['ok'])
+        return reply['result']
+
+    def check(self):
+        history = {entry['path']: entry['snapshots'] for entry in self.query('history', path='user/a') if entry['kind'] == 'f'}
+        self.assertEqual(history['user/a/y'], [self.snap1])
+        self.assertEqual(history['user/a/sub/f'], [self.snap1])
+        self.assertEqual(history['user/a/new'], [self.snap2])
+        self.assertEqual([entry['snapshots'] for entry in self.query('history', path='user/a/x')], [[self.snap1], [self.snap2]])
+        self.assertEqual(self.query('history', path='user/b/z')[0]['snapshots'], [self.snap1, self.snap2])
+        self.assertEqual(self.query('changes', snapshot=self.snap2),
+                         {'changed': ['user/a/new', 'user/a/x'], 'removed': ['user/a/sub/f', 'user/a/y']})
+        self.assertEqual([(s['name'], s['files']) for s in self.query('snapshots')], [(self.snap1, 4), (self.snap2, 3)])
+
+    def test_incremental(self):
+        """verify the catalog is updated from the change stream alone"""
+        reply = self.agent.handle({'op': 'catalog-update', 'snapshot': self.snap2,
+                                   'updated': ['user/', 'user/a/', 'user/b/', 'user/a/x', 'user/a/new'], 'deleted': []})
+        self.assertEqual(reply['rescanned'], False)
+        self.assertEqual(self.query('latest'), self.snap1)
+        self.agent.handle({'op': 'catalog-close', 'snapshot': self.snap2})
+        self.check()
+
+        ino = os.lstat(self.path(self.snap2, "user/b/z")).st_ino
+        self.assertEqual([entry['path'] for entry in self.query('inode', ino=ino)], ['user/b/z'])
+
+    def test_rescan(self):
+        """verify a walk of the new snapshot gives the same catalog"""
+        self.catalog(self.snap2, full=True)
+        self.check()
+        self.assertEqual(self.query('latest'), self.snap2)
+
+    def test_drop(self):
+        """verify pruned snapshots are dropped with the versions only they held"""
+        self.catalog(self.snap2, updated=['user/a/', 'user/a/x', 'user/a/new'])
+        shutil.rmtree(os.path.join(self.root, self.snap1))
+        self.assertEqual(self.agent.handle({'op': 'catalog-close', 'snapshot': self.snap2})['dropped'], [self.snap1])
+        self.assertEqual(self.query('history', path='user/a/y'), [])
+        self.assertEqual(self.query('history', path='user/b/z')[0]['snapshots'], [self.snap2])
+        self.assertTrue(os.path.exists(os.path.join(self.root, CATALOG_DB)))
+
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
@@ -0,0 +1,63 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from SnapshotClone import cloneSnapshot
+from myocp_agent import Agent
+
+
+class TestSnapshotClone(unittest.TestCase):
+    """Test the snapshot clone engine"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "2019-01-01-000000")
+        for folder in ["a/b/c", "a/d", "e"]:
+            os.makedirs(os.path.join(self.src, folder))
+        for name in ["top", "a/one", "a/b/c/two", "e/three"]:
+            with open(os.path.join(self.src, name), 'w') as fp:
+                fp.write(name)
+        os.symlink("a/one", os.path.join(self.src, "link"))
+        os.symlink("/nowhere", os.path.join(self.src, "e/dangling"))
+        os.chmod(os.path.join(self.src, "a/d"), 0o750)
+        os.utime(os.path.join(self.src, "a/b"), (1000000000, 1000000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_clone(self):
+        """verify files are hard linked and folders recreated with their attributes"""
+        dest = os.path.join(self.tmp, "WORKING")
+        stats = cloneSnapshot(self.src, dest, workers=3)
+
+        self.assertEqual(stats.files, 6)
+        self.assertEqual(stats.dirs, 5)
+        self.assertEqual(stats.errors, [])
+        self.assertGreater(stats.rate(), 0)
+
+        for name in ["top", "a/one", "a/b/c/two", "e/three"]:
+            self.assertTrue(os.path.samefile(os.path.join(self.src, name), os.path.join(dest, name)))
+        self.assertTrue(os.path.islink(os.path.join(dest, "link")))
+        self.assertEqual(os.readlink(os.path.join(dest, "e/dangling")), "/nowhere")
+        self.assertEqual(os.stat(os.path.join(dest, "a/d")).st_mode & 0o777, 0o750)
+        self.assertEqual(os.stat(os.path.join(dest, "a/b")).st_mtime, 1000000000)
+
+    def test_agent_clone(self):
+        """verify the agent clones a backup folder into WORKING"""
+        agent = Agent(os.path.dirname(self.tmp), os.path.basename(self.tmp))
+        reply = agent.handle({'op': 'clone', 'src': self.src})
+        self.assertTrue(reply['ok'])
+        self.assertEqual(reply['clone']['files'], 6)
+        self.assertTrue(os.path.isdir(os.path.join(self.tmp, "WORKING", "a", "b", "c")))
+
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
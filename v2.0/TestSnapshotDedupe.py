@@ -0,0 +1,76 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from SnapshotDedupe import dedupe, DEDUPE_REPORT
+
+
+class TestSnapshotDedupe(unittest.TestCase):
+    """Test the cross host dedupe pass"""
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.files = {"laptop/2019-01-01-000000/user/Downloads/big.iso": b'a' * 20000,
+                      "laptop/2019-01-02-000000/user/renamed.iso": b'a' * 20000,
+                      "desktop/2019-01-01-120000/user/copy.iso": b'a' * 20000,
+                      "desktop/2019-01-01-120000/user/other": b'b' * 20000,
+                      "desktop/2019-01-01-120000/user/newer.iso": b'a' * 20000,
+                      "laptop/WORKING/user/big.iso": b'a' * 20000}
+        for name, data in self.files.items():
+            path = os.path.join(self.dest, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as fp:
+                fp.write(data)
+            os.utime(path, (1000000000, 1000000000))
+        os.utime(os.path.join(self.dest, "desktop/2019-01-01-120000/user/newer.iso"), (1100000000, 1100000000))
+        os.utime(os.path.join(self.dest, "desktop/2019-01-01-120000/user"), (1200000000, 1200000000))
+        os.makedirs(os.path.join(self.dest, "laptop/.trash"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def ino(self, name):
+        return os.lstat(os.path.join(self.dest, name)).st_ino
+
+    def test_dedupe(self):
+        """verify identical files across backups and hosts are linked and the space counted"""
+        report = dedupe(self.dest, workers=2, min_size=1)
+        self.assertEqual(report['backups'], 3)
+        self.assertEqual(report['linked'], 2)
+        self.assertEqual(report['errors'], 0)
+        self.assertGreaterEqual(report['reclaimed'], 2 * 20000)
+
+        canon = self.ino("laptop/2019-01-01-000000/user/Downloads/big.iso")
+        self.assertEqual(self.ino("laptop/2019-01-02-000000/user/renamed.iso"), canon)
+        self.assertEqual(self.ino("desktop/2019-01-01-120000/user/copy.iso"), canon)
+        # a different mtime, different contents and WORKING are left alone
+        self.assertNotEqual(self.ino("desktop/2019-01-01-120000/user/newer.iso"), canon)
+        self.assertNotEqual(self.ino("laptop/WORKING/user/big.iso"), canon)
+        self.assertEqual(os.lstat(os.path.join(self.dest, "desktop/2019-01-01-120000/user")).st_mtime, 1200000000)
+        self.assertEqual([n for n in os.listdir(os.path.join(self.dest, "desktop/2019-01-01-120000/user")) if n.startswith('.')], [])
+
+        with open(os.path.join(self.dest, DEDUPE_REPORT)) as fp:
+            self.assertEqual(json.load(fp)['linked'], 2)
+
+        # done backups are not walked again
+        self.assertEqual(dedupe(self.dest, workers=2, min_size=1)['backups'], 0)
+
+    def test_ignore_times(self):
+        """verify --ignore-times links files whose mtime differs"""
+        report = dedupe(self.dest, workers=1, min_size=1, ignore_times=True)
+        self.assertEqual(report['linked'], 3)
+        self.assertEqual(self.ino("desktop/2019-01-01-120000/user/newer.iso"),
+                         self.ino("laptop/2019-01-01-000000/user/Downloads/big.iso"))
+
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
@@ -0,0 +1,69 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from SnapshotDelete import deleteSnapshot, Throttle
+
+
+class TestSnapshotDelete(unittest.TestCase):
+    """Test the snapshot deletion engine"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.snap = os.path.join(self.tmp, "2019-01-01-000000")
+        self.keep = os.path.join(self.tmp, "2019-01-02-000000")
+        os.makedirs(self.keep)
+        for folder in ["a/b/c", "a/d", "e"]:
+            os.makedirs(os.path.join(self.snap, folder))
+        for name in ["a/one", "a/b/c/two", "e/three"]:
+            with open(os.path.join(self.snap, name), 'wb') as fp:
+                fp.write(b'x' * 10000)
+        # a file shared with another snapshot frees nothing
+        os.link(os.path.join(self.snap, "a/one"), os.path.join(self.keep, "one"))
+        os.symlink("a/one", os.path.join(self.snap, "link"))
+        self.unique = sum(os.lstat(os.path.join(self.snap, name)).st_blocks * 512 for name in ["a/b/c/two", "e/three"])
+        os.chmod(os.path.join(self.snap, "a/b/c"), 0o500)
+        os.chmod(os.path.join(self.snap, "a/b"), 0o000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_delete(self):
+        """verify the snapshot is removed, locked folders included, and freed bytes are counted"""
+        reports = []
+        stats = deleteSnapshot(self.snap, workers=3, progress=reports.append)
+
+        self.assertFalse(os.path.lexists(self.snap))
+        self.assertEqual(stats.errors, [])
+        self.assertEqual(stats.files, 4)
+        self.assertEqual(stats.dirs, 6)
+        self.assertTrue(os.path.exists(os.path.join(self.keep, "one")))
+        self.assertGreaterEqual(stats.freed, self.unique)
+        self.assertEqual(stats.asDict()['files'], 4)
+
+    def test_throttle(self):
+        """verify the throttle spaces out operations"""
+        throttle = Throttle(200)
+        start = time.monotonic()
+        for _i in range(21):
+            throttle()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+        unlimited = Throttle(0)
+        start = time.monotonic()
+        for _i in range(1000):
+            unlimited()
+        self.assertLess(time.monotonic() - start, 0.05)
+
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
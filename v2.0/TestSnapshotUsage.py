@@ -0,0 +1,97 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from SnapshotUsage import SnapshotUsage, planPrune, freedBy
+from myocp_agent import Agent
+
+
+class TestSnapshotUsage(unittest.TestCase):
+    """Test the snapshot usage accounting and prune planner"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, "laptop")
+        self.names = ["2019-01-01-000000", "2019-01-02-000000", "2019-01-03-000000"]
+        for name in self.names:
+            os.makedirs(os.path.join(self.root, name))
+        # shared by all three, by the first two, and one file each
+        self.write(self.names[0], "all", 40000)
+        self.write(self.names[0], "pair", 30000)
+        for name in self.names:
+            self.write(name, "own", 20000)
+        self.link(self.names[0], self.names[1], "all")
+        self.link(self.names[0], self.names[2], "all")
+        self.link(self.names[0], self.names[1], "pair")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, snap, name, size):
+        with open(os.path.join(self.root, snap, name), 'wb') as fp:
+            fp.write(b'x' * size)
+
+    def link(self, src, dest, name):
+        os.link(os.path.join(self.root, src, name), os.path.join(self.root, dest, name))
+
+    def blocks(self, snap, name):
+        return os.lstat(os.path.join(self.root, snap, name)).st_blocks * 512
+
+    def test_accounting(self):
+        """verify exclusive bytes and groups, and that updates only add what is new"""
+        usage = SnapshotUsage(self.root, workers=2)
+        self.assertEqual(usage.update(self.names[:2]), (self.names[:2], []))
+        self.assertEqual(usage.update(self.names), ([self.names[2]], []))
+
+        groups = usage.groups()
+        self.assertEqual(groups[tuple(self.names[:2])], self.blocks(self.names[0], "pair"))
+        self.assertEqual(groups[tuple(self.names)], self.blocks(self.names[0], "all"))
+        exclusive = usage.exclusive()
+        self.assertGreaterEqual(exclusive[self.names[0]], self.blocks(self.names[0], "own"))
+        self.assertLess(exclusive[self.names[0]], self.blocks(self.names[0], "own") + self.blocks(self.names[0], "pair"))
+
+        # dropping the first makes the pair exclusive to the second
+        shutil.rmtree(os.path.join(self.root, self.names[0]))
+        self.assertEqual(usage.update(self.names[1:]), ([], [self.names[0]]))
+        self.assertGreaterEqual(usage.exclusive()[self.names[1]],
+                                self.blocks(self.names[1], "own") + self.blocks(self.names[1], "pair"))
+        usage.close()
+
+    def test_plan(self):
+        """verify the planner finds the smallest set of snapshots for the target"""
+        a, b, c, d = "a", "b", "c", "d"
+        groups = {(a,): 10, (b,): 10, (c,): 50, (a, b): 100, (c, d): 500}
+        self.assertEqual(planPrune(groups, [a, b, c], 0), ([], 0))
+        # a alone frees little, a and b together free the shared bytes
+        self.assertEqual(planPrune(groups, [a, b, c], 100), ([a, b], 120))
+        self.assertEqual(planPrune(groups, [a, b, c], 40), ([c], 50))
+        self.assertEqual(planPrune(groups, [a, b, c], 0, minimum=1), ([c], 50))
+        self.assertEqual(planPrune(groups, [a, b, c], 10000), ([a, b, c], 170))
+        self.assertEqual(freedBy(groups, {a, b, c, d}), 670)
+
+    def test_agent_prune_plan(self):
+        """verify the agent plans against the filesystem and never picks the newest backup"""
+        agent = Agent(self.tmp, "laptop")
+        reply = agent.handle({'op': 'prune-plan', 'max-percent': 0})
+        self.assertTrue(reply['ok'])
+        self.assertEqual(reply['remove'], [os.path.join(self.root, name) for name in self.names[:2]])
+        self.assertEqual(agent.handle({'op': 'prune-plan', 'max-percent': 100})['remove'], [])
+
+        reply = agent.handle({'op': 'usage'})
+        self.assertEqual(reply['added'], [])
+        self.assertEqual(sorted(reply['exclusive']), self.names)
+
+        agent.handle({'op': 'trash', 'path': self.names[0]})
+        self.assertEqual(agent.handle({'op': 'space'})['estimating'], 0)
+
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
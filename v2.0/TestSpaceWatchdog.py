@@ -0,0 +1,124 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import time
+import subprocess
+import unittest
+
+from unittest.mock import patch
+from SpaceWatchdog import SpaceWatchdog
+from TestRsyncMethod import FakeLog
+
+
+def stopped(proc):
+    """is the process stopped, signals take a moment to arrive"""
+    for _try in range(100):
+        with open("/proc/%d/stat" % proc.pid, 'r') as fp:
+            if fp.read().rsplit(')', 1)[1].split()[0] == 'T':
+                return True
+        time.sleep(0.01)
+    return False
+
+
+class FakeSpaceComms():
+    def __init__(self, spaces):
+        self.spaces = spaces
+        self.seen = []
+
+    def space(self):
+        space = self.spaces.pop(0) if len(self.spaces) > 1 else self.spaces[0]
+        self.seen.append(space)
+        return space
+
+
+class TestSpaceWatchdog(unittest.TestCase):
+    """Test pausing the transfer while room is made"""
+
+    def setUp(self):
+        self.proc = subprocess.Popen(["sleep", "30"])
+        self.needs = []
+
+    def tearDown(self):
+        self.proc.kill()
+        self.proc.wait()
+
+    def watchdog(self, spaces):
+        watchdog = SpaceWatchdog(FakeSpaceComms(spaces), FakeLog(), 1000, 30, self.needs.append)
+        watchdog.attach(self.proc)
+        return watchdog
+
+    def test_enough_space(self):
+        """verify nothing is paused while there is room"""
+        watchdog = self.watchdog([{'free': 1000, 'pending': 0, 'estimating': 0}])
+        self.assertFalse(watchdog.check())
+        self.assertEqual(self.needs, [])
+
+    def test_pause_while_reclaiming(self):
+        """verify room is made while the process runs, and it is stopped until the reclaimer has freed enough"""
+        states = []
+        def low(need):
+            self.needs.append(need)
+            states.append(stopped(self.proc))
+        watchdog = SpaceWatchdog(FakeSpaceComms([{'free': 10, 'pending': 0, 'estimating': 0},
+                                                 {'free': 500, 'pending': 5000, 'estimating': 0},
+                                                 {'free': 2500, 'pending': 0, 'estimating': 0}]),
+                                 FakeLog(), 1000, 30, low)
+        watchdog.attach(self.proc)
+        space = watchdog.comms.space
+        def waiting():
+            states.append(stopped(self.proc))
+            return space()
+        with patch('SpaceWatchdog.PAUSE_POLL', 0), patch.object(watchdog.comms, 'space', side_effect=waiting):
+            self.assertTrue(watchdog.check())
+        self.assertEqual(states, [False, False, False, True])
+        self.assertEqual(self.needs, [2000])
+        self.assertEqual(len(watchdog.comms.seen), 3)
+        self.assertFalse(stopped(self.proc))
+
+    def test_pause_limited(self):
+        """verify a pause ends at PAUSE_MAX however long the reclaimer takes"""
+        watchdog = self.watchdog([{'free': 10, 'pending': 0, 'estimating': 0},
+                                  {'free': 10, 'pending': 5000, 'estimating': 0}])
+        with patch('SpaceWatchdog.PAUSE_POLL', 0), patch('SpaceWatchdog.PAUSE_MAX', 0.2):
+            self.assertTrue(watchdog.check())
+        self.assertFalse(stopped(self.proc))
+
+    def test_nothing_to_reclaim(self):
+        """verify the process is never stopped when no room can be made"""
+        watchdog = self.watchdog([{'free': 10, 'pending': 0, 'estimating': 0}])
+        self.assertFalse(watchdog.check())
+        self.assertEqual(self.needs, [2000])
+        self.assertEqual(len(watchdog.comms.seen), 2)
+        self.assertFalse(stopped(self.proc))
+
+    def test_finished_process(self):
+        """verify there is nothing to pause once the process has gone"""
+        watchdog = self.watchdog([{'free': 10, 'pending': 0, 'estimating': 0}])
+        watchdog.detach(self.proc)
+        self.assertFalse(watchdog.check())
+        self.assertEqual(self.needs, [])
+
+    def test_projection_makes_room(self):
+        """verify room is made for the bytes the transfer is projected to need"""
+        watchdog = self.watchdog([{'free': 5000, 'pending': 0, 'estimating': 0},
+                                  {'free': 5000, 'pending': 4000, 'estimating': 0}])
+        watchdog.project = lambda: (1000, 9000)
+        self.assertFalse(watchdog.check())
+        self.assertEqual(self.needs, [8000 + 2000])
+        self.assertFalse(watchdog.aborted)
+
+        watchdog.project = lambda: None
+        self.assertFalse(watchdog.check())
+        self.assertEqual(len(self.needs), 1)
+
+    def test_projection_does_not_fit(self):
+        """verify the transfer is stopped when there is no making room for what is projected"""
+        watchdog = self.watchdog([{'free': 5000, 'pending': 0, 'estimating': 0}])
+        watchdog.project = lambda: (1000, 9000)
+        self.assertTrue(watchdog.check())
+        self.assertTrue(watchdog.aborted)
+        self.assertEqual(self.proc.wait(5), -15)
+
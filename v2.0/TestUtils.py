@@ -0,0 +1,61 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+# pylint: disable=line-too-long
+
+import sys
+import unittest
+
+from Utils import process
+
+
+class TestUtils(unittest.TestCase):
+    """Test Utils"""
+
+    def test_process_status_and_output(self):
+        """verify status and output of both streams are returned"""
+        st, rt = process([sys.executable, '-c', 'import sys; print("out"); sys.stderr.write("err\\n"); sys.exit(3)'])
+        self.assertEqual(st, 3)
+        self.assertEqual(sorted(rt.split('\n')), ['err', 'out'])
+
+    def test_process_chatty_stderr(self):
+        """verify a stream of stderr does not stall stdout"""
+        script = 'import sys\nfor i in range(20000):\n    sys.stderr.write("e%d\\n" % i)\nprint("done")'
+        st, rt = process([sys.executable, '-c', script])
+        self.assertEqual(st, 0)
+        self.assertIn('done', rt.split('\n'))
+
+    def test_process_bounded_tail(self):
+        """verify only the tail is kept while the callback sees every line"""
+        seen = []
+        st, rt = process([sys.executable, '-c', 'for i in range(5000): print(i)'],
+                         callback=lambda line, is_stderr: seen.append(line), tail=10)
+        self.assertEqual(st, 0)
+        self.assertEqual(len(seen), 5000)
+        self.assertEqual(rt.split('\n'), [str(i) for i in range(4990, 5000)])
+
+    def test_process_input_text(self):
+        """verify input_text is fed to stdin"""
+        st, rt = process([sys.executable, '-c', 'import sys; print(sys.stdin.read().upper())'],
+                         input_text="spam " * 50000)
+        self.assertEqual(st, 0)
+        self.assertEqual(rt, "SPAM " * 50000)
+
+    def test_process_unterminated_line(self):
+        """verify a final line without a newline is not lost"""
+        st, rt = process([sys.executable, '-c', 'import sys; sys.stdout.write("no newline")'])
+        self.assertEqual((st, rt), (0, 'no newline'))
+
+    def test_process_carriage_returns(self):
+        """verify a line rewritten with \\r is seen each time, and \\r\\n ends one line"""
+        seen = []
+        script = 'import sys, time\nsys.stdout.write("1%\\r"); sys.stdout.flush(); time.sleep(0.1)\nsys.stdout.write("\\n50%\\r\\nend\\r\\n")'
+        st, _rt = process([sys.executable, '-c', script], callback=lambda line, is_stderr: seen.append(line))
+        self.assertEqual(st, 0)
+        self.assertEqual(seen, ['1%', '50%', 'end'])
+
+
+if __name__ == '__main__':
+
+    unittest.main(verbosity=1)
@@ -7,15 +7,25 @@ Small utility classes
 """
 
 import os
+import re
 import time
 import logging
+import selectors
 import subprocess
+import collections
 
 #from RemoteComms import RemoteComms
 from Settings import Settings
 #from MetaData import MetaData
 
 
+# how many lines of a command's output process() keeps for error reporting
+PROCESS_TAIL_LINES = 1000
+PIPE_CHUNK = 65536
+# a line rewritten in place with \r, like rsync's progress, is a line too
+LINE_END = re.compile(b'\r\n|\r|\n')
+
+
 class TimeDate():
     """Date and Time object"""
     
@@ -35,38 +45,89 @@ class TimeDate():
         return time.strftime("%Y-%m-%d")
 
 
-def process(cmd, log=None):
+# pylint: disable=too-many-arguments
+def process(cmd, log=None, input_text=None, callback=None, tail=PROCESS_TAIL_LINES, started=None):
     """execute a command using Popen and collect the output and return status.
     also there is a option to log an info message if log is defined.
-    """
-    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1) as proc:
-        res = []
-        while True:
-            stdOutStr = proc.stdout.readline()
-            stdErrStr = proc.stderr.readline()
-    
-            # If both are empty and there is an error code then stop.
-            if not stdOutStr and not stdErrStr and proc.returncode is not None:
-                break
-                
-            else:
-                if stdOutStr:
-                    res.append(stdOutStr.decode().replace('\n', ''))
-                    
-                    if log:
-                        log.info(stdOutStr.strip().decode())
+    input_text, if given, is written to the command's stdin.
 
-                if stdErrStr:
-                    res.append(stdErrStr.decode().replace('\n', ''))
-                    
-                    if log:
-                        log.info(stdErrStr.strip().decode())
+    stdout and stderr are drained together as data arrives, so a chatty
+    stream can never stall the other. each complete line is passed to
+    callback(line, is_stderr) as it arrives and only the last 'tail' lines
+    are kept for the returned text, so memory stays flat however much the
+    command prints. a line ends with \n, \r\n or \r.
 
-            proc.poll()
+    started(proc), if given, is called with the Popen once the command is
+    running.
+    """
+    res = collections.deque(maxlen=tail)
+    stdin = subprocess.PIPE if input_text is not None else None
+
+    with subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0) as proc:
+        if started:
+            started(proc)
+        sel = selectors.DefaultSelector()
+        partial = {}
+
+        for stream, is_stderr in ((proc.stdout, False), (proc.stderr, True)):
+            sel.register(stream, selectors.EVENT_READ, is_stderr)
+            partial[stream] = b''
+
+        pending = b''
+        if input_text is not None:
+            pending = input_text.encode()
+            if pending:
+                sel.register(proc.stdin, selectors.EVENT_WRITE, None)
+            else:
+                proc.stdin.close()
+
+        def emit(raw, is_stderr):
+            """hand one complete line to the log, callback and tail"""
+            line = raw.rstrip(b'\r\n').decode(errors='replace')
+            res.append(line)
+
+            if log:
+                log.info(line.strip())
+
+            if callback:
+                callback(line, is_stderr)
+
+        while sel.get_map():
+            for key, _mask in sel.select():
+                stream = key.fileobj
+
+                if stream is proc.stdin:
+                    try:
+                        written = os.write(stream.fileno(), pending[:PIPE_CHUNK])
+                    except BrokenPipeError:
+                        written = len(pending)
+                    pending = pending[written:]
+                    if not pending:
+                        sel.unregister(stream)
+                        stream.close()
+                    continue
+
+                data = os.read(stream.fileno(), PIPE_CHUNK)
+                if not data:
+                    # end of stream, flush any unterminated last line
+                    sel.unregister(stream)
+                    if partial[stream]:
+                        emit(partial[stream], key.data)
+                    continue
+
+                data = partial[stream] + data
+                # a \r at the end may be the start of \r\n
+                held = b'\r' if data.endswith(b'\r') else b''
+                lines = LINE_END.split(data[:len(data) - len(held)])
+                partial[stream] = lines.pop() + held
+                for raw in lines:
+                    emit(raw, key.data)
+
+        sel.close()
 
         # Wait for the task to exit.
         proc.wait()
-        
+
         return_code = proc.returncode
         return_text = '\n'.join(res)
 
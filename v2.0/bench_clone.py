@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+bench_clone.py - compare snapshot cloning engines
+
+  bench_clone.py [-f files] [-d dirs] [-w workers] [snapshot]
+
+Clones a snapshot with the os.walk based createNextBackupFolder() algorithm
+from the v0.5 server script and with SnapshotClone, and reports files/second
+for each.  Without a snapshot folder a synthetic one is built in a temporary
+folder first.  Run it on the backup server's filesystem for real numbers.
+"""
+
+import os
+import sys
+import time
+import getopt
+import shutil
+import tempfile
+
+from SnapshotClone import cloneSnapshot, CLONE_WORKERS
+
+
+def legacyClone(src, dest):
+    """createNextBackupFolder() from src/myowncrashplan.py, ported to python3
+    but otherwise unchanged, including its stat and islink calls
+    """
+    os.mkdir(dest)
+    count = 0
+    for root, dirs, files in os.walk(src, topdown=False, followlinks=False):
+        rel = os.path.relpath(root, src)
+        rel = '' if rel == '.' else rel
+        dstpath = os.path.join(dest, rel)
+        p = ''
+        for x in rel.split('/'):
+            p += x
+            os.path.islink(os.path.join(dest, p))
+            p += '/'
+
+        if not os.path.exists(dstpath):
+            os.makedirs(dstpath)
+
+        for name in files:
+            srcfile = os.path.join(root, name)
+            dst = os.path.join(dstpath, name)
+            os.link(srcfile, dst, follow_symlinks=False)
+            if not os.path.islink(srcfile):
+                atime = os.stat(srcfile).st_atime
+                mtime = os.stat(srcfile).st_mtime
+                _mode = os.stat(srcfile).st_mode
+                os.utime(dst, (atime, mtime))
+            count += 1
+
+        for name in dirs:
+            srcdir = os.path.join(root, name)
+            atime = os.stat(srcdir).st_atime
+            mtime = os.stat(srcdir).st_mtime
+            mode = os.stat(srcdir).st_mode
+            dst = os.path.join(dstpath, name)
+            if not os.path.islink(srcdir):
+                try:
+                    os.makedirs(dst, mode)
+                except OSError:
+                    os.chmod(dst, mode)
+                os.utime(dst, (atime, mtime))
+            count += 1
+    return count
+
+
+def makeTree(root, files, dirs):
+    """build a synthetic snapshot of files spread over dirs folders"""
+    per_dir = max(1, files // dirs)
+    for d in range(dirs):
+        folder = os.path.join(root, "d%03d" % (d % 100), "sub%05d" % d)
+        os.makedirs(folder, exist_ok=True)
+        for f in range(per_dir):
+            with open(os.path.join(folder, "f%05d" % f), 'w') as fp:
+                fp.write("x")
+
+
+def timed(label, func, *args):
+    """run func and print its files/second"""
+    start = time.time()
+    count = func(*args)
+    seconds = time.time() - start
+    print("%-24s %9d entries %8.2fs %10.0f entries/s" % (label, count, seconds, count / seconds))
+    return seconds
+
+
+def main(argv):
+    """run the benchmark"""
+    opts, args = getopt.getopt(argv, 'f:d:w:')
+    options = dict(opts)
+    files = int(options.get('-f', 100000))
+    dirs = int(options.get('-d', 2000))
+    workers = int(options.get('-w', CLONE_WORKERS))
+
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(args[0]) if args else None)
+    try:
+        if args:
+            src = args[0]
+        else:
+            src = os.path.join(tmp, "LATEST")
+            makeTree(src, files, dirs)
+
+        old = timed("os.walk (v0.5)", legacyClone, src, os.path.join(tmp, "legacy"))
+        new = timed("SnapshotClone x%d" % workers,
+                    lambda s, d: (lambda st: st.files + st.dirs)(cloneSnapshot(s, d, workers)),
+                    src, os.path.join(tmp, "clone"))
+        print("speed up %.1fx" % (old / new))
+    finally:
+        shutil.rmtree(tmp)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,872 @@
+#!/usr/bin/env python3
+
+# pylint: disable=invalid-name
+# pylint: disable=trailing-whitespace
+# pylint: disable=trailing-newlines
+
+"""
+myocp_agent.py - server side helper
+
+The client copies this script to <backup-destination>/.myocp/ on the server
+and runs it over the shared ssh connection.  It reads one JSON request per
+line on stdin and writes one JSON reply per line on stdout, so a whole batch
+of questions costs a single round trip.
+
+  python3 myocp_agent.py <backup-destination> <local-hostname>
+  python3 myocp_agent.py --reclaim <backup-destination> <local-hostname> [workers max-ops]
+
+The second form is the background reclaimer started by the reclaim op, it
+empties the host's .trash folder and then drops the chunks of any chunk
+backups it held from the chunk store.
+
+  python3 myocp_agent.py --put-range <backup-destination> <local-hostname> <name> <offset>
+
+writes stdin into the range of a big file being sent in parallel streams
+that starts at offset, see RangeTransfer, and replies with what it wrote.
+
+Each request is a dict with an "op" key, each reply is a dict with an "ok"
+key and either the results of the op or an "error" message.
+
+Only the standard library may be used here, the server is not expected to
+have anything else installed.
+"""
+
+import os
+import sys
+import json
+import time
+import gzip
+import hashlib
+import stat
+import fcntl
+import base64
+import shutil
+import zlib
+import sqlite3
+import subprocess
+
+from SnapshotClone import cloneSnapshot, CLONE_WORKERS
+from SnapshotDelete import deleteSnapshot, exclusiveBytes, DELETE_WORKERS
+from ChunkStore import ChunkStore, manifestName, hasManifests, CHUNKS_DIR
+from SnapshotDedupe import DEDUPE_REPORT, DEDUPE_WORKERS, DEDUPE_DB, cachedDigest, hashFile
+from SnapshotCatalog import SnapshotCatalog, QUERY_LIMIT
+from SnapshotUsage import SnapshotUsage, planPrune, USAGE_DB, USAGE_WORKERS
+
+WORKING = "WORKING"
+METADATA = ".metadata"
+TRASH = ".trash"
+RECLAIM_LOCK = ".reclaim.lock"
+PROGRESS = ".progress"
+RUN_JOURNAL = ".run-journal"
+# where rsync keeps the files it was interrupted sending, in a folder per
+# source and shard, RSYNC_PARTIAL_DIR
+PARTIAL = ".myocp-partial"
+# where the ranges of big files are put together before they are linked
+# into WORKING, each file with a note of each range written
+RANGES = ".ranges"
+RANGE_BLOCK = 1024 * 1024
+# the most files link-hits lists as linked from an older reference
+LINK_HITS_LIMIT = 10000
+# block tracked files are patched here before they go into WORKING, and
+# the block map of the last version of each is kept, see BlockTracker
+BLOCKS = ".blocks"
+BLOCK_MAPS = ".block-maps"
+
+
+class Agent():
+    """answer requests about one host's backups"""
+
+    def __init__(self, destination, hostname):
+        """"""
+        self.destination = destination
+        self.hostname = hostname
+        self.root = os.path.join(destination, hostname)
+        self.trash = os.path.join(self.root, TRASH)
+
+    def path(self, name):
+        """full path of a name within the host's backup folder"""
+        if name != os.path.basename(name) or name in ('', '.', '..'):
+            raise ValueError("invalid backup name %s" % name)
+        return os.path.join(self.root, name)
+
+    def handle(self, request):
+        """dispatch a single request and build the reply"""
+        try:
+            handler = getattr(self, "op_" + request['op'].replace('-', '_'))
+        except (KeyError, AttributeError):
+            return {'ok': False, 'error': "unknown request %s" % request.get('op')}
+
+        try:
+            reply = handler(request)
+        except (OSError, ValueError, KeyError) as exc:
+            return {'ok': False, 'error': str(exc)}
+
+        reply['ok'] = True
+        return reply
+
+    def op_ensure_root(self, _request):
+        """create the host's backup folder if needed"""
+        os.makedirs(self.root, exist_ok=True)
+        return {}
+
+    def backupNames(self):
+        """the completed backup folder names, oldest first"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if name.startswith('20') and os.path.isdir(os.path.join(self.root, name)))
+
+    def op_list(self, _request):
+        """list the completed backup folders, oldest first"""
+        backups = [os.path.join(self.root, name) for name in self.backupNames()]
+        return {'backups': backups,
+                'working': os.path.isdir(os.path.join(self.root, WORKING))}
+
+    def op_space(self, _request):
+        """report space on the backup filesystem in bytes. free is what we
+        can write, reserved what only root can. inodes is 0 when the
+        filesystem does not have a fixed number of them.
+        """
+        vfs = os.statvfs(self.destination)
+        total = vfs.f_frsize * vfs.f_blocks
+        free = vfs.f_frsize * vfs.f_bavail
+        reserved = vfs.f_frsize * (vfs.f_bfree - vfs.f_bavail)
+        used = total - vfs.f_frsize * vfs.f_bfree
+        percent = int(round(used * 100.0 / (used + free))) if (used + free) else 100
+        pending, estimating = self.pendingBytes()
+        return {'total': total, 'free': free, 'reserved': reserved, 'used': used, 'percent': percent,
+                'inodes': vfs.f_files, 'inodes_free': vfs.f_favail,
+                'pending': pending, 'estimating': estimating}
+
+    def pendingBytes(self):
+        """bytes in the trash still waiting to be reclaimed, and the number of
+        trashed backups the reclaimer has not sized yet
+        """
+        pending = 0
+        estimating = 0
+        if os.path.isdir(self.trash):
+            for name in os.listdir(self.trash):
+                # a chunk backup's progress outlives it until its chunks go
+                if name.endswith(PROGRESS):
+                    progress = readProgress(os.path.join(self.trash, name))
+                    pending += max(0, progress.get('estimate', 0) - progress.get('freed', 0))
+                elif not name.startswith('.') and \
+                        'estimate' not in readProgress(os.path.join(self.trash, name + PROGRESS)):
+                    estimating += 1
+        return pending, estimating
+
+    def op_metadata(self, _request):
+        """read the host's .metadata file"""
+        meta = {}
+        metafile = os.path.join(self.root, METADATA)
+        if os.path.exists(metafile):
+            with open(metafile, 'r') as fp:
+                meta = json.load(fp)
+        return {'metadata': meta}
+
+    def op_finalize(self, request):
+        """rename WORKING to the dated folder and write the metadata.
+        The metadata is written to a temporary file first so a failure part
+        way through never leaves it pointing at a folder that does not exist.
+        """
+        datedir = self.path(request['datedir'])
+        metafile = os.path.join(self.root, METADATA)
+        tmpfile = metafile + ".tmp"
+
+        with open(tmpfile, 'w') as fp:
+            fp.write(json.dumps(request['metadata'])+"\n")
+        # what rsync was interrupted sending is no part of the backup
+        partial = os.path.join(self.path(WORKING), PARTIAL)
+        if os.path.isdir(partial):
+            deleteSnapshot(partial)
+        try:
+            os.rename(self.path(WORKING), datedir)
+        except OSError:
+            os.unlink(tmpfile)
+            raise
+        os.rename(tmpfile, metafile)
+        # the run journal described WORKING, which is a backup now
+        if os.path.exists(os.path.join(self.root, RUN_JOURNAL)):
+            os.unlink(os.path.join(self.root, RUN_JOURNAL))
+        return {'latest': datedir}
+
+    def op_run_journal(self, request):
+        """read the client's run journal, or write it if one is given"""
+        journal_file = os.path.join(self.root, RUN_JOURNAL)
+        if 'journal' in request:
+            with open(journal_file + ".tmp", 'w') as fp:
+                fp.write(json.dumps(request['journal']))
+            os.rename(journal_file + ".tmp", journal_file)
+            return {}
+        journal = None
+        if os.path.exists(journal_file):
+            with open(journal_file, 'r') as fp:
+                journal = json.load(fp)
+        return {'journal': journal}
+
+    def op_partial_gc(self, request):
+        """remove the partial files rsync, and the ranges of big files, have
+        not touched for max_age seconds, a file that was never sent again is
+        left behind otherwise
+        """
+        partial = os.path.join(self.path(WORKING), PARTIAL)
+        cutoff = time.time() - request['max_age']
+        removed, size, kept = 0, 0, 0
+        # rsync's partial files are in a folder per source and shard
+        folders = []
+        if os.path.isdir(partial):
+            folders = [os.path.join(partial, name) for name in os.listdir(partial)]
+        for folder in folders + [os.path.join(self.root, RANGES), os.path.join(self.root, BLOCKS)]:
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                full = os.path.join(folder, name)
+                st = os.lstat(full)
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                if st.st_mtime >= cutoff:
+                    kept += 1
+                    continue
+                os.unlink(full)
+                removed += 1
+                size += st.st_size
+        for folder in folders:
+            if os.path.isdir(folder) and not os.listdir(folder):
+                os.rmdir(folder)
+        return {'removed': removed, 'bytes': size, 'kept': kept}
+
+    def rangeFile(self, name):
+        """the file the ranges of name are written to"""
+        if not name or not all(c in "0123456789abcdef" for c in name):
+            raise ValueError("invalid range name %s" % name)
+        return os.path.join(self.root, RANGES, name)
+
+    def putRange(self, name, offset, stream):
+        """write stream into the file name from offset, and note the range
+        and its digest once all of it is written
+        """
+        staging = self.rangeFile(name)
+        os.makedirs(os.path.dirname(staging), exist_ok=True)
+        digest = hashlib.sha256()
+        length = 0
+        fd = os.open(staging, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while True:
+                data = stream.read(RANGE_BLOCK)
+                if not data:
+                    break
+                digest.update(data)
+                length += len(data)
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        writeProgress("%s.%d" % (staging, offset), {'length': length, 'digest': digest.hexdigest()})
+        return {'bytes': length, 'digest': digest.hexdigest()}
+
+    def op_range_status(self, request):
+        """the ranges of name written so far, {offset: [length, digest]}"""
+        staging = self.rangeFile(request['name'])
+        ranges = {}
+        if os.path.exists(staging):
+            for note in os.listdir(os.path.dirname(staging)):
+                if note.startswith(request['name'] + '.'):
+                    written = readProgress(os.path.join(os.path.dirname(staging), note))
+                    if written:
+                        ranges[note.rsplit('.', 1)[1]] = [written['length'], written['digest']]
+        return {'ranges': ranges}
+
+    def op_range_assemble(self, request):
+        """check the ranges of name are all there as the client read them,
+        give the file its mode and mtime and link it into WORKING at path
+        """
+        staging = self.rangeFile(request['name'])
+        written = self.op_range_status(request)['ranges']
+        end = 0
+        for offset, length, digest in sorted(request['ranges']):
+            if offset != end or written.get(str(offset)) != [length, digest]:
+                raise ValueError("range %d of %s was not written as sent" % (offset, request['path']))
+            end += length
+        if end != request['size'] or os.lstat(staging).st_size < end:
+            raise ValueError("ranges of %s do not make up %d bytes" % (request['path'], request['size']))
+        os.truncate(staging, end)
+
+        target = self.workingPath(request['path'])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.chmod(staging, request['mode'] & 0o7777)
+        os.utime(staging, ns=(request['mtime_ns'], request['mtime_ns']))
+        if os.path.lexists(target):
+            os.unlink(target)
+        os.link(staging, target)
+        os.unlink(staging)
+        for offset, _length, _digest in request['ranges']:
+            os.unlink("%s.%d" % (staging, offset))
+        return {'bytes': end}
+
+    def blockFile(self, name):
+        """the file a block tracked file is patched in, and its block map"""
+        if not name or not all(c in "0123456789abcdef" for c in name):
+            raise ValueError("invalid block file name %s" % name)
+        return os.path.join(self.root, BLOCKS, name), os.path.join(self.root, BLOCK_MAPS, name)
+
+    def backupPath(self, name, path):
+        """the full path of a path as it is in a backup, in the backup name"""
+        path = os.path.normpath(path)
+        if os.path.isabs(path) or path.split(os.sep)[0] in ('..', '.'):
+            raise ValueError("invalid path %s" % path)
+        return os.path.join(self.path(name), path)
+
+    def workingPath(self, path):
+        """the full path of a path as it is in a backup, in WORKING"""
+        return self.backupPath(WORKING, path)
+
+    def op_block_begin(self, request):
+        """start the new version of a block tracked file from the version in
+        the backup base, if it is the one the client's block map describes.
+        a file that has not changed is linked into WORKING there and then.
+        """
+        staging, map_file = self.blockFile(request['name'])
+        target = self.workingPath(request['path'])
+        block_map = readProgress(map_file)
+        base = self.backupPath(request['base'], request['path']) if request['base'] else None
+        based = False
+        if base and block_map.get('path') == request['path'] and block_map.get('fingerprint') == request['fingerprint']:
+            try:
+                st = os.lstat(base)
+                based = (st.st_size, st.st_mtime_ns) == (block_map['size'], block_map['mtime_ns'])
+            except OSError:
+                pass
+
+        os.makedirs(os.path.dirname(staging), exist_ok=True)
+        if os.path.exists(staging + ".digests"):
+            os.unlink(staging + ".digests")
+        if based and request['unchanged']:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.lexists(target):
+                os.unlink(target)
+            os.link(base, target)
+            return {'based': True}
+        if based:
+            cloneFile(base, staging)
+        else:
+            with open(staging, 'wb'):
+                pass
+        return {'based': based}
+
+    def op_block_put(self, request):
+        """write changed blocks, [index, digest, base64 of the zlib
+        compressed block], into the new version, checking each
+        """
+        staging, _map_file = self.blockFile(request['name'])
+        written = readProgress(staging + ".digests")
+        size = 0
+        fd = os.open(staging, os.O_WRONLY)
+        try:
+            for index, digest, data in request['blocks']:
+                raw = zlib.decompress(base64.b64decode(data))
+                if hashlib.sha256(raw).hexdigest() != digest:
+                    raise ValueError("block %d of %s did not arrive as sent" % (index, request['name']))
+                os.pwrite(fd, raw, index * request['block_size'])
+                written[str(index)] = digest
+                size += len(raw)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        writeProgress(staging + ".digests", written)
+        return {'bytes': size}
+
+    def op_block_end(self, request):
+        """check the new version has the blocks the client has, and put it
+        in WORKING with its mode and mtime
+        """
+        staging, map_file = self.blockFile(request['name'])
+        target = self.workingPath(request['path'])
+        block_size = request['block_size']
+        block_map = readProgress(map_file) if request['based'] else {}
+        digests = block_map.get('digests', [])
+        count = -(-request['size'] // block_size)
+        digests = (digests + [None] * count)[:count]
+        for index, digest in readProgress(staging + ".digests").items():
+            if int(index) < count:
+                digests[int(index)] = digest
+        if None in digests or hashlib.sha256("".join(digests).encode()).hexdigest() != request['fingerprint']:
+            raise ValueError("%s does not have the blocks the client has" % request['path'])
+
+        os.truncate(staging, request['size'])
+        os.chmod(staging, request['mode'] & 0o7777)
+        os.utime(staging, ns=(request['mtime_ns'], request['mtime_ns']))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(staging, target)
+        os.makedirs(os.path.dirname(map_file), exist_ok=True)
+        writeProgress(map_file, {'path': request['path'], 'size': request['size'], 'mtime_ns': request['mtime_ns'],
+                                 'block_size': block_size, 'fingerprint': request['fingerprint'], 'digests': digests})
+        if os.path.exists(staging + ".digests"):
+            os.unlink(staging + ".digests")
+        return {}
+
+    def op_working_paths(self, request):
+        """which of paths are in WORKING"""
+        present = []
+        for path in request['paths']:
+            if os.path.lexists(self.workingPath(path)):
+                present.append(os.path.normpath(path))
+        return {'present': present}
+
+    def op_remove(self, request):
+        """remove a backup folder, reporting progress on stderr"""
+        def progress(stats):
+            """let the client know how far the deletion has got"""
+            sys.stderr.write("remove: %(files)d files %(dirs)d dirs %(freed)d bytes freed\n"
+                             % stats.asDict())
+            sys.stderr.flush()
+
+        target = self.path(os.path.basename(request['path']))
+        stats = deleteSnapshot(target, request.get('workers', DELETE_WORKERS),
+                               request.get('max-ops', 0), progress)
+        for error in stats.errors[:10]:
+            sys.stderr.write("remove: %s\n" % error)
+        if os.path.lexists(target):
+            raise OSError("%s was not completely removed" % target)
+        return {'removed': target, 'delete': stats.asDict()}
+
+    def op_trash(self, request):
+        """move a backup folder into the trash, which is instant, leaving the
+        reclaimer to delete it in the background
+        """
+        target = self.path(os.path.basename(request['path']))
+        os.makedirs(self.trash, exist_ok=True)
+        trashed = os.path.join(self.trash, os.path.basename(target))
+
+        # the usage database already knows what removing it frees on its own,
+        # asked before the move while its chunks can still be told apart
+        estimate = None
+        if os.path.exists(os.path.join(self.root, USAGE_DB)):
+            usage = SnapshotUsage(self.root)
+            try:
+                estimate = usage.exclusive().get(os.path.basename(target))
+            finally:
+                usage.close()
+
+        os.rename(target, trashed)
+        if estimate is not None:
+            writeProgress(trashed + PROGRESS, {'estimate': estimate, 'freed': 0})
+        return {'trashed': trashed}
+
+    def op_reclaim(self, request):
+        """start the background reclaimer, which exits straight away if one
+        is already running
+        """
+        if not os.path.isdir(self.trash) or not os.listdir(self.trash):
+            return {'started': False}
+
+        # pylint: disable=consider-using-with
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--reclaim',
+                          self.destination, self.hostname,
+                          str(request.get('workers', DELETE_WORKERS)),
+                          str(request.get('max-ops', 0))],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
+        return {'started': True}
+
+    def reclaim(self, workers=DELETE_WORKERS, max_ops=0):
+        """delete everything in the trash, oldest first, recording progress
+        so the space op can report what is still to come. only one
+        reclaimer runs at a time. the chunks of chunk backups are freed by
+        a gc of the store once they are gone, their progress is kept until
+        then.
+        """
+        os.makedirs(self.trash, exist_ok=True)
+        with open(os.path.join(self.trash, RECLAIM_LOCK), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return 0
+
+            reclaimed = 0
+            while True:
+                victims = sorted(name for name in os.listdir(self.trash)
+                                 if not name.startswith('.') and not name.endswith(PROGRESS))
+                if not victims:
+                    break
+
+                # size everything first, the client is waiting on the
+                # estimates to decide how much more to trash
+                unsized = [os.path.join(self.trash, name) for name in victims
+                           if 'estimate' not in readProgress(os.path.join(self.trash, name) + PROGRESS)]
+                chunked = self.chunkBytes([victim for victim in unsized if hasManifests(victim)])
+                for victim in unsized:
+                    writeProgress(victim + PROGRESS,
+                                  {'estimate': exclusiveBytes(victim, workers) + chunked.get(victim, 0),
+                                   'freed': 0})
+
+                victim = os.path.join(self.trash, victims[0])
+                progress = readProgress(victim + PROGRESS)
+
+                def update(stats, progress=progress, victim=victim):
+                    """record how much has been freed so far"""
+                    progress['freed'] = stats.freed
+                    writeProgress(victim + PROGRESS, progress)
+
+                chunked = hasManifests(victim)
+                stats = deleteSnapshot(victim, workers, max_ops, update)
+                reclaimed += stats.freed
+                if os.path.lexists(victim):
+                    # leave it for the next reclaimer rather than spin on it
+                    os.unlink(victim + PROGRESS)
+                    break
+                if not chunked:
+                    os.unlink(victim + PROGRESS)
+
+            return reclaimed + self.chunksGc()
+
+    def chunkBytes(self, victims):
+        """{victim: bytes} for the chunks only each of the trashed chunk
+        backups victims refers to
+        """
+        if not victims or not os.path.isdir(os.path.join(self.destination, CHUNKS_DIR)):
+            return {}
+        store = ChunkStore(self.destination)
+        try:
+            return store.exclusive(victims)
+        finally:
+            store.close()
+
+    def chunksGc(self):
+        """drop the chunks of the chunk backups the reclaimer deleted, then
+        their progress. returns the bytes freed.
+        """
+        done = [os.path.join(self.trash, name) for name in os.listdir(self.trash)
+                if name.endswith(PROGRESS)
+                and not os.path.lexists(os.path.join(self.trash, name[:-len(PROGRESS)]))]
+        if not done:
+            return 0
+        freed = 0
+        if os.path.isdir(os.path.join(self.destination, CHUNKS_DIR)):
+            store = ChunkStore(self.destination)
+            try:
+                _dropped, freed = store.gc()
+            finally:
+                store.close()
+        for progress in done:
+            os.unlink(progress)
+        return freed
+
+    def op_usage(self, request):
+        """bring the usage database up to date, walking only the backups made
+        since the last time, and report the bytes each backup holds alone
+        """
+        usage = SnapshotUsage(self.root, request.get('workers', USAGE_WORKERS))
+        try:
+            added, dropped = usage.update(self.backupNames())
+            return {'added': added, 'dropped': dropped, 'exclusive': usage.exclusive()}
+        finally:
+            usage.close()
+
+    def op_prune_plan(self, request):
+        """choose the backups to remove in one go to bring the space used,
+        less what is waiting in the trash, plus the bytes the coming backup
+        needs, down to max-percent. the newest backup is never chosen.
+        """
+        space = self.op_space(request)
+        size = space['used'] + space['free']
+        target = space['used'] - space['pending'] + request.get('need', 0) - size * request['max-percent'] // 100
+
+        names = self.backupNames()
+        if target <= 0 and not request.get('minimum'):
+            return {'remove': [], 'target': target, 'freed': 0}
+
+        usage = SnapshotUsage(self.root, request.get('workers', USAGE_WORKERS))
+        try:
+            usage.update(names)
+            remove, freed = planPrune(usage.groups(), names[:-1], target,
+                                      request.get('minimum', 0))
+        finally:
+            usage.close()
+        return {'remove': [os.path.join(self.root, name) for name in remove],
+                'target': target, 'freed': freed}
+
+    def op_catalog_update(self, request):
+        """add a batch of the paths rsync reported to the catalog entry for a
+        new backup. if the catalog does not have the backup before it, or the
+        client says its list is incomplete, the backup is walked instead.
+        """
+        name = os.path.basename(request['snapshot'])
+        names = self.backupNames()
+        index = names.index(name)
+        previous = names[index - 1] if index else None
+
+        catalog = SnapshotCatalog(self.root)
+        try:
+            row = catalog.snapshot(name)
+            if row and row[1]:
+                return {'rescanned': False, 'skipped': True}
+            _snap, stream = catalog.begin(name, previous)
+            if request.get('full') or not stream:
+                catalog.rescan(name)
+                catalog.finish(name)
+                return {'rescanned': True}
+            catalog.applyChanges(name, request.get('updated', []), request.get('deleted', []))
+            return {'rescanned': False}
+        finally:
+            catalog.close()
+
+    def op_catalog_close(self, request):
+        """mark a new backup complete in the catalog and forget the backups
+        that have been removed
+        """
+        catalog = SnapshotCatalog(self.root)
+        try:
+            dropped = catalog.drop(self.backupNames())
+            totals = catalog.finish(os.path.basename(request['snapshot']))
+            return {'dropped': dropped, 'files': totals['files'], 'bytes': totals['bytes']}
+        finally:
+            catalog.close()
+
+    def op_catalog_query(self, request):
+        """answer a question about history from the catalog"""
+        catalog = SnapshotCatalog(self.root)
+        try:
+            query = request['query']
+            limit = request.get('limit', QUERY_LIMIT)
+            if query == 'snapshots':
+                return {'result': catalog.snapshots()}
+            if query == 'latest':
+                latest = catalog.latest()
+                return {'result': latest[1] if latest else None}
+            if query == 'history':
+                return {'result': catalog.history(request['path'], limit)}
+            if query == 'inode':
+                return {'result': catalog.inode(request['ino'], limit)}
+            if query == 'changes':
+                return {'result': catalog.changes(os.path.basename(request['snapshot']), limit)}
+            raise ValueError("unknown catalog query %s" % query)
+        finally:
+            catalog.close()
+
+    def op_dedupe(self, request):
+        """start a dedupe pass over the whole backup destination in the
+        background, it exits straight away if one is running. replies with
+        the report of the last pass to finish.
+        """
+        report = readProgress(os.path.join(self.destination, DEDUPE_REPORT))
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SnapshotDedupe.py")
+        # pylint: disable=consider-using-with
+        subprocess.Popen([sys.executable, script, '-w', str(request.get('workers', DEDUPE_WORKERS)),
+                          self.destination],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
+        return {'started': True, 'last': report}
+
+    def op_chunks_missing(self, request):
+        """which of a list of chunks the store does not have"""
+        store = ChunkStore(self.destination)
+        try:
+            return {'missing': store.missing(request['digests'])}
+        finally:
+            store.close()
+
+    def op_chunks_put(self, request):
+        """add compressed chunks to the store"""
+        store = ChunkStore(self.destination)
+        try:
+            added, written = store.put(request['chunks'])
+            return {'added': added, 'written': written}
+        finally:
+            store.close()
+
+    def op_manifest_put(self, request):
+        """add entries to the manifest of one source in WORKING. the first
+        batch starts the manifest again, the last one puts it in place.
+        """
+        working = self.path(WORKING)
+        os.makedirs(working, exist_ok=True)
+        self.path(request['source'])
+        manifest = os.path.join(working, manifestName(request['source']))
+        with gzip.open(manifest + ".part", 'wt' if request.get('first') else 'at') as fp:
+            for entry in request['entries']:
+                fp.write(json.dumps(entry)+"\n")
+        if request.get('last'):
+            os.rename(manifest + ".part", manifest)
+        return {}
+
+    def op_link_moves(self, request):
+        """hard link files the client has seen move, from their old path in
+        the backup latest to their new path in WORKING, where their size,
+        mtime and contents match. rsync then finds them already there.
+        """
+        latest = os.path.basename(request['latest'])
+        cache = os.path.join(self.destination, DEDUPE_DB)
+        db = sqlite3.connect(cache) if os.path.exists(cache) else None
+        counts = {'linked': 0, 'bytes': 0, 'present': 0, 'mismatched': 0}
+        try:
+            for old, new, size, mtime, digest in request['moves']:
+                src, dest = self.backupPath(latest, old), self.workingPath(new)
+                if os.path.lexists(dest):
+                    counts['present'] += 1
+                    continue
+                try:
+                    st = os.lstat(src)
+                except OSError:
+                    counts['mismatched'] += 1
+                    continue
+                if not stat.S_ISREG(st.st_mode) or st.st_size != size or int(st.st_mtime) != mtime:
+                    counts['mismatched'] += 1
+                    continue
+                # a dedupe pass may already have hashed it
+                known = cachedDigest(db, st) if db else None
+                if (known or hashFile(src)[1]) != digest:
+                    counts['mismatched'] += 1
+                    continue
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.link(src, dest)
+                counts['linked'] += 1
+                counts['bytes'] += size
+        finally:
+            if db:
+                db.close()
+        return counts
+
+    def op_link_hits(self, request):
+        """find which of the --link-dest references, searched in order as
+        rsync does, the files of path in WORKING were linked from. files
+        linked from a reference after the first are listed, up to
+        LINK_HITS_LIMIT, rsync does not report them.
+
+        a file only comes from an older reference when it is not in the
+        latest backup, which changes the mtime of its folder, so only the
+        files of folders whose mtime differs from the latest backup's are
+        looked at. the rest are only listed.
+        """
+        started = time.time()
+        refs = [self.path(os.path.basename(ref)) for ref in request['refs']]
+        working = self.path(WORKING)
+        top = os.path.relpath(self.workingPath(request['path']), working)
+        hits = [[0, 0] for _ref in refs]
+        new = [0, 0]
+        relinked = []
+        complete = True
+        stats = 0
+        folders = [top]
+        while folders:
+            folder = folders.pop()
+            changed = not refs
+            if refs:
+                stats += 2
+                try:
+                    changed = (os.lstat(os.path.join(working, folder)).st_mtime_ns
+                               != os.lstat(os.path.join(refs[0], folder)).st_mtime_ns)
+                except OSError:
+                    changed = True
+            with os.scandir(os.path.join(working, folder)) as it:
+                entries = list(it)
+            for entry in entries:
+                rel = os.path.join(folder, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(rel)
+                    continue
+                if not changed or not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                stats += 1
+                found = new
+                for index, ref in enumerate(refs):
+                    stats += 1
+                    try:
+                        if os.lstat(os.path.join(ref, rel)).st_ino == st.st_ino:
+                            found = hits[index]
+                            if index and len(relinked) < LINK_HITS_LIMIT:
+                                relinked.append(rel)
+                            elif index:
+                                complete = False
+                            break
+                    except OSError:
+                        continue
+                found[0] += 1
+                found[1] += st.st_size
+        return {'hits': hits, 'new': new, 'relinked': relinked, 'complete': complete, 'stats': stats,
+                'seconds': round(time.time() - started, 3)}
+
+    def op_clone(self, request):
+        """make dest a hard link clone of the backup folder src"""
+        src = self.path(os.path.basename(request['src']))
+        dest = self.path(request.get('dest', WORKING))
+        stats = cloneSnapshot(src, dest, request.get('workers', CLONE_WORKERS))
+        for error in stats.errors[:10]:
+            sys.stderr.write("clone: %s\n" % error)
+        return {'clone': stats.asDict()}
+
+
+def readProgress(filename):
+    """read a reclaim progress file, {} if there isn't one"""
+    try:
+        with open(filename, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def cloneFile(src, dest):
+    """copy src to dest in the kernel, which shares the blocks rather than
+    copying them where the filesystem can
+    """
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            left = os.fstat(fsrc.fileno()).st_size
+            while left > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdest.fileno(), left)
+                if not copied:
+                    break
+                left -= copied
+        except (AttributeError, OSError):
+            fsrc.seek(0)
+            fdest.seek(0)
+            fdest.truncate()
+            shutil.copyfileobj(fsrc, fdest, RANGE_BLOCK)
+
+
+def writeProgress(filename, progress):
+    """replace a reclaim progress file in one step"""
+    with open(filename + ".tmp", 'w') as fp:
+        fp.write(json.dumps(progress))
+    os.rename(filename + ".tmp", filename)
+
+
+def main(argv):
+    """serve requests from stdin until it is closed"""
+    if argv and argv[0] == '--reclaim':
+        Agent(argv[1], argv[2]).reclaim(*[int(arg) for arg in argv[3:5]])
+        return 0
+
+    if argv and argv[0] == '--put-range':
+        try:
+            reply = Agent(argv[1], argv[2]).putRange(argv[3], int(argv[4]), sys.stdin.buffer)
+            reply['ok'] = True
+        except (OSError, ValueError) as exc:
+            reply = {'ok': False, 'error': str(exc)}
+        sys.stdout.write(json.dumps(reply)+"\n")
+        return 0
+
+    if len(argv) != 2:
+        sys.stderr.write("usage: myocp_agent.py [--reclaim] <backup-destination> <local-hostname>\n")
+        return 2
+
+    agent = Agent(argv[0], argv[1])
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            reply = agent.handle(json.loads(line))
+        except ValueError as exc:
+            reply = {'ok': False, 'error': "bad request (%s)" % exc}
+        sys.stdout.write(json.dumps(reply)+"\n")
+        sys.stdout.flush()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -57,6 +57,11 @@ from Installation import initialise, install, uninstall
 from MetaData import MetaData
 from RemoteComms import RemoteComms
 from RsyncMethod import RsyncMethod
+from ParallelRsyncMethod import ParallelRsyncMethod
+from ChunkMethod import ChunkMethod
+from JournalRsyncMethod import JournalRsyncMethod
+from ContinuousBackup import ContinuousBackup
+from CrashPlanError import CrashPlanError
 from Settings import Settings, default_settings_json
 from Utils import TimeDate, backupAlreadyRunning#, weHaveBackedUpToday
 
@@ -80,18 +85,21 @@ CONFIG_FILE = os.path.join(os.environ['HOME'], ".myocp", "settings.json")
 # START HERE
 #
 def Usage():
-    print("myowncrashplan.py [-h -n -f -t --install --uninstall]")
+    print("myowncrashplan.py [-h -n -f -t --history path --changes backup --continuous --install --uninstall]")
     print(" -h    this help")
     print(" -n    dry run, do not do an actual backup")
     print(" -f    force even in already run today")
     print(" -t n  run a numbered test")
+    print(" --history path    list the backups holding each version of path")
+    print(" --changes backup  list what changed in a backup")
+    print(" --continuous  watch the sources and back up changes as they happen (Linux)")
     print(" --install     install into ~/bin/crashplan")
     print(" --uninstall   uninstall from ~/bin/crashplan")
 
 def get_opts(argv):
     """parse the command line"""
     sopt = 'hnfs'
-    lopt = ['help', 'dry_run', 'force', 'size', 'install', 'uninstall']
+    lopt = ['help', 'dry_run', 'force', 'size', 'history=', 'changes=', 'continuous', 'install', 'uninstall']
 
     try:
         opts, _args = getopt.getopt(argv, sopt, lopt)
@@ -103,11 +111,14 @@ def get_opts(argv):
     options = {'dry_run': False,
                'force': False,
                'getsize': False,
+               'history': None,
+               'changes': None,
+               'continuous': False,
                'install': False,
                'uninstall': False}
 
     if opts:
-        for o, _a in opts:
+        for o, a in opts:
             if o in ('-h', '--help'):
                 Usage()
                 sys.exit()
@@ -118,6 +129,15 @@ def get_opts(argv):
             if o in ('-f', '--force'):
                 options['force'] = True
 
+            if o == '--history':
+                options['history'] = a
+
+            if o == '--changes':
+                options['changes'] = a
+
+            if o == '--continuous':
+                options['continuous'] = True
+
             if o == '--install':
                 options['install'] = True
 
@@ -125,7 +145,7 @@ def get_opts(argv):
                 options['uninstall'] = True
 
             if o in ('-s', '--size'):
-                options['getsize'] == True
+                options['getsize'] = True
 
     if options['install'] and options['uninstall']:
         print("ERROR: install and uninstall options are mutually exclusive.")
@@ -147,6 +167,21 @@ def weHaveBackedUpToday(comms, log, settings):
     return False
 
 
+def showCatalog(comms, options):
+    """answer the --history and --changes questions from the server's catalog"""
+    if options['history']:
+        for entry in comms.catalogQuery('history', path=options['history']):
+            held = entry['snapshots']
+            print("%-60s %10d  %s .. %s" % (entry['path'], entry['size'],
+                                            held[0] if held else '-', held[-1] if held else '-'))
+    if options['changes']:
+        changes = comms.catalogQuery('changes', snapshot=options['changes'])
+        for path in changes['changed']:
+            print("+ %s" % path)
+        for path in changes['removed']:
+            print("- %s" % path)
+
+
 def createLogger():
     """create a logger"""
     # create logger with 'myowncrashplan'
@@ -198,7 +233,14 @@ def main():
     settings = Settings(CONFIG_FILE, errlog)
     comms = RemoteComms(settings, errlog)
     meta = MetaData(errlog, comms, settings)
-    rsync = RsyncMethod(settings, meta, errlog, comms, options['dry_run'], options['getsize'])
+    if settings('backup-method') == 'chunk':
+        rsync = ChunkMethod(settings, meta, errlog, comms, options['dry_run'], options['getsize'])
+    elif settings('backup-method') == 'journal':
+        rsync = JournalRsyncMethod(settings, meta, errlog, comms, options['dry_run'], options['getsize'])
+    elif settings('rsync-workers') > 1:
+        rsync = ParallelRsyncMethod(settings, meta, errlog, comms, options['dry_run'], options['getsize'])
+    else:
+        rsync = RsyncMethod(settings, meta, errlog, comms, options['dry_run'], options['getsize'])
 
     if backupAlreadyRunning(errlog):
         sys.exit(0)
@@ -206,10 +248,25 @@ def main():
     if comms.serverIsUp():
         errlog.info("The Server is Up. The backup might be able to start.")
 
-        comms.createRootBackupDir()
+        comms.openMaster()
+        comms.serverState()
+
+        if options['history'] or options['changes']:
+            showCatalog(comms, options)
+            comms.closeMaster()
+            sys.exit(0)
+
+        if options['continuous']:
+            try:
+                ContinuousBackup(settings, meta, errlog, comms).run()
+            except CrashPlanError as exc:
+                errlog.error(exc)
+            comms.closeMaster()
+            sys.exit(0)
 
         if weHaveBackedUpToday(comms, errlog, settings) and not options['force']:
             errlog.info("We Have Already Backed Up Today, so exit here.")
+            comms.closeMaster()
             sys.exit(0)
         elif weHaveBackedUpToday(comms, errlog, settings) and options['force']:
             errlog.info("We Have Already Backed Up Today, but we are running another backup anyway.")
@@ -232,8 +289,13 @@ def main():
         #    errlog.info("There is enough space for the next backup.")
 
         mcp = CrashPlan(settings, meta, errlog, comms, rsync, options['dry_run'])
-        mcp.getSize()
-        sys.exit()
+        # the local journal estimate is cheap and feeds admission and the
+        # size calibration, only the dry run is left to a method that
+        # projects its size as it runs
+        mcp.getSize(dry_run=options['getsize'] or not rsync.projectsSize())
+        if options['getsize']:
+            comms.closeMaster()
+            sys.exit()
         mcp.doBackup()
         mcp.finishUp()
 
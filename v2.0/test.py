@@ -4,9 +4,25 @@ import unittest
 
 from TestRsyncMethod import TestRsyncMethod
 from TestSettings    import TestSettings
-from TestRemoteComms import TestRemoteComms
+from TestRemoteComms import TestRemoteComms, TestRemoteCommsMaster
 from TestMetaData    import TestMetaData
 from TestCrashPlan   import TestCrashPlan
+from TestAgent       import TestAgent
+from TestUtils       import TestUtils
+from TestRsyncOutput import TestRsyncOutput
+from TestParallelRsyncMethod import TestParallelRsyncMethod
+from TestSnapshotClone import TestSnapshotClone
+from TestSnapshotDelete import TestSnapshotDelete
+from TestSnapshotUsage import TestSnapshotUsage
+from TestSnapshotCatalog import TestSnapshotCatalog
+from TestSnapshotDedupe import TestSnapshotDedupe
+from TestChunkMethod import TestChunkMethod, TestChunker
+from TestFileJournal import TestFileJournal, TestJournalRsyncMethod
+from TestContinuousBackup import TestSourceWatcher, TestContinuousBackup
+from TestSpaceWatchdog import TestSpaceWatchdog
+from TestLinkDestHistory import TestLinkDestHistory
+from TestRangeTransfer import TestRangeTransfer
+from TestBlockTracker import TestBlockTracker
 
 #with patch("builtins.open", mock_open(read_data="data")) as mock_file:
 #    assert open("path/to/open").read() == "data"